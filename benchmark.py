@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+import sys, os, time, json, math, random, shutil, argparse, platform
+import subprocess, tempfile, statistics
+
+''' Benchmark fkgit on a synthetic repository.
+    A work tree of the given shape is generated, then committed step by
+    step with churn in between, each command run as its own process:
+      init, add . (whole tree), commit    -> once, they change the repo
+      add ., commit of every history step -> one sample per step
+      status, diff, ls-files, cat-file,   -> --repeat samples on the last
+      indexcat.py                            step plus churn not yet added
+    Per run: wall time, user/sys time, peak RSS, page faults, context
+    switches, and with --syscalls the syscall counts from 'strace -f -c'.
+    Results go to a JSON file, --baseline compares them with an older one.
+
+    python3 benchmark.py --files 20000 --depth 4 -o new.json
+    python3 benchmark.py --files 20000 --depth 4 --baseline old.json
+'''
+HERE = os.path.dirname(os.path.abspath(__file__))
+FKGIT = os.path.join(HERE, 'fkgit.py')
+INDEXCAT = os.path.join(HERE, 'indexcat.py')
+SIZE_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+# sigma of lognormal sizes, most files small and a long tail of big ones.
+LOGNORMAL_SIGMA = 1.0
+# words file lines are made of, so files diff like text.
+WORDS = [word.encode('ascii') for word in
+         'alpha beta gamma delta index tree blob commit pack delta hash '
+         'status diff stage merge branch object cache walk path'.split()]
+
+def errMsg(msg):
+    ''' Print Error Message. '''
+    print("Error, {}".format(msg))
+    exit(1)
+
+def fileSize(rng, dist, mean):
+    ''' Size of a new file drawn from dist with the given mean. '''
+    if dist == 'fixed':
+        return mean
+    if dist == 'uniform':
+        return rng.randint(0, 2 * mean)
+    # mean of lognormvariate(mu, sigma) is exp(mu + sigma ^ 2 / 2).
+    mu = math.log(max(mean, 1)) - LOGNORMAL_SIGMA ** 2 / 2
+    return int(rng.lognormvariate(mu, LOGNORMAL_SIGMA))
+
+def fileData(rng, size):
+    ''' Text of about size bytes, lines of random words. '''
+    lines = []
+    total = 0
+    while total < size:
+        line = b' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        lines.append(line)
+        total += len(line) + 1
+    return b'\n'.join(lines)[:size] + b'\n' if size else b''
+
+def makeDirs(depth, fanout):
+    ''' Directories of a complete tree, fanout children each, depth levels
+        below the root: ['', 'd0/', 'd0/d0/', ...]. '''
+    dirs = ['']
+    level = ['']
+    for _ in range(depth):
+        level = ['{}d{}/'.format(parent, i)
+                 for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+class RepoGenerator:
+    ''' Work tree of the given shape under top, files spread evenly over
+        the directories. Same seed, same tree. '''
+    def __init__(self, top, args):
+        self.top = top
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.dirs = makeDirs(args.depth, args.fanout)
+        self.paths = []
+
+    def writeFile(self, path):
+        fullPath = os.path.join(self.top, path)
+        os.makedirs(os.path.dirname(fullPath), exist_ok = True)
+        size = fileSize(self.rng, self.args.sizeDist, self.args.size)
+        with open(fullPath, 'wb') as fWt:
+            fWt.write(fileData(self.rng, size))
+
+    def newFile(self):
+        ''' Write a file with a new name, return its path. '''
+        path = '{}f{}.txt'.format(self.rng.choice(self.dirs), len(self.paths))
+        self.paths.append(path)
+        self.writeFile(path)
+        return path
+
+    def generate(self):
+        for _ in range(self.args.files):
+            self.newFile()
+
+    def churn(self, deletes = False):
+        ''' Rewrite churn rate of the files and add a tenth as many new
+            ones, with deletes also remove that many. '''
+        count = max(1, int(len(self.paths) * self.args.churn))
+        for path in self.rng.sample(self.paths, min(count, len(self.paths))):
+            self.writeFile(path)
+        for _ in range(max(1, count // 10)):
+            self.newFile()
+        if deletes:
+            for path in self.rng.sample(self.paths, max(1, count // 10)):
+                self.paths.remove(path)
+                os.remove(os.path.join(self.top, path))
+
+def parseStraceSummary(path):
+    ''' Return {syscall: calls} and the total from 'strace -c' output. '''
+    counts = {}
+    total = None
+    with open(path) as fRd:
+        for line in fRd:
+            fields = line.split()
+            # % time, seconds, usecs/call, calls, [errors], syscall
+            if len(fields) < 5 or not fields[3].isdigit():
+                continue
+            if fields[-1] == 'total':
+                total = int(fields[3])
+            else:
+                counts[fields[-1]] = int(fields[3])
+    return counts, total
+
+def runCommand(argv, cwd, env, syscalls = False):
+    ''' Run argv once, return its measurements. With syscalls it is run a
+        second time under strace, the slow traced run is not timed. '''
+    # a file, not a pipe, a full pipe would block the child we wait for.
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        proc = subprocess.Popen(argv, cwd = cwd, env = env,
+                                stdout = subprocess.DEVNULL, stderr = stderr)
+        # wait4() gives resource usage of this child only.
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            stderr.seek(0)
+            errMsg("{} Failed: {}".format(' '.join(argv),
+                   stderr.read().decode('utf-8', 'replace').strip()))
+    result = {
+        'wall': wall,
+        'user': usage.ru_utime,
+        'sys': usage.ru_stime,
+        # kilobytes on Linux, bytes on macOS.
+        'maxRss': usage.ru_maxrss,
+        'majorFaults': usage.ru_majflt,
+        'minorFaults': usage.ru_minflt,
+        'contextSwitches': usage.ru_nvcsw + usage.ru_nivcsw,
+    }
+    if syscalls:
+        with tempfile.NamedTemporaryFile(suffix = '.strace') as summary:
+            subprocess.run(['strace', '-f', '-c', '-o', summary.name] + argv,
+                           cwd = cwd, env = env, check = True,
+                           stdout = subprocess.DEVNULL,
+                           stderr = subprocess.DEVNULL)
+            result['syscallCounts'], result['syscalls'] = \
+                    parseStraceSummary(summary.name)
+    return result
+
+def summarize(samples):
+    ''' Median of every number over samples, max for peak RSS. '''
+    summary = {'runs': len(samples)}
+    for key in samples[0]:
+        if key == 'syscallCounts':
+            continue
+        values = [sample[key] for sample in samples
+                  if sample.get(key) is not None]
+        if not values:
+            continue
+        summary[key] = max(values) if key == 'maxRss' else \
+                       statistics.median(values)
+    if 'wall' in summary and len(samples) > 1:
+        summary['wallMin'] = min(sample['wall'] for sample in samples)
+    return summary
+
+class Benchmark:
+    ''' Runs the commands in order and collects samples by name. '''
+    def __init__(self, repo, args):
+        self.repo = repo
+        self.args = args
+        self.samples = {}
+        self.env = dict(os.environ, GIT_AUTHOR_NAME = 'bench',
+                        GIT_AUTHOR_EMAIL = 'bench@example.com')
+        self.syscalls = args.syscalls
+
+    def run(self, name, argv, repeat = 1):
+        for _ in range(repeat):
+            result = runCommand(argv, self.repo, self.env, self.syscalls)
+            self.samples.setdefault(name, []).append(result)
+        if self.args.verbose:
+            print('{:<16} {:8.3f}s'.format(name, self.samples[name][-1]['wall']))
+
+    def fkgit(self, name, *args, repeat = 1):
+        self.run(name, [sys.executable, FKGIT] + list(args), repeat)
+
+def readHead(repo):
+    ''' SHA-1 of master, as fkgit writes it. '''
+    with open(os.path.join(repo, '.git', 'refs', 'heads', 'master')) as fRd:
+        return fRd.read().strip()
+
+def runBenchmark(args):
+    ''' Generate the repository, run every command, return the results. '''
+    top = args.keep or tempfile.mkdtemp(prefix = 'fkgit-bench-')
+    repo = os.path.join(top, 'repo')
+    if os.path.exists(repo):
+        shutil.rmtree(repo)
+    os.makedirs(repo)
+    generator = RepoGenerator(repo, args)
+    bench = Benchmark(repo, args)
+    try:
+        start = time.perf_counter()
+        generator.generate()
+        generateTime = time.perf_counter() - start
+
+        bench.fkgit('init', 'init')
+        bench.fkgit('add-all', 'add', '.')
+        bench.fkgit('commit-first', 'commit', '-m', 'initial')
+        for step in range(args.history):
+            generator.churn()
+            bench.fkgit('add-churn', 'add', '.')
+            bench.fkgit('commit', 'commit', '-m', 'step {}'.format(step))
+
+        # changes not added yet, what status and diff have to find.
+        generator.churn(deletes = True)
+        repeat = args.repeat
+        bench.fkgit('status', 'status', repeat = repeat)
+        bench.fkgit('diff', 'diff', repeat = repeat)
+        bench.fkgit('ls-files', 'ls-files', '-s', repeat = repeat)
+        head = readHead(repo)
+        bench.fkgit('cat-file-commit', 'cat-file', '-p', head, repeat = repeat)
+        blobPath = generator.paths[0]
+        blob = subprocess.run([sys.executable, FKGIT, 'hash-object',
+                               blobPath], cwd = repo, env = bench.env,
+                              stdout = subprocess.PIPE, check = True)
+        bench.fkgit('cat-file-blob', 'cat-file', '-p',
+                    blob.stdout.decode().strip(), repeat = repeat)
+        bench.run('indexcat', [sys.executable, INDEXCAT,
+                  os.path.join('.git', 'index')], repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(top, ignore_errors = True)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'revision': gitRevision(),
+            'generateTime': generateTime,
+        },
+        'shape': {key: getattr(args, key) for key in
+                  ('files', 'depth', 'fanout', 'sizeDist', 'size', 'history',
+                   'churn', 'seed', 'repeat')},
+        'results': {name: summarize(samples)
+                    for name, samples in bench.samples.items()},
+        'samples': bench.samples,
+    }
+
+def gitRevision():
+    ''' Commit of the fkgit source benchmarked, None if not a git repo. '''
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = HERE,
+                             stdout = subprocess.PIPE,
+                             stderr = subprocess.DEVNULL, check = True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.decode().strip()
+
+def printResults(report, baseline = None, threshold = 0.1):
+    ''' Print a table of results, with ratios to baseline if given.
+        Return names slower than baseline by more than threshold. '''
+    results = report['results']
+    base = baseline['results'] if baseline else {}
+    if baseline and baseline.get('shape') != report['shape']:
+        print('Warning: baseline shape differs: {}'.format(baseline['shape']))
+    header = '{:<16} {:>4} {:>9} {:>9} {:>9} {:>10}'.format(
+             'command', 'runs', 'wall', 'user', 'sys', 'maxRss')
+    header += ' {:>9}'.format('syscalls')
+    if base:
+        header += ' {:>8} {:>8}'.format('wall x', 'rss x')
+    print(header)
+    slower = []
+    for name, result in results.items():
+        line = '{:<16} {:>4} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>8}kB'.format(
+               name, result['runs'], result['wall'], result['user'],
+               result['sys'], result['maxRss'])
+        line += ' {:>9}'.format(result.get('syscalls', '-'))
+        old = base.get(name)
+        if old:
+            wallRatio = result['wall'] / old['wall'] if old['wall'] else 0
+            rssRatio = result['maxRss'] / old['maxRss'] if old['maxRss'] else 0
+            line += ' {:>8.2f} {:>8.2f}'.format(wallRatio, rssRatio)
+            if wallRatio > 1 + threshold:
+                slower.append(name)
+                line += '  slower'
+        print(line)
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description = 'benchmark fkgit on a generated repository')
+    parser.add_argument('--files', type = int, default = 1000,
+            help = 'files in the generated tree (default %(default)s)')
+    parser.add_argument('--depth', type = int, default = 3,
+            help = 'directory levels below the root (default %(default)s)')
+    parser.add_argument('--fanout', type = int, default = 4,
+            help = 'sub directories per directory (default %(default)s)')
+    parser.add_argument('--size-dist', dest = 'sizeDist',
+            choices = SIZE_DISTRIBUTIONS, default = 'lognormal',
+            help = 'distribution of file sizes (default %(default)s)')
+    parser.add_argument('--size', type = int, default = 4096,
+            help = 'mean file size in bytes (default %(default)s)')
+    parser.add_argument('--history', type = int, default = 5,
+            help = 'commits after the first one (default %(default)s)')
+    parser.add_argument('--churn', type = float, default = 0.05,
+            help = 'fraction of files changed per commit '
+                   '(default %(default)s)')
+    parser.add_argument('--seed', type = int, default = 0,
+            help = 'random seed, same seed same repository')
+    parser.add_argument('-r', '--repeat', type = int, default = 5,
+            help = 'runs of each read only command (default %(default)s)')
+    parser.add_argument('--syscalls', action = 'store_true',
+            help = 'count syscalls with strace, in an extra untimed run')
+    parser.add_argument('-o', '--output', default = None,
+            help = 'write results to this JSON file')
+    parser.add_argument('--baseline', default = None,
+            help = 'JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type = float, default = 0.1,
+            help = 'wall time ratio over 1 + threshold is a regression, '
+                   'exit status 1 then (default %(default)s)')
+    parser.add_argument('--keep', default = None,
+            help = 'generate into this directory and keep it')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+            help = 'print every run as it finishes')
+    args = parser.parse_args()
+
+    if args.syscalls and shutil.which('strace') is None:
+        errMsg("--syscalls Needs strace Installed.")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fRd:
+            baseline = json.load(fRd)
+
+    report = runBenchmark(args)
+    if args.output:
+        with open(args.output, 'w') as fWt:
+            json.dump(report, fWt, indent = 2, sort_keys = True)
+    slower = printResults(report, baseline, args.threshold)
+    if slower:
+        print('Slower than baseline: {}'.format(', '.join(slower)))
+        exit(1)
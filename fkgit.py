@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
-import sys, os, zlib, struct, math, argparse, time, operator
-import getopt, hashlib, collections, binascii, stat, difflib
+import sys, os, zlib, struct, math, time, operator
+import hashlib, collections, binascii, stat, threading, bisect, re, atexit
+# modules only some commands need (argparse, tempfile, json, mmap, ...) are
+# imported where used, an embedding process does not pay for the rest.
 
 # ./.fkgit, same as ./.git
 baseName = '.git'
+# read size per chunk when hashing files, 1 MiB.
+streamChunkSize = 1 << 20
 
 # Data for one entry in the git index (.git/index)
 ''' Parse Index File.
@@ -26,13 +30,232 @@ baseName = '.git'
       | 9-bit unix perm   |        | 12-bit name length      |
 '''
 # IndexEntry = <class '__main__.IndexEntryType'>
+# extFlags is the 16-bit extended flags of index v3 and later, 0 if none.
 IndexEntry = collections.namedtuple('IndexEntryType', [
     'ctime_s', 'ctime_n', 'mtime_s', 'mtime_n', 'dev', 'ino', 'mode', 'uid',
-    'gid', 'size', 'sha1', 'flags', 'path'])
+    'gid', 'size', 'sha1', 'flags', 'path', 'extFlags'], defaults = [0])
+
+# flags of IndexEntry, see the format above.
+INDEX_FLAG_EXTENDED = 0x4000
+INDEX_NAME_MASK = 0xfff
+
+class LRUCache:
+    ''' Least recently used cache bounded by total bytes of its items, with
+        counters of hits, misses and evictions. sizeOf(item) gives the
+        bytes an item is charged for, len(item[1]) of (type, data) default.
+    '''
+    def __init__(self, maxBytes, sizeOf = lambda item: len(item[1])):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.curBytes = 0
+        self.items = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        # threads of a pool or of the server share the caches.
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, item):
+        size = self.sizeOf(item)
+        with self.lock:
+            if size > self.maxBytes or key in self.items:
+                return
+            self.items[key] = (item, size)
+            self.curBytes += size
+            while self.curBytes > self.maxBytes:
+                _, (_, oldSize) = self.items.popitem(last = False)
+                self.curBytes -= oldSize
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.curBytes = 0
+
+    def stats(self):
+        ''' Return counters as dict, e.g. {'hits': 3, 'misses': 1, ...}. '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'items': len(self.items),
+                'bytes': self.curBytes, 'maxBytes': self.maxBytes}
+
+# bytes of inflated objects cached per repository, objectCache of
+# RepositoryState.
+OBJECT_CACHE_BYTES = 64 << 20
+# bytes of parsed trees cached per repository, treeCache of RepositoryState.
+TREE_CACHE_BYTES = 8 << 20
+
+def treeCacheSize(entries):
+    ''' Bytes a parsed tree is charged for, about its raw tree object. '''
+    return 64 * len(entries)
+
+def cacheStats():
+    ''' Return counters of the in-process object caches. '''
+    state = repoState()
+    return {'object': state.objectCache.stats(),
+            'tree': state.treeCache.stats(),
+            'deltaBase': state.deltaBaseCache.stats()}
+
+''' Phase tracing, on when FKGIT_TRACE names a file. At exit one JSON line
+    per command is appended to it:
+      {"command": ["status"], "pid": 4242, "start": 1700000000.1,
+       "wall": 0.25, "phases": {"index-read": {"calls": 1, "seconds":
+       0.01}, ...}, "counters": {"filesStat": 3, ...}, "caches": {...}}
+    Phase times are inclusive, 'object-read' holds its 'zlib-decompress'
+    too. Only the main process is traced, not workers of a process pool.
+    Off, a hook costs one global lookup: 'with tracePhase(name)' gets a
+    shared do-nothing context, 'if trace:' guards every counter.
+'''
+TRACE_ENV = 'FKGIT_TRACE'
+
+class TracePhase:
+    ''' Context adding its time and a call to one phase of a Trace. '''
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *excInfo):
+        self.phase[0] += 1
+        self.phase[1] += time.perf_counter() - self.start
+
+class Trace:
+    ''' Phase times and counters of this process, see above. '''
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.startCounter = time.perf_counter()
+        # name -> [calls, seconds]
+        self.phases = collections.defaultdict(lambda: [0, 0.0])
+        self.counters = collections.Counter()
+
+    def phase(self, name):
+        return TracePhase(self.phases[name])
+
+    def count(self, name, value = 1):
+        self.counters[name] += value
+
+    def write(self):
+        ''' Append the JSON line of this command to the trace file. '''
+        record = {
+            'command': sys.argv[1:], 'pid': os.getpid(), 'start': self.start,
+            'wall': time.perf_counter() - self.startCounter,
+            'phases': {name: {'calls': calls, 'seconds': seconds}
+                       for name, (calls, seconds) in self.phases.items()},
+            'counters': dict(self.counters), 'caches': cacheStats(),
+        }
+        import json
+        # one write() of a line opened for append, lines of concurrent
+        # commands do not mix.
+        with open(self.path, 'a') as fWt:
+            fWt.write(json.dumps(record, sort_keys = True) + '\n')
+
+class NoTracePhase:
+    ''' Context of tracePhase() when tracing is off. '''
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *excInfo):
+        pass
+
+noTracePhase = NoTracePhase()
+trace = Trace(os.environ[TRACE_ENV]) if os.environ.get(TRACE_ENV) else None
+if trace:
+    # forked pool workers leave by os._exit(), they never write.
+    atexit.register(trace.write)
+
+def tracePhase(name):
+    ''' Context timing phase name, e.g. 'with tracePhase('diff'):'. '''
+    return trace.phase(name) if trace else noTracePhase
+
+''' Index lock, same as git's: .git/index.lock is created with O_EXCL by
+    whoever rewrites the index, the new index is written into it and
+    renamed over .git/index, which releases it. Commands changing the index
+    (add, commit, update-index) hold it from reading the index to writing
+    it, so two of them never overwrite each other's entries; a second one
+    fails as git does. status only refreshes the index when it gets the
+    lock and the index is still the one it read.
+'''
+def lockIndex():
+    ''' Create .git/index.lock, return its path, None if it exists. '''
+    lockPath = gitPath('index.lock')
+    try:
+        os.close(os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o666))
+    except FileExistsError:
+        return None
+    return lockPath
+
+def unlockIndex():
+    ''' Remove index.lock held by this process, if any. '''
+    indexLockState = repoState().indexLock
+    lockPath, indexLockState['path'] = indexLockState['path'], None
+    if lockPath is not None:
+        try:
+            os.unlink(lockPath)
+        except FileNotFoundError:
+            pass
+
+class IndexLock:
+    ''' Context holding index.lock, errMsg() if another process does. It
+        is taken again by a write after the index was renamed. '''
+    def __enter__(self):
+        indexLockState = repoState().indexLock
+        if indexLockState['path'] is None:
+            indexLockState['path'] = lockIndex() or errMsg(
+                    "Unable to Create '{}': File Exists. Another fkgit or "
+                    "git Process Seems to Be Running.".format(
+                    gitPath('index.lock')))
+        indexLockState['depth'] += 1
+
+    def __exit__(self, *excInfo):
+        indexLockState = repoState().indexLock
+        indexLockState['depth'] -= 1
+        if indexLockState['depth'] == 0:
+            unlockIndex()
+
+def indexLocked(func):
+    ''' Decorator running func with index.lock held. '''
+    def locked(*args, **kwargs):
+        with IndexLock():
+            return func(*args, **kwargs)
+    locked.__name__, locked.__doc__ = func.__name__, func.__doc__
+    return locked
+
+def encodeOffsetVarint(value):
+    ''' Big endian varint of pack OFS_DELTA and index v4: 7 bit per byte,
+        +1 for every byte after the first, so no two encodings mean the
+        same value. '''
+    encoded = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        value -= 1
+        encoded.insert(0, 0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(encoded)
+
+def decodeOffsetVarint(data, pos):
+    ''' Return (value, next pos) of encodeOffsetVarint() data at pos. '''
+    byte = data[pos]
+    value = byte & 0x7f
+    pos += 1
+    while byte & 0x80:
+        byte = data[pos]
+        value = ((value + 1) << 7) | (byte & 0x7f)
+        pos += 1
+    return (value, pos)
 
 def lsFiles(verbose = False):
     ''' Show staged contents' object name in the output. '''
-    for entry in readIndex():
+    for entry in readIndex(verify = False):
         ''' IndexEntryType(ctime_s=1505698291, ctime_n=0, mtime_s=1505698291,
             mtime_n=0, dev=64512, ino=194773692, mode=33277, uid=1000,
             gid=1000, size=8920,
@@ -48,81 +271,798 @@ def lsFiles(verbose = False):
         else:
             print(entry.path)
 
-def diff():
-    ''' Show diff between index and working tree. '''
-    ''' entries_by_path = {e.path: e for e in read_index()} =
-        {'indexcat.py': IndexEntry(..., ..., path='indexcat.py'),
-        'main.cpp': IndexEntry(..., ..., path='main.cpp')}
-    '''
-    # type(entries_by_path) = <class 'dict'>, convert to Key -> Value.
-    entriesByPath = {entry.path: entry for entry in readIndex()}
-    ''' for path in enumerate(changed):
-            ...  print(path)
-                 ...
-                 (0, 'demo.py')
-                 (1, 'fkgit.py')
-    '''
-    changed, _, _ = getStatus()
-    for _, path in enumerate(changed):
-        sha1 = binascii.hexlify(entriesByPath[path].sha1).decode('utf-8')
-        objType, data = readObject(sha1)
-        assert objType == 'blob', "Only Support blob type."
-        indexLines = data.decode('utf-8').splitlines()
-        workingLines = readFile(path).decode('utf-8').splitlines()
-
-        ''' unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
-            tofiledate='', n=3, lineterm='\n')
-            Compare two sequences of lines;
-            generate the delta as a unified diff.
-        '''
-        # For inputs that do not have trailing newlines, set the lineterm
-        # argument to "" so that the output will be uniformly newline free
-        diffLines = difflib.unified_diff(
-                    indexLines, workingLines,
-                    'a/{} (index)'.format(path),
-                    'b/{} (working tree)'.format(path),
-                    lineterm = '')
+def diff(cached = False, commits = (), algorithm = 'myers', stat = False,
+         jobs = None, poolType = 'process', preloadThreads = None):
+    ''' Show diff between index and working tree. With cached, between the
+        tree of commits[0] (HEAD by default) and index. With two commits,
+        between their trees. With stat, print changed line counts only.
+        Files are diffed by a pool of 'jobs' workers, output keeps order.
+        Index entries are lstat-ed by 'preloadThreads' threads.
+    '''
+    pairs = diffPairsOf(cached, commits, preloadThreads)
+    if stat:
+        with tracePhase('diff'):
+            stats = list(diffPairs(diffStatWorker, pairs, algorithm, jobs,
+                                   poolType))
+        printDiffStat(stats)
+        return
+    # print() buffers text, flush it before writing bytes underneath.
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    # output streams as files are done, writing it is part of the phase.
+    with tracePhase('diff'):
+        for data in diffPairs(diffFileWorker, pairs, algorithm, jobs,
+                              poolType):
+            out.write(data)
+            out.flush()
+
+def diffPairsOf(cached = False, commits = (), preloadThreads = None):
+    ''' Return [(path, oldMode, oldSha1, newMode, newSha1)] of what diff()
+        compares, newSha1 None with newMode set means the new side is the
+        file in working tree. '''
+    # pairs of trees come from a generator, walked as they are diffed.
+    if len(commits) == 2:
+        oldTree, newTree = [revisionTree(name) for name in commits]
+        pairs = diffTrees(oldTree, newTree)
+    elif cached:
+        if commits:
+            headTree = revisionTree(commits[0])
+        else:
+            # no commit yet, everything in index is new.
+            headTree = getLocalMasterHash() and revisionTree('HEAD')
+        pairs = diffTreeIndex(headTree, readIndex(verify = False))
+    elif commits:
+        errMsg("Diff between Commit and Working Tree Not Supported.")
+    else:
+        index = readIndex(verify = False)
+        changed, _, _ = getStatus(preloadThreads)
+        pairs = []
+        for path in changed:
+            entry = index.get(path)
+            newMode = treeMode(os.lstat(workPath(path)).st_mode)
+            pairs.append((path, '{:o}'.format(treeMode(entry.mode)),
+                          entry.sha1.hex(), '{:o}'.format(newMode), None))
+    return list(pairs)
+
+# diff pairs per pool worker when jobs is not given, a pool costs more to
+# start than diffing a few files in this process.
+DIFF_MIN_PAIRS = 16
+
+def diffPairs(worker, pairs, algorithm, jobs = None, poolType = 'process'):
+    ''' Yield worker((pair, algorithm)) of every diff pair, in order of
+        pairs. Pairs are diffed by a pool of 'jobs' workers, at most a
+        few per worker in flight, and each result is yielded as soon as
+        it and all before it are done, so output starts with the first
+        file, not after the last one. By default one worker per
+        DIFF_MIN_PAIRS pairs up to cpu count, no pool below twice that.
+    '''
+    pairs = list(pairs)
+    if trace:
+        trace.count('filesDiffed', len(pairs))
+    if jobs is None:
+        jobs = min(len(pairs) // DIFF_MIN_PAIRS, os.cpu_count() or 1)
+    jobs = min(jobs, len(pairs))
+    if jobs <= 1:
+        for pair in pairs:
+            yield worker((pair, algorithm))
+        return
 
-        for line in diffLines:
-            print(line)
+    with workerPool(jobs, poolType) as executor:
+        pending = collections.deque()
+        for pair in pairs:
+            pending.append(executor.submit(worker, (pair, algorithm)))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def diffFileWorker(task):
+    ''' Worker of diffPairs(), return whole diff of one pair as bytes. '''
+    pair, algorithm = task
+    return b''.join(diffFile(*pair, algorithm = algorithm))
+
+def diffStatWorker(task):
+    ''' Worker of diffPairs(), return diffFileStat() of one pair. '''
+    pair, algorithm = task
+    return diffFileStat(*pair, algorithm = algorithm)
+
+''' Diff engine, works on bytes.
+    Lines are split on b'\n' only and keep it, then interned to ints so
+    the algorithms compare small ints instead of bytes. Result of every
+    algorithm is two arrays of change marks, changedA[i] = 1 if line i of
+    old side is deleted, changedB[j] = 1 if line j of new side is added,
+    unmarked lines match one to one in order. Hunks and stat are built
+    from the marks.
+      myers     - O(ND) shortest edit script, linear space by splitting at
+                  the middle snake (Myers 1986, section 4b).
+      patience  - match lines unique on both sides first (longest
+                  increasing subsequence), recurse between them.
+      histogram - match the region around the least frequent common line,
+                  recurse on both sides, like jgit and git.
+'''
+DIFF_ALGORITHMS = ('myers', 'patience', 'histogram')
+# git treats a file with NUL in the first 8000 bytes as binary.
+BINARY_CHECK_SIZE = 8000
+# histogram skips lines occurring more often than this, same as git.
+HISTOGRAM_MAX_CHAIN = 64
+# myers stops looking for the shortest edit script after this many edits
+# (or square root of total lines if more), same limit as xdiff.
+DIFF_MAX_COST = 256
+# lines of context around each hunk.
+DIFF_CONTEXT = 3
+
+def isBinary(data):
+    ''' Guess if data is binary the same way git does. '''
+    return b'\x00' in data[:BINARY_CHECK_SIZE]
+
+def splitLines(data):
+    ''' Split bytes into lines ending with b'\n', the last one may not. '''
+    parts = data.split(b'\n')
+    lines = [part + b'\n' for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+def diffLines(aLines, bLines, algorithm = 'myers'):
+    ''' Diff two lists of lines, return (changedA, changedB) bytearrays of
+        change marks, see the comment above. '''
+    # common prefix and suffix never change, leave them out of interning.
+    aLen, bLen = len(aLines), len(bLines)
+    prefix = 0
+    while prefix < aLen and prefix < bLen and \
+            aLines[prefix] == bLines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < aLen - prefix and suffix < bLen - prefix and \
+            aLines[aLen - 1 - suffix] == bLines[bLen - 1 - suffix]:
+        suffix += 1
+
+    # intern lines, {b'line\n': 0, ...}
+    ids = {}
+    a = [ids.setdefault(line, len(ids))
+         for line in aLines[prefix:aLen - suffix]]
+    b = [ids.setdefault(line, len(ids))
+         for line in bLines[prefix:bLen - suffix]]
+    changedA = bytearray(aLen)
+    changedB = bytearray(bLen)
+
+    # a line missing on the other side can never match, mark it changed
+    # and run the algorithm on the rest only, they are usually few.
+    aSet, bSet = set(a), set(b)
+    aKeep = [i for i, line in enumerate(a) if line in bSet]
+    bKeep = [j for j, line in enumerate(b) if line in aSet]
+    for i in range(len(a)):
+        changedA[prefix + i] = 1
+    for j in range(len(b)):
+        changedB[prefix + j] = 1
+    a = [a[i] for i in aKeep]
+    b = [b[j] for j in bKeep]
+    marksA, marksB = bytearray(len(a)), bytearray(len(b))
+    diffSequences(a, b, marksA, marksB, algorithm)
+    for k, i in enumerate(aKeep):
+        changedA[prefix + i] = marksA[k]
+    for k, j in enumerate(bKeep):
+        changedB[prefix + j] = marksB[k]
+    compactChanges(aLines, changedA, changedB)
+    compactChanges(bLines, changedB, changedA)
+    return changedA, changedB
+
+def compactChanges(lines, changed, otherChanged):
+    ''' Slide groups of changed lines the way xdiff does without indent
+        heuristic: as far down as they go, then back up to line up with
+        a change group of the other side, so equal diffs print the same
+        whatever the algorithm picked. Groups of both sides are walked in
+        step, [start, end) here, [otherStart, otherEnd) on the other side.
+    '''
+    def groupEnd(marks, start):
+        while start < len(marks) and marks[start]:
+            start += 1
+        return start
+
+    def groupStart(marks, end):
+        while end > 0 and marks[end - 1]:
+            end -= 1
+        return end
+
+    start, end = 0, groupEnd(changed, 0)
+    otherStart, otherEnd = 0, groupEnd(otherChanged, 0)
+
+    def slideUp():
+        nonlocal start, end, otherStart, otherEnd
+        if start == 0 or lines[start - 1] != lines[end - 1]:
+            return False
+        start -= 1
+        end -= 1
+        changed[start], changed[end] = 1, 0
+        start = groupStart(changed, start)
+        otherEnd = otherStart - 1
+        otherStart = groupStart(otherChanged, otherEnd)
+        return True
+
+    while True:
+        if end != start:
+            while True:
+                size = end - start
+                endMatchingOther = -1
+                while slideUp():
+                    pass
+                earliestEnd = end
+                if otherEnd > otherStart:
+                    endMatchingOther = end
+                while end < len(changed) and lines[start] == lines[end]:
+                    changed[start], changed[end] = 0, 1
+                    start += 1
+                    end = groupEnd(changed, end + 1)
+                    otherStart = otherEnd + 1
+                    otherEnd = groupEnd(otherChanged, otherStart)
+                    if otherEnd > otherStart:
+                        endMatchingOther = end
+                # sliding may have merged groups, then slide again.
+                if size == end - start:
+                    break
+            if end != earliestEnd and endMatchingOther != -1:
+                while otherEnd == otherStart:
+                    slideUp()
+        if end == len(changed):
+            break
+        start = end + 1
+        end = groupEnd(changed, start)
+        otherStart = otherEnd + 1
+        otherEnd = groupEnd(otherChanged, otherStart)
+
+def diffSequences(a, b, changedA, changedB, algorithm = 'myers'):
+    ''' Diff int lists a and b, set change marks into changedA, changedB.
+        Ranges to diff are kept in a stack instead of recursion, so deep
+        splits of patience and histogram can not overflow Python's stack.
+    '''
+    assert algorithm in DIFF_ALGORITHMS, \
+            "Unknown Diff Algorithm {}.".format(algorithm)
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        aLo, aHi, bLo, bHi = stack.pop()
+        while aLo < aHi and bLo < bHi and a[aLo] == b[bLo]:
+            aLo += 1
+            bLo += 1
+        while aLo < aHi and bLo < bHi and a[aHi - 1] == b[bHi - 1]:
+            aHi -= 1
+            bHi -= 1
+        if aLo == aHi or bLo == bHi:
+            for i in range(aLo, aHi):
+                changedA[i] = 1
+            for j in range(bLo, bHi):
+                changedB[j] = 1
+            continue
+
+        ranges = None
+        if algorithm == 'patience':
+            ranges = patienceSplit(a, b, aLo, aHi, bLo, bHi)
+        elif algorithm == 'histogram':
+            ranges = histogramSplit(a, b, aLo, aHi, bLo, bHi)
+        if ranges is None:
+            x, y = middleSnake(a, b, aLo, aHi, bLo, bHi)
+            ranges = [(aLo, x, bLo, y), (x, aHi, y, bHi)]
+        stack.extend(ranges)
+
+def middleSnake(a, b, aLo, aHi, bLo, bHi):
+    ''' Find a point (x, y) on an optimal edit path of a[aLo:aHi] and
+        b[bLo:bHi] by running Myers forward and backward at the same time
+        till they meet, each half then needs at most half of the edits.
+        Ranges must not share first or last line and not be empty.
+    '''
+    n, m = aHi - aLo, bHi - bLo
+    delta = n - m
+    odd = delta & 1
+    maxD = (n + m + 1) // 2
+    offset = maxD + 1
+    maxCost = max(DIFF_MAX_COST, math.isqrt(n + m + 3))
+    # furthest x reached on diagonal k = x - y, forward from (aLo, bLo),
+    # backward from (aHi, bHi) counted in steps back from the end.
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(maxD + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[aLo + x] == b[bLo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            # backward diagonal of forward k is delta - k.
+            if odd and delta - d < k < delta + d and \
+                    x + backward[offset + delta - k] >= n:
+                return aLo + x, bLo + y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                        backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[aHi - 1 - x] == b[bHi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and \
+                    x + forward[offset + delta - k] >= n:
+                return aHi - x, bHi - y
+        # too many edits, give up the shortest script like xdiff does and
+        # split at the furthest point either search got to.
+        if d >= maxCost:
+            x, k = max((forward[offset + k] * 2 - k, k)
+                       for k in range(-d, d + 1, 2))
+            bx, bk = max((backward[offset + k] * 2 - k, k)
+                         for k in range(-d, d + 1, 2))
+            if x >= bx:
+                x = (x + k) // 2
+                return aLo + x, bLo + x - k
+            bx = (bx + bk) // 2
+            return aHi - bx, bHi - (bx - bk)
+    assert False, "Middle Snake Not Found."
+
+def patienceSplit(a, b, aLo, aHi, bLo, bHi):
+    ''' Match lines unique in both ranges, keep the longest subsequence in
+        order on both sides, return ranges between matched lines, or None
+        if no line is unique on both sides. '''
+    countA = collections.Counter(a[aLo:aHi])
+    countB = collections.Counter(b[bLo:bHi])
+    posA = {a[i]: i for i in range(aLo, aHi) if countA[a[i]] == 1}
+    # (i, j) of unique lines, in order of j.
+    pairs = [(posA[b[j]], j) for j in range(bLo, bHi)
+             if countB[b[j]] == 1 and b[j] in posA]
+    if not pairs:
+        return None
+
+    # longest increasing subsequence of i by patience sorting.
+    tails, tailPos, prev = [], [], [None] * len(pairs)
+    for pos, (i, _) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, i)
+        if pile == len(tails):
+            tails.append(i)
+            tailPos.append(pos)
+        else:
+            tails[pile] = i
+            tailPos[pile] = pos
+        prev[pos] = tailPos[pile - 1] if pile else None
+    anchors = []
+    pos = tailPos[-1]
+    while pos is not None:
+        anchors.append(pairs[pos])
+        pos = prev[pos]
+
+    # anchors are in reverse order, ranges go into a stack anyway.
+    ranges = []
+    endA, endB = aHi, bHi
+    for i, j in anchors:
+        ranges.append((i + 1, endA, j + 1, endB))
+        endA, endB = i, j
+    ranges.append((aLo, endA, bLo, endB))
+    return ranges
+
+def histogramSplit(a, b, aLo, aHi, bLo, bHi):
+    ''' Find the longest common region around the least frequent line of
+        a, return ranges before and after it, None if every common line
+        occurs more than HISTOGRAM_MAX_CHAIN times. '''
+    # line -> positions in a
+    positions = {}
+    for i in range(aLo, aHi):
+        positions.setdefault(a[i], []).append(i)
+    best = None
+    bestCount = HISTOGRAM_MAX_CHAIN + 1
+    j = bLo
+    while j < bHi:
+        occurs = positions.get(b[j])
+        nextJ = j + 1
+        if occurs is None or len(occurs) > bestCount:
+            j = nextJ
+            continue
+        for i in occurs:
+            # grow the match both ways.
+            startA, startB, endA, endB = i, j, i + 1, j + 1
+            while startA > aLo and startB > bLo and \
+                    a[startA - 1] == b[startB - 1]:
+                startA -= 1
+                startB -= 1
+            while endA < aHi and endB < bHi and a[endA] == b[endB]:
+                endA += 1
+                endB += 1
+            nextJ = max(nextJ, endB)
+            # region is ranked by its least frequent line.
+            count = min(len(positions[a[k]]) for k in range(startA, endA))
+            if best is None or count < bestCount or \
+                    endA - startA > best[1] - best[0]:
+                best = (startA, endA, startB, endB)
+                bestCount = count
+        j = nextJ
+    if best is None:
+        return None
+    startA, endA, startB, endB = best
+    return [(aLo, startA, bLo, startB), (endA, aHi, endB, bHi)]
+
+def diffChanges(changedA, changedB):
+    ''' Yield (aStart, aEnd, bStart, bEnd) of each group of changed lines
+        from change marks. '''
+    aLen, bLen = len(changedA), len(changedB)
+    i = j = 0
+    while i < aLen or j < bLen:
+        if (i < aLen and changedA[i]) or (j < bLen and changedB[j]):
+            aStart, bStart = i, j
+            while i < aLen and changedA[i]:
+                i += 1
+            while j < bLen and changedB[j]:
+                j += 1
+            yield aStart, i, bStart, j
+        else:
+            i += 1
+            j += 1
+
+def funcLine(aLines, start, cache):
+    ''' Hunk header context: closest line before start beginning with a
+        letter, '_' or '$', git's default. cache = [searched up to, line]
+        saves rescanning for later hunks. '''
+    for i in range(start - 1, cache[0] - 1, -1):
+        line = aLines[i]
+        if line[:1].isalpha() or line[:1] in (b'_', b'$'):
+            cache[1] = line[:80].rstrip()
+            break
+    cache[0] = max(cache[0], start)
+    return cache[1]
+
+def diffHunks(aLines, bLines, changedA, changedB, context = DIFF_CONTEXT):
+    ''' Yield unified diff hunks as bytes, one hunk per chunk. '''
+    changes = list(diffChanges(changedA, changedB))
+    cache = [0, b'']
+    k = 0
+    while k < len(changes):
+        # changes closer than two contexts share one hunk.
+        last = k
+        while last + 1 < len(changes) and \
+                changes[last + 1][0] - changes[last][1] <= 2 * context:
+            last += 1
+        aStart = max(changes[k][0] - context, 0)
+        bStart = max(changes[k][2] - context, 0)
+        aEnd = min(changes[last][1] + context, len(aLines))
+        bEnd = min(changes[last][3] + context, len(bLines))
+
+        def hunkRange(start, count):
+            if count == 1:
+                return b'%d' % (start + 1)
+            return b'%d,%d' % (start + 1 if count else start, count)
+        header = b'@@ -' + hunkRange(aStart, aEnd - aStart) + b' +' + \
+                 hunkRange(bStart, bEnd - bStart) + b' @@'
+        func = funcLine(aLines, aStart, cache)
+        lines = [header + (b' ' + func if func else b'') + b'\n']
+
+        i, j = aStart, bStart
+        while i < aEnd or j < bEnd:
+            if i < aEnd and changedA[i]:
+                lines.append(b'-' + aLines[i])
+                i += 1
+            elif j < bEnd and changedB[j]:
+                lines.append(b'+' + bLines[j])
+                j += 1
+            else:
+                lines.append(b' ' + aLines[i])
+                i += 1
+                j += 1
+            if not lines[-1].endswith(b'\n'):
+                lines[-1] += b'\n\\ No newline at end of file\n'
+        yield b''.join(lines)
+        k = last + 1
+
+def loadDiffSides(path, oldSha1, newMode, newSha1):
+    ''' Return (oldData, newData, newSha1) of a diff pair, reading the new
+        side from working tree when newSha1 is None and newMode is not. '''
+    oldData = readObject(oldSha1)[1] if oldSha1 else b''
+    if newSha1 is None and newMode is not None:
+        newData = readFile(workPath(path))
+        newSha1 = hashlib.sha1(b'blob %d\x00' % len(newData) +
+                               newData).hexdigest()
+    else:
+        newData = readObject(newSha1)[1] if newSha1 else b''
+    return oldData, newData, newSha1
+
+def diffFile(path, oldMode, oldSha1, newMode, newSha1, algorithm = 'myers'):
+    ''' Yield git style diff of one path as bytes chunks, modes as octal
+        strings, SHA-1 in hex, None on the side the path is missing. '''
+    header = ['diff --git a/{0} b/{0}'.format(path)]
+    if oldMode is None:
+        header.append('new file mode {:06o}'.format(int(newMode, 8)))
+    elif newMode is None:
+        header.append('deleted file mode {:06o}'.format(int(oldMode, 8)))
+    elif int(oldMode, 8) != int(newMode, 8):
+        header.append('old mode {:06o}'.format(int(oldMode, 8)))
+        header.append('new mode {:06o}'.format(int(newMode, 8)))
+    oldData, newData, newSha1 = loadDiffSides(path, oldSha1, newMode, newSha1)
+    if oldSha1 != newSha1:
+        sameMode = oldMode is not None and newMode is not None and \
+                   int(oldMode, 8) == int(newMode, 8)
+        header.append('index {}..{}{}'.format((oldSha1 or '0' * 40)[:7],
+                                              (newSha1 or '0' * 40)[:7],
+                      ' {:06o}'.format(int(newMode, 8)) if sameMode else ''))
+    fromFile = 'a/' + path if oldMode else '/dev/null'
+    toFile = 'b/' + path if newMode else '/dev/null'
+    if oldSha1 == newSha1:
+        pass
+    elif isBinary(oldData) or isBinary(newData):
+        header.append('Binary files {} and {} differ'.format(fromFile, toFile))
+    else:
+        header.append('--- ' + fromFile)
+        header.append('+++ ' + toFile)
+    yield ('\n'.join(header) + '\n').encode('utf-8', 'surrogateescape')
+    if oldSha1 == newSha1 or isBinary(oldData) or isBinary(newData):
+        return
+
+    aLines, bLines = splitLines(oldData), splitLines(newData)
+    changedA, changedB = diffLines(aLines, bLines, algorithm)
+    yield from diffHunks(aLines, bLines, changedA, changedB)
+
+def diffFileStat(path, oldMode, oldSha1, newMode, newSha1,
+                 algorithm = 'myers'):
+    ''' Return (path, insertions, deletions, binarySizes) of one path,
+        binarySizes is (oldSize, newSize) for binary files else None. No
+        hunk is built, only change marks are counted. '''
+    oldData, newData, newSha1 = loadDiffSides(path, oldSha1, newMode, newSha1)
+    if isBinary(oldData) or isBinary(newData):
+        return (path, 0, 0, (len(oldData), len(newData)))
+    if oldSha1 == newSha1:
+        return (path, 0, 0, None)
+    changedA, changedB = diffLines(splitLines(oldData), splitLines(newData),
+                                   algorithm)
+    return (path, changedB.count(1), changedA.count(1), None)
+
+def printDiffStat(stats, width = 80):
+    ''' Print stats of diffFileStat() like 'git diff --stat'. '''
+    if not stats:
+        return
+    counts = ['Bin' if sizes else str(add + delete)
+              for _, add, delete, sizes in stats]
+    nameWidth = max(len(path) for path, _, _, _ in stats)
+    numberWidth = max(len(count) for count in counts)
+    maxChange = max(add + delete for _, add, delete, _ in stats)
+    graphWidth = maxChange
+    # same as git: keep the line in width, shrink graph first, then name.
+    if nameWidth + numberWidth + 6 + graphWidth > width:
+        if graphWidth > width * 3 // 8 - numberWidth - 6:
+            graphWidth = max(width * 3 // 8 - numberWidth - 6, 6)
+        if nameWidth > width - numberWidth - 6 - graphWidth:
+            nameWidth = width - numberWidth - 6 - graphWidth
+        else:
+            graphWidth = width - numberWidth - 6 - nameWidth
+
+    def scale(count):
+        return 1 + (count * (graphWidth - 1)) // maxChange if count else 0
+
+    insertions = deletions = 0
+    for (path, add, delete, sizes), count in zip(stats, counts):
+        if len(path) > nameWidth:
+            path = '...' + path[len(path) - nameWidth + 3:]
+        if sizes:
+            print(' {} | Bin {} -> {} bytes'.format(path.ljust(nameWidth),
+                                                   *sizes))
+            continue
+        insertions += add
+        deletions += delete
+        if graphWidth < maxChange:
+            total = max(scale(add + delete), 2 if add and delete else 0)
+            if add < delete:
+                add = scale(add)
+                delete = total - add
+            else:
+                delete = scale(delete)
+                add = total - delete
+        print(' {} | {}{}'.format(path.ljust(nameWidth),
+                                  count.rjust(numberWidth),
+                                  (' ' + '+' * add + '-' * delete)
+                                  if add or delete else ''))
+    summary = ' {} file{} changed'.format(len(stats),
+                                          's' if len(stats) > 1 else '')
+    if insertions or not deletions:
+        summary += ', {} insertion{}(+)'.format(insertions,
+                                     's' if insertions != 1 else '')
+    if deletions or not insertions:
+        summary += ', {} deletion{}(-)'.format(deletions,
+                                     's' if deletions != 1 else '')
+    print(summary)
+
+def revisionTree(name):
+    ''' Return tree SHA-1 of a commit or tree revision. '''
+    sha1 = resolveRevision(name)
+    objType, data = readObject(sha1)
+    if objType == 'commit':
+        return parseCommit(data).tree
+    assert objType == 'tree', "Expect commit or tree, But Got {}.".\
+                                format(objType)
+    return sha1
+
+def diffTreeIndex(treeSha1, index):
+    ''' Compare a tree (hex SHA-1, None for nothing) with index, yield the
+        same tuples as diffTrees(). A directory whose cache tree node is
+        valid and has the same SHA-1 as the tree side is skipped unread.
+    '''
+    cacheTree = parseCacheTree(index.extensions.get(b'TREE'))
+    paths = index.paths()
+
+    def walk(treeSha1, lo, hi, prefix, node):
+        if node is not None and node.entryCount == hi - lo and \
+                node.sha1 is not None and node.sha1.hex() == treeSha1:
+            return
+        treeEntries = {name: (mode, sha1) for mode, name, sha1
+                       in (readTree(treeSha1) if treeSha1 else [])}
+        # name -> ('blob', position) or ('tree', lo, hi) of index side.
+        indexItems = collections.OrderedDict()
+        i = lo
+        while i < hi:
+            rest = paths[i][len(prefix):]
+            slash = rest.find('/')
+            if slash < 0:
+                indexItems[rest] = ('blob', i)
+                i += 1
+                continue
+            dirPrefix = prefix + rest[:slash + 1]
+            j = i + 1
+            while j < hi and paths[j].startswith(dirPrefix):
+                j += 1
+            indexItems[rest[:slash]] = ('tree', i, j)
+            i = j
+
+        def sortKey(name):
+            if name in indexItems:
+                return name + '/' if indexItems[name][0] == 'tree' else name
+            return name + '/' if isTreeMode(treeEntries[name][0]) else name
+
+        for name in sorted(indexItems.keys() | treeEntries.keys(),
+                           key = sortKey):
+            path = prefix + name
+            oldMode, oldSha1 = treeEntries.get(name, (None, None))
+            oldIsTree = oldMode is not None and isTreeMode(oldMode)
+            item = indexItems.get(name)
+            if oldMode is not None and not oldIsTree and \
+                    (item is None or item[0] == 'tree'):
+                yield (path, oldMode, oldSha1, None, None)
+            if item is None:
+                if oldIsTree:
+                    yield from diffTrees(oldSha1, None, path + '/')
+                continue
+            if item[0] == 'tree':
+                subNode = node.subtrees.get(name) if node else None
+                yield from walk(oldSha1 if oldIsTree else None, item[1],
+                                item[2], path + '/', subNode)
+                continue
+            entry = index[item[1]]
+            newMode = '{:o}'.format(treeMode(entry.mode))
+            newSha1 = entry.sha1.hex()
+            if oldIsTree:
+                yield from diffTrees(oldSha1, None, path + '/')
+                oldMode = oldSha1 = None
+            if (oldMode is None or int(oldMode, 8) != int(newMode, 8)) or \
+                    oldSha1 != newSha1:
+                yield (path, oldMode, oldSha1, newMode, newSha1)
+
+    yield from walk(treeSha1, 0, len(index), '', cacheTree)
 
 def findObject(hashCode):
-    """ Find object with given SHA-1 prefix and return path to object. Or
-        exit if there are no one or more than one object with this prefix.
+    """ Find object with given SHA-1 prefix, loose or packed, and return its
+        full SHA-1. Or exit if there are no one or more than one object
+        with this prefix.
     """
     if len(hashCode) < 7:
         errMsg("Hash Prefix Must Longer than 7 Characters.")
-    objDir = os.path.join(baseName, 'objects', hashCode[:2])
-    restHashCode = hashCode[2:]
-    try:
-        objs = [name for name in os.listdir(objDir)
-                                    if name.startswith(restHashCode)]
-    except FileNotFoundError:
-        errMsg("File Not Found.")
-
+    hashCode = hashCode.lower()
+    objs = matchObjects(hashCode)
     if not objs:
         # "Object '0fe2738082e4f75c9c6bf154af70c12d9b55af' Not Found."
-        print("Object {!r} Not Found.".format(hashCode))
-        sys.exit(1)
-    if len(objs) > 2:
-        print("There Are [{}] Objects with HashCode {!r}.".format( len(objs), hashCode))
-    # .git/objects/48/0fe2738082e4f75c9c6bf154af70c12d9b55af
-    return os.path.join(objDir, objs[0])
+        errMsg("Object {!r} Not Found.".format(hashCode))
+    if len(objs) > 1:
+        errMsg("There Are [{}] Objects with HashCode {!r}:\n{}".format(
+                len(objs), hashCode,
+                '\n'.join('    ' + sha1 for sha1 in objs)))
+    # 480fe2738082e4f75c9c6bf154af70c12d9b55af
+    return objs[0]
+
+def matchObjects(hashCode):
+    ''' Return sorted full hex SHA-1 of objects starting with lower case
+        hex hashCode, loose or packed. '''
+    # full SHA-1 needs no prefix search, one stat or one pack lookup.
+    if len(hashCode) == 40:
+        return [hashCode] if hasObject(hashCode) else []
+    objs = repoState().looseObjectIndex.findPrefix(hashCode)
+    for pack in getPacks():
+        objs.extend(pack.findPrefix(hashCode))
+    # the same object may be both loose and packed.
+    return sorted(set(objs))
+
+def hasObject(sha1):
+    ''' Check if object of full hex SHA-1 exists, loose or packed. '''
+    if os.path.exists(gitPath('objects', sha1[:2], sha1[2:])):
+        return True
+    binSha1 = bytes.fromhex(sha1)
+    return any(pack.findSha1(binSha1) is not None for pack in getPacks())
+
+class LooseObjectIndex:
+    ''' Sorted names of loose objects, split by first byte into a 256 entry
+        fanout of objects/xx directories. Each bucket is listed once and
+        listed again only when its directory mtime changes.
+    '''
+    def __init__(self):
+        # 'xx' -> (dir mtime, sorted list of the rest 38 hex digits)
+        self.fanout = {}
+
+    def bucket(self, prefix):
+        objDir = gitPath('objects', prefix)
+        try:
+            mtime = os.stat(objDir).st_mtime_ns
+        except FileNotFoundError:
+            self.fanout.pop(prefix, None)
+            return []
+        cached = self.fanout.get(prefix)
+        if cached is None or cached[0] != mtime:
+            names = sorted(name for name in os.listdir(objDir)
+                           if len(name) == 38)
+            cached = (mtime, names)
+            self.fanout[prefix] = cached
+        return cached[1]
+
+    def findPrefix(self, hashCode):
+        ''' Return full hex SHA-1 of loose objects starting with hashCode. '''
+        names = self.bucket(hashCode[:2])
+        rest = hashCode[2:]
+        found = []
+        i = bisect.bisect_left(names, rest)
+        while i < len(names) and names[i].startswith(rest):
+            found.append(hashCode[:2] + names[i])
+            i += 1
+        return found
 
 def readObject(hashCode, printRaw = False):
-    ''' Read object with given SHA1 hashcode.
-        Return: tuple of (type, data), or ValueError if not found.
+    ''' Read object with given SHA1 hashcode, from loose object file or
+        from a pack. Return: tuple of (type, data), or ValueError if not found.
     '''
-    path = findObject(hashCode)
+    if len(hashCode) == 40:
+        sha1 = hashCode.lower()
+    else:
+        with tracePhase('object-lookup'):
+            sha1 = findObject(hashCode)
+    objectCache = repoState().objectCache
+    cached = objectCache.get(sha1)
+    if cached is None:
+        if trace:
+            trace.count('objectsRead')
+        with tracePhase('object-read'):
+            cached = readUncachedObject(sha1)
+        objectCache.put(sha1, cached)
+    if printRaw:
+        print("{} {}".format(cached[0], len(cached[1])).encode('utf-8') +
+              b'\x00' + cached[1])
+    return cached
+
+def readUncachedObject(sha1):
+    ''' Worker of readObject(), read and inflate object of full SHA-1. '''
+    # .git/objects/48/0fe2738082e4f75c9c6bf154af70c12d9b55af
+    path = gitPath('objects', sha1[:2], sha1[2:])
+    try:
+        compressed = readFile(path)
+    except FileNotFoundError:
+        try:
+            return readPackedObject(sha1)
+        except ValueError:
+            # report missing object the same way as findObject().
+            findObject(sha1)
+            raise
+
     # Notice, the object file was Zlib compressed.
     ''' fullData =  b'tree 114\x00100664 main.cpp\x00\xd8\xc1\xa2&i{:\x12\xf9%
         \x85\x03\x13\xe3{\x91\xe6"\xe4\xce100775 indexcat.py\x00\xd6\x8e
         \x19\x16S\xc2\xd2\x98\xe0\xdd\xfcW\xda\xeb=\xbdO\xa7\x8e\xf0100775
         fkgit.py\x001\x03\x99\xe2Uh\xed4\x0f[\xba\xc6\x0f\xa3GU\xeb\x12\x85i'
     '''
-    fullData = zlib.decompress(readFile(path))
-    if printRaw:
-        print(fullData)
+    with tracePhase('zlib-decompress'):
+        fullData = zlib.decompress(compressed)
+    if trace:
+        trace.count('bytesInflated', len(fullData))
 
     # find the first occurance of b'\x00', take index as 8
     try:
@@ -144,8 +1084,13 @@ def readObject(hashCode, printRaw = False):
 def readTree(hashCode = None, data = None):
     ''' Read Tree object and return list of (mode, path, sha1) tuples. '''
     if hashCode is not None:
+        if len(hashCode) != 40:
+            hashCode = findObject(hashCode)
+        cached = repoState().treeCache.get(hashCode)
+        if cached is not None:
+            return list(cached)
         objType, data = readObject(hashCode)
-        assert objType == 'true'
+        assert objType == 'tree', "Expect tree, But Got {}.".format(objType)
     elif data is None:
         print("You Should Specify 'sha1' or 'data'")
     ''' data =  b'100664 main.cpp\x00\xd8\xc1\xa2&i{:\x12\xf9%\x85\x03\x13
@@ -164,15 +1109,67 @@ def readTree(hashCode = None, data = None):
         except ValueError:
             break
         # ['100664', 'main.cpp']
-        mode, path = data[start:index].decode('utf-8').split()
+        mode, path = data[start:index].decode('utf-8').split(' ', 1)
         sha1 = data[index + 1:index + 21]
         # pack three elements as a tuple.
         # ('100664', 'main.cpp', 'd8c1a226697b3a12f925850313e37b91e622e4ce')
         mixTuple = (mode, path, binascii.hexlify(sha1).decode('utf-8'))
         entries.append(mixTuple)
         start = index + 21
+    if hashCode is not None:
+        repoState().treeCache.put(hashCode, tuple(entries))
     return entries
 
+def isTreeMode(mode):
+    ''' Check tree entry mode string, '40000' for sub directories. '''
+    return stat.S_ISDIR(int(mode, 8))
+
+def diffTrees(oldTree, newTree, prefix = ''):
+    ''' Compare two trees (hex SHA-1, None for nothing), yield (path,
+        oldMode, oldSha1, newMode, newSha1) of every blob that differs, in
+        path order, mode and SHA-1 None on the side the path is missing.
+        Sub trees with the same SHA-1 on both sides are skipped unread, so
+        the cost follows the number of changes, not the size of the trees.
+    '''
+    if oldTree == newTree:
+        return
+    oldEntries = {path: (mode, sha1) for mode, path, sha1
+                  in (readTree(oldTree) if oldTree else [])}
+    newEntries = {path: (mode, sha1) for mode, path, sha1
+                  in (readTree(newTree) if newTree else [])}
+    # git tree order, directory 'a' sorts as 'a/'.
+    def sortKey(name):
+        mode = (oldEntries.get(name) or newEntries.get(name))[0]
+        return name + '/' if isTreeMode(mode) else name
+    for name in sorted(oldEntries.keys() | newEntries.keys(), key = sortKey):
+        oldMode, oldSha1 = oldEntries.get(name, (None, None))
+        newMode, newSha1 = newEntries.get(name, (None, None))
+        if (oldMode, oldSha1) == (newMode, newSha1):
+            continue
+        path = prefix + name
+        oldIsTree = oldMode is not None and isTreeMode(oldMode)
+        newIsTree = newMode is not None and isTreeMode(newMode)
+        if oldIsTree or newIsTree:
+            # a blob replaced by a tree (or back) is a delete plus an add.
+            if oldMode is not None and not oldIsTree:
+                yield (path, oldMode, oldSha1, None, None)
+            yield from diffTrees(oldSha1 if oldIsTree else None,
+                                 newSha1 if newIsTree else None, path + '/')
+            if newMode is not None and not newIsTree:
+                yield (path, None, None, newMode, newSha1)
+            continue
+        yield (path, oldMode, oldSha1, newMode, newSha1)
+
+def treeEntryAt(treeSha1, path):
+    ''' Return (mode, sha1) of path inside tree, None if it is not there. '''
+    entry = ('40000', treeSha1)
+    for name in path.strip('/').split('/'):
+        if entry is None or not isTreeMode(entry[0]):
+            return None
+        entry = next(((mode, sha1) for mode, childName, sha1
+                      in readTree(entry[1]) if childName == name), None)
+    return entry
+
 def catFile(mode, hashCode):
     ''' Upper function of cat-file call. '''
     ''' git cat-file -p 19b5340d1316fc3f19b4d87f558ad2bd082d80fd
@@ -214,29 +1211,190 @@ def catFile(mode, hashCode):
                 # {:06} => 016384, {:06o} => 040000
                 print("{:06o} {} {}\t{}".format(modInt, type, sha1, path))
 
+def resolveBatchName(name):
+    ''' Return (full SHA-1, None) of an object name of 'cat-file --batch',
+        or (None, 'missing' or 'ambiguous'), never exits. '''
+    if re.fullmatch('[0-9a-fA-F]{4,40}', name):
+        with tracePhase('object-lookup'):
+            objs = matchObjects(name.lower())
+        if len(objs) > 1:
+            return (None, 'ambiguous')
+        if objs:
+            return (objs[0], None)
+    # HEAD or a ref name, readRef() never reads other files under .git.
+    sha1 = readRef(name)
+    if sha1 and hasObject(sha1):
+        return (sha1, None)
+    return (None, 'missing')
+
+def catFileBatch(contents = True, buffered = False, inFile = None,
+                 outFile = None):
+    ''' 'cat-file --batch' (contents) and '--batch-check': read one object
+        name per line, write a '<sha1> <type> <size>' line, with contents
+        also the data and a newline, or '<name> missing' if not found. One
+        process serves every line, so objects, trees and pack indexes stay
+        cached between them. Output is flushed after each object, for a
+        reader waiting on it, unless buffered.
+    '''
+    inFile = inFile or sys.stdin.buffer
+    outFile = outFile or sys.stdout.buffer
+    for line in inFile:
+        name = line.rstrip(b'\n').decode('utf-8', 'surrogateescape')
+        sha1, error = resolveBatchName(name)
+        if sha1 is None:
+            outFile.write('{} {}\n'.format(name, error).encode('utf-8',
+                                                          'surrogateescape'))
+        elif contents:
+            objType, data = readObject(sha1)
+            outFile.write('{} {} {}\n'.format(sha1, objType,
+                                              len(data)).encode('utf-8'))
+            outFile.write(data)
+            outFile.write(b'\n')
+        else:
+            objType, size = readObjectHeader(sha1)
+            outFile.write('{} {} {}\n'.format(sha1, objType,
+                                              size).encode('utf-8'))
+        if not buffered:
+            outFile.flush()
+    outFile.flush()
+
 def getLocalMasterHash():
     ''' Get SHA-1 of the latest commit of local master branch. '''
     # '.fkgit/refs/heads/master'
-    masterPath = os.path.join(baseName, 'refs', 'heads', 'master')
+    masterPath = gitPath('refs', 'heads', 'master')
     try:
         return readFile(masterPath).decode('utf-8').strip()
     except FileNotFoundError:
         return None
 
+''' Cache tree (TREE index extension), one node per directory, preorder.
+      | Path component\0 | Entry count(ASCII) | ' ' | Subtree count(ASCII) |
+      | '\n' | SHA-1 of the tree, only if entry count is not -1 |
+    Entry count is the number of index entries under this directory, -1 if
+    the node was invalidated and its tree must be hashed again.
+'''
+class CacheTree:
+    ''' Node of the cache tree: tree SHA-1 of one directory of the index. '''
+    def __init__(self, entryCount = -1, sha1 = None):
+        self.entryCount = entryCount
+        self.sha1 = sha1
+        # 'dirName' -> CacheTree of the sub directory.
+        self.subtrees = collections.OrderedDict()
+
+    def invalidate(self, path):
+        ''' Mark every directory from root down to path's parent dirty. '''
+        node = self
+        for name in path.split('/')[:-1]:
+            node.entryCount = -1
+            node.sha1 = None
+            node = node.subtrees.get(name)
+            if node is None:
+                return
+        node.entryCount = -1
+        node.sha1 = None
+
+    def encode(self, name = b''):
+        ''' Return TREE extension data of this node and its subtrees. '''
+        data = name + b'\x00' + '{} {}\n'.format(
+                self.entryCount, len(self.subtrees)).encode('ascii')
+        if self.entryCount >= 0:
+            data += self.sha1
+        for subName, subtree in self.subtrees.items():
+            data += subtree.encode(subName.encode('utf-8'))
+        return data
+
+def parseCacheTree(data):
+    ''' Parse TREE extension data into the root CacheTree. '''
+    if not data:
+        return CacheTree()
+
+    def parseNode(pos):
+        ''' Return (name, CacheTree, next pos) of the node at pos. '''
+        nameEnd = data.index(b'\x00', pos)
+        lineEnd = data.index(b'\n', nameEnd)
+        entryCount, subCount = map(int, data[nameEnd + 1:lineEnd].split())
+        node = CacheTree(entryCount)
+        next = lineEnd + 1
+        if entryCount >= 0:
+            node.sha1 = data[next:next + 20]
+            next += 20
+        for _ in range(subCount):
+            subName, subtree, next = parseNode(next)
+            node.subtrees[subName] = subtree
+        return (data[pos:nameEnd].decode('utf-8'), node, next)
+
+    return parseNode(0)[1]
+
+def treeMode(mode):
+    ''' Normalize a stat mode the way git stores it in index and trees:
+        100644, 100755, 120000 (symbolic link) or 160000 (gitlink). '''
+    if stat.S_ISLNK(mode):
+        return 0o120000
+    if stat.S_IFMT(mode) == 0o160000 or stat.S_ISDIR(mode):
+        return 0o160000
+    return 0o100755 if mode & 0o100 else 0o100644
+
+@indexLocked
 def writeTree():
-    ''' Write a tree object from the current index file. '''
-    for entry in readIndex():
-        # entry.mode = 33277, {:o} o => octal
-        # '{:o} {}'.format(entry.mode, entry.path) => '100775 demo.py'
-        modePath = '{:o} {}'.format(entry.mode, entry.path).encode('utf-8')
-        treeEntry = modePath + b'\x00' + entry.sha1
-        treeEntries.append(treeEntry)
-    print("treeEntries = ", treeEntries)
-    # Example: b'.'.join([b'ab', b'pq', b'rs']) -> b'ab.pq.rs'.
-    return(hashObject(b''.join(treeEntries), 'tree', True))
+    ''' Write nested tree objects from the current index file, return SHA-1
+        of the root tree. Directories whose cache tree node is still valid
+        are not hashed again; the refreshed cache tree is stored in index.
+    '''
+    index = readIndex()
+    cacheTree = parseCacheTree(index.extensions.get(b'TREE'))
+    oldTreeData = cacheTree.encode()
+    paths = index.paths()
 
-def commit(message):
-    ''' Commit, using the index file and given message,
+    def buildTree(lo, hi, prefixLen, node):
+        ''' Write tree of index entries [lo, hi), all under the same
+            directory whose path is prefixLen long. '''
+        if node.entryCount == hi - lo and node.sha1 is not None:
+            return node.sha1.hex()
+        treeEntries = []
+        subtrees = collections.OrderedDict()
+        i = lo
+        while i < hi:
+            rest = paths[i][prefixLen:]
+            slash = rest.find('/')
+            if slash < 0:
+                entry = index[i]
+                # entry.mode = 33188, {:o} o => octal
+                # '{:o} {}'.format(mode, 'demo.py') => '100644 demo.py'
+                modePath = '{:o} {}'.format(treeMode(entry.mode), rest)
+                treeEntries.append(modePath.encode('utf-8') + b'\x00' +
+                                   entry.sha1)
+                i += 1
+                continue
+            # index is sorted, entries of one sub directory are adjacent.
+            name = rest[:slash]
+            dirPrefix = paths[i][:prefixLen + slash + 1]
+            j = i + 1
+            while j < hi and paths[j].startswith(dirPrefix):
+                j += 1
+            subtree = node.subtrees.get(name) or CacheTree()
+            subSha1 = buildTree(i, j, len(dirPrefix), subtree)
+            subtrees[name] = subtree
+            treeEntries.append('40000 {}'.format(name).encode('utf-8') +
+                               b'\x00' + bytes.fromhex(subSha1))
+            i = j
+        node.subtrees = subtrees
+        # Example: b'.'.join([b'ab', b'pq', b'rs']) -> b'ab.pq.rs'.
+        sha1 = hashObject(b''.join(treeEntries), 'tree', True)
+        node.entryCount = hi - lo
+        node.sha1 = bytes.fromhex(sha1)
+        return sha1
+
+    sha1 = buildTree(0, len(index), 0, cacheTree)
+    treeData = cacheTree.encode()
+    if treeData != oldTreeData:
+        extensions = dict(index.extensions)
+        extensions[b'TREE'] = treeData
+        writeIndex(index, index.version, extensions)
+    return sha1
+
+def commit(message, out = None):
+    ''' Commit, using the index file and given message, the summary line
+        is printed to out (stdout by default).
         return: sha1 of commit object. '''
     treeHash = writeTree()
     parent = getLocalMasterHash()
@@ -250,9 +1408,12 @@ def commit(message):
     except KeyError:
         author = '{} <{}>'.format(author, email)
 
-    # format author time.
-    timeStamp = int(time.mktime(time.localtime()))
-    authorTime = '1505732862 -0500'
+    # format author time, '1505732862 -0500'.
+    timeStamp = int(time.time())
+    tzOffset = time.localtime(timeStamp).tm_gmtoff // 60
+    authorTime = '{} {}{:02d}{:02d}'.format(timeStamp,
+            '-' if tzOffset < 0 else '+', abs(tzOffset) // 60,
+            abs(tzOffset) % 60)
 
     # standard git commit, The first commit, has no parent.
     ''' > git cat-file -p 13bf599
@@ -289,118 +1450,1720 @@ def commit(message):
 
     data = '\n'.join(commitInfo).encode('utf-8')
     sha1 = hashObject(data, 'commit', True)
-    masterPath = os.path.join(baseName, 'refs', 'heads', 'master')
+    masterPath = gitPath('refs', 'heads', 'master')
     writeFile(masterPath, (sha1 + '\n').encode('utf-8'))
     # [master df34f29] second commit
-    print("[master {}] {}".format(sha1, message))
+    print("[master {}] {}".format(sha1, message), file = out or sys.stdout)
+    updateCommitGraph(sha1)
     return sha1
 
-def readIndex():
-    ''' Read index file, return list of IndexEntry object. '''
+# Commit object parsed, parents and times without header lines.
+Commit = collections.namedtuple('Commit', [
+    'tree', 'parents', 'author', 'committer', 'time', 'message'])
+
+def parseCommit(data):
+    ''' Parse commit object data into Commit. '''
+    header, _, message = data.decode('utf-8', 'replace').partition('\n\n')
+    tree = None
+    parents = []
+    author = committer = ''
+    for line in header.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            tree = value
+        elif key == 'parent':
+            parents.append(value)
+        elif key == 'author':
+            author = value
+        elif key == 'committer':
+            committer = value
+    # 'corsair <xiangp126@126.com> 1505724533 -0400' => 1505724533
+    commitTime = int(committer.rsplit(' ', 2)[-2]) if committer else 0
+    return Commit(tree, parents, author, committer, commitTime, message)
+
+def readCommit(hashCode):
+    ''' Read and parse commit object. '''
+    objType, data = readObject(hashCode)
+    assert objType == 'commit', "Expect commit, But Got {}.".format(objType)
+    return parseCommit(data)
+
+def listRefs():
+    ''' Return {refName: sha1} of all branches, 'refs/heads/master'... '''
+    refs = {}
+    headsDir = gitPath('refs', 'heads')
+    for root, dirs, files in os.walk(headsDir):
+        for name in files:
+            path = os.path.join(root, name)
+            refName = os.path.relpath(path, gitPath()).replace(os.sep, '/')
+            refs[refName] = readFile(path).decode('utf-8').strip()
+    return refs
+
+def resolveRevision(name):
+    ''' Resolve 'HEAD', a branch name or a SHA-1 prefix to full SHA-1. '''
+    return readRef(name) or findObject(name)
+
+def checkRefName(name):
+    ''' True if name is a valid ref name by git's rules (check-ref-format):
+        no component starting with '.' or ending with '.lock', no '..',
+        '@{', '//', control characters or any of ' ~^:?*[\\', does not
+        start or end with '/' and does not end with '.'. '''
+    if not name or name == '@' or name.startswith('/') or \
+            name.endswith(('/', '.', '.lock')):
+        return False
+    if '..' in name or '@{' in name or '//' in name:
+        return False
+    if re.search(r'[\x00-\x20\x7f~^:?*\[\\]', name):
+        return False
+    return not any(part.startswith('.') or part.endswith('.lock')
+                   for part in name.split('/'))
+
+def readRef(name):
+    ''' Return SHA-1 'HEAD', 'refs/...' or a branch name points to, None
+        if no such ref, the branch has no commit yet, or name is not a valid
+        ref name: nothing else under .git is ever read. '''
+    try:
+        if name == 'HEAD':
+            head = readFile(gitPath('HEAD')).decode('utf-8')
+            if not head.startswith('ref: '):
+                head = head.strip()
+                return head if re.fullmatch('[0-9a-f]{40}', head) else None
+            name = head[len('ref: '):].strip()
+            if not name.startswith('refs/'):
+                return None
+        if not checkRefName(name):
+            return None
+        refNames = [name] if name.startswith('refs/') else []
+        refNames.append('refs/heads/' + name)
+        for refName in refNames:
+            try:
+                sha1 = readFile(gitPath(refName)).\
+                        decode('utf-8').strip()
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                continue
+            return sha1 if re.fullmatch('[0-9a-f]{40}', sha1) else None
+    except (OSError, UnicodeDecodeError):
+        pass
+    return None
+
+''' Commit graph (.git/objects/info/commit-graph), same format as git.
+      | CGPH | Version 1 | Hash Version 1 | Chunk count | Base graphs 0 |
+      | Chunk lookup: (4 byte id, 8 byte offset) per chunk + terminator |
+      | OIDF: fanout 256 * 4 | OIDL: sorted commit SHA-1, count * 20    |
+      | CDAT per commit: tree SHA-1, parent 1 pos, parent 2 pos,         |
+      |   generation << 2 | time >> 32, time & 0xffffffff                |
+      | EDGE: more parent positions of octopus merges, last one | 1<<31  |
+      | Checksum                                                        |
+    Written by 'fkgit commit-graph' and 'fkgit repack', and by commit when
+    there is none yet or GRAPH_MAX_MISSING commits are not in it: writing
+    walks all history, so commits made since the last write are parsed
+    from their objects till then.
+'''
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+# Commit info of the graph walks, generation is GENERATION_INFINITY for
+# commits which are not in the commit graph yet.
+CommitNode = collections.namedtuple('CommitNode', [
+    'sha1', 'tree', 'parents', 'generation', 'time'])
+GENERATION_INFINITY = 0xffffffff
+
+class CommitGraph:
+    ''' Memory-mapped commit-graph file, commits looked up by position. '''
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        sigh, ver, hashVer, chunkCnt = struct.unpack_from('>4sBBB',
+                                                          self.data, 0)
+        assert sigh == b'CGPH' and ver == 1 and hashVer == 1, \
+                "Error, Unsupported Commit Graph {}".format(path)
+        self.chunks = {}
+        for i in range(chunkCnt):
+            chunkId, offset = struct.unpack_from('>4sQ', self.data, 8 + 12 * i)
+            self.chunks[chunkId] = offset
+        self.fanout = struct.unpack_from('>256L', self.data,
+                                         self.chunks[b'OIDF'])
+        self.count = self.fanout[255]
+        self.oidStart = self.chunks[b'OIDL']
+        self.dataStart = self.chunks[b'CDAT']
+        self.edgeStart = self.chunks.get(b'EDGE')
+        self.bloomIdxStart = self.chunks.get(b'BIDX')
+        self.bloomDataStart = self.chunks.get(b'BDAT')
+        if self.bloomDataStart is not None:
+            bloomSettings = struct.unpack_from('>LLL', self.data,
+                                               self.bloomDataStart)
+            # only filters written with our settings can be queried.
+            if bloomSettings != (1, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY):
+                self.bloomIdxStart = self.bloomDataStart = None
+
+    def sha1At(self, pos):
+        start = self.oidStart + 20 * pos
+        return self.data[start:start + 20]
+
+    def find(self, sha1):
+        ''' Return position of binary sha1, or None. '''
+        lo = self.fanout[sha1[0] - 1] if sha1[0] else 0
+        hi = self.fanout[sha1[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midSha1 = self.sha1At(mid)
+            if midSha1 < sha1:
+                lo = mid + 1
+            elif midSha1 > sha1:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def commitAt(self, pos):
+        ''' Return (tree, parent positions, generation, time) of pos. '''
+        start = self.dataStart + 36 * pos
+        tree = self.data[start:start + 20]
+        parent1, parent2, genTime, timeLow = struct.unpack_from(
+                '>LLLL', self.data, start + 20)
+        parents = []
+        if parent1 != GRAPH_PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & GRAPH_EXTRA_EDGES:
+            edge = self.edgeStart + 4 * (parent2 & ~GRAPH_EXTRA_EDGES)
+            while True:
+                parent, = struct.unpack_from('>L', self.data, edge)
+                parents.append(parent & ~GRAPH_LAST_EDGE)
+                if parent & GRAPH_LAST_EDGE:
+                    break
+                edge += 4
+        elif parent2 != GRAPH_PARENT_NONE:
+            parents.append(parent2)
+        commitTime = ((genTime & 0b11) << 32) | timeLow
+        return (tree, parents, genTime >> 2, commitTime)
+
+    def bloomFilterAt(self, pos):
+        ''' Return changed-path Bloom filter of pos, None if not written. '''
+        if self.bloomIdxStart is None:
+            return None
+        end, = struct.unpack_from('>L', self.data, self.bloomIdxStart + 4 * pos)
+        start = 0
+        if pos:
+            start, = struct.unpack_from('>L', self.data,
+                                        self.bloomIdxStart + 4 * pos - 4)
+        # data of filters starts after the 12 byte header of BDAT.
+        dataStart = self.bloomDataStart + 12
+        return self.data[dataStart + start:dataStart + end]
+
+def getCommitGraph():
+    ''' Return CommitGraph of the repository, or None if not written. '''
+    path = gitPath('objects', 'info', 'commit-graph')
     try:
-         data = readFile(os.path.join(baseName, 'index'))
+        mtime = os.stat(path).st_mtime_ns
     except FileNotFoundError:
-        return []
+        return None
+    commitGraphCache = repoState().commitGraphCache
+    if commitGraphCache['mtime'] != mtime:
+        commitGraphCache['graph'] = CommitGraph(path)
+        commitGraphCache['mtime'] = mtime
+    return commitGraphCache['graph']
 
-    # calculate checksum leaving the last 20 bytes(checksum itself).
-    # data[0:20], left included, right not.
-    checkSum = hashlib.sha1(data[0:-20]).digest()
-    assert checkSum == data[-20:], "Error, Invalid Index CheckSum."
-    sigh, ver, fileCnt = struct.unpack('!4sLL', data[0:12])
-    assert sigh == b'DIRC', \
-            'Error, Invalid Index Signature {}'.format(sigh)
-    assert ver == 2, 'Error, Unknown Index Version {}'.format(ver)
-
-    # omit header and checksum part.
-    allEntryPart = data[12:-20]
-    entries = []
-    # per entry data length.
-    entryDataLen = 62
+def getCommitNode(sha1):
+    ''' Return CommitNode of hex sha1, from the commit graph if it is there
+        (nothing inflated), or parsed from the commit object otherwise.
+    '''
+    commitNodes = repoState().commitNodes
+    node = commitNodes.get(sha1)
+    if node is not None:
+        return node
+    graph = getCommitGraph()
+    pos = graph.find(bytes.fromhex(sha1)) if graph is not None else None
+    if pos is not None:
+        tree, parentPos, generation, commitTime = graph.commitAt(pos)
+        parents = tuple(graph.sha1At(i).hex() for i in parentPos)
+        node = CommitNode(sha1, tree.hex(), parents, generation, commitTime)
+    else:
+        commit = readCommit(sha1)
+        node = CommitNode(sha1, commit.tree, tuple(commit.parents),
+                          GENERATION_INFINITY, commit.time)
+    commitNodes[sha1] = node
+    return node
 
-    i = 0
-    while i + entryDataLen < len(allEntryPart):
-        # not included, as j in [i:j]
-        fieldEnd = i + entryDataLen
-        ''' fields = (1505637351, 0, 1505637351, 0, 16777220, 35245842,
-                    33188, 502, 20, 83,
-             b'\x0c\x02Q\xe0\x9eya\xf9\x92s\xa5\xa8\xe9S\xf6Q\xeb_=Y', 8)
-        '''
-        fields = struct.unpack('>LLLLLLLLLL20sH', allEntryPart[i:fieldEnd])
-        # parse path name, multiple b'\x00' terminatered.
-        pathLen = fields[-1]
-        entryLen = (((entryDataLen + pathLen) // 8) + 1) * 8
-        path = allEntryPart[fieldEnd:fieldEnd + pathLen]
-        # (path.decode('utf-8'),) convert str to tuple.
-        ''' fields + (path.decode('utf-8'),) =
-                (1505637351, 0, 1505637351, 0, 16777220, 35245842, 33188,
-                 502, 20, 83,
-                 b'\x0c\x02Q\xe0\x9eya\xf9\x92s\xa5\xa8\xe9S\xf6Q\xeb_=Y',
-                 8, 'main.cpp')
-        '''
-        ''' IndexEntry(*(fields + (path.decode(),))) =
-            IndexEntry(ctime_s=1505637351, ctime_n=0, mtime_s=1505637351,
+''' Changed-path Bloom filter of a commit, git BIDX/BDAT chunks.
+    Every path changed against the first parent, and every leading
+    directory of it, is added with 7 hashes h0 + i * h1 (murmur3 with two
+    seeds) into 10 bits per path. A commit changing more than 512 paths
+    gets the 1 byte all-set filter, which says 'maybe' to everything.
+'''
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGES = 512
+BLOOM_SEED0 = 0x293ae76f
+BLOOM_SEED1 = 0x7e646e2c
+
+def murmur3(seed, data):
+    ''' 32 bit murmur3 as git bloom filter version 1, which reads bytes as
+        signed char, so bytes >= 0x80 are sign extended. '''
+    def rotl(value, count):
+        return ((value << count) | (value >> (32 - count))) & 0xffffffff
+    def signed(byte):
+        return byte | 0xffffff00 if byte & 0x80 else byte
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    h = seed
+    len4 = len(data) // 4
+    for i in range(len4):
+        k = (signed(data[4 * i]) | (signed(data[4 * i + 1]) << 8) |
+             (signed(data[4 * i + 2]) << 16) |
+             (signed(data[4 * i + 3]) << 24)) & 0xffffffff
+        k = (k * c1) & 0xffffffff
+        k = rotl(k, 15)
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = rotl(h, 13)
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+    tail = data[4 * len4:]
+    k = 0
+    if len(tail) >= 3:
+        k ^= (signed(tail[2]) << 16) & 0xffffffff
+    if len(tail) >= 2:
+        k ^= (signed(tail[1]) << 8) & 0xffffffff
+    if len(tail) >= 1:
+        k ^= signed(tail[0])
+        k = (k * c1) & 0xffffffff
+        k = rotl(k, 15)
+        k = (k * c2) & 0xffffffff
+        h ^= k
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+def bloomKey(path):
+    ''' Return the 7 hashes of path, same for every filter. '''
+    data = path.encode('utf-8')
+    hash0 = murmur3(BLOOM_SEED0, data)
+    hash1 = murmur3(BLOOM_SEED1, data)
+    return [(hash0 + i * hash1) & 0xffffffff for i in range(BLOOM_NUM_HASHES)]
+
+def bloomPathKeys(path):
+    ''' Keys of path and its leading directories, 'a/b/c', 'a/b', 'a'. '''
+    parts = path.strip('/').split('/')
+    return [bloomKey('/'.join(parts[:i])) for i in range(len(parts), 0, -1)]
+
+def bloomMaybeContains(bloomFilter, keys):
+    ''' False if no key can be in the filter, True if all maybe are. '''
+    bits = len(bloomFilter) * 8
+    for key in keys:
+        for hashVal in key:
+            pos = hashVal % bits
+            if not bloomFilter[pos // 8] & (1 << (pos % 8)):
+                return False
+    return True
+
+def computeBloomFilter(node):
+    ''' Build changed-path Bloom filter of CommitNode against first parent. '''
+    parentTree = getCommitNode(node.parents[0]).tree if node.parents else None
+    paths = set()
+    for path, _, _, _, _ in diffTrees(parentTree, node.tree):
+        parts = path.split('/')
+        for i in range(len(parts), 0, -1):
+            paths.add('/'.join(parts[:i]))
+        if len(paths) > BLOOM_MAX_CHANGES:
+            return b'\xff'
+    if not paths:
+        return b'\x00'
+    bloomFilter = bytearray((len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    bits = len(bloomFilter) * 8
+    for path in paths:
+        for hashVal in bloomKey(path):
+            pos = hashVal % bits
+            bloomFilter[pos // 8] |= 1 << (pos % 8)
+    return bytes(bloomFilter)
+
+def getBloomFilter(sha1):
+    ''' Return Bloom filter of commit from the commit graph, or None. '''
+    graph = getCommitGraph()
+    if graph is None:
+        return None
+    pos = graph.find(bytes.fromhex(sha1))
+    return None if pos is None else graph.bloomFilterAt(pos)
+
+def writeCommitGraph():
+    ''' Write commit graph of all commits reachable from branches. Commits
+        already in the old graph are taken from it, not inflated again.
+    '''
+    nodes = {}
+    stack = list(listRefs().values())
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in nodes:
+            continue
+        node = getCommitNode(sha1)
+        nodes[sha1] = node
+        stack.extend(parent for parent in node.parents if parent not in nodes)
+    if not nodes:
+        return None
+
+    # generation = 1 + max(generation of parents), parents done first.
+    generations = {}
+    for sha1 in nodes:
+        stack = [sha1]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [parent for parent in nodes[top].parents
+                       if parent not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            generations[top] = 1 + max([generations[parent] for parent
+                                        in nodes[top].parents] or [0])
+            stack.pop()
+
+    sha1s = sorted(nodes)
+    positions = {sha1: pos for pos, sha1 in enumerate(sha1s)}
+    fanout = [0] * 256
+    for sha1 in sha1s:
+        fanout[int(sha1[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    commitData = []
+    edges = []
+    for sha1 in sha1s:
+        node = nodes[sha1]
+        parents = [positions[parent] for parent in node.parents]
+        parent1 = parents[0] if parents else GRAPH_PARENT_NONE
+        if len(parents) > 2:
+            parent2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(parents[-1] | GRAPH_LAST_EDGE)
+        else:
+            parent2 = parents[1] if len(parents) == 2 else GRAPH_PARENT_NONE
+        commitData.append(bytes.fromhex(node.tree) + struct.pack('>LLLL',
+                parent1, parent2,
+                (generations[sha1] << 2) | ((node.time >> 32) & 0b11),
+                node.time & 0xffffffff))
+
+    # filters of commits in the old graph are kept, the rest computed.
+    bloomEnds = []
+    bloomData = []
+    bloomSize = 0
+    for sha1 in sha1s:
+        bloomFilter = getBloomFilter(sha1)
+        if bloomFilter is None:
+            bloomFilter = computeBloomFilter(nodes[sha1])
+        bloomData.append(bytes(bloomFilter))
+        bloomSize += len(bloomFilter)
+        bloomEnds.append(bloomSize)
+
+    chunks = [(b'OIDF', struct.pack('>256L', *fanout)),
+              (b'OIDL', b''.join(bytes.fromhex(sha1) for sha1 in sha1s)),
+              (b'CDAT', b''.join(commitData))]
+    if edges:
+        chunks.append((b'EDGE', struct.pack('>{}L'.format(len(edges)),
+                                            *edges)))
+    chunks.append((b'BIDX', struct.pack('>{}L'.format(len(bloomEnds)),
+                                        *bloomEnds)))
+    chunks.append((b'BDAT', struct.pack('>LLL', 1, BLOOM_NUM_HASHES,
+                            BLOOM_BITS_PER_ENTRY) + b''.join(bloomData)))
+    data = struct.pack('>4sBBBB', b'CGPH', 1, 1, len(chunks), 0)
+    offset = len(data) + 12 * (len(chunks) + 1)
+    for chunkId, chunk in chunks:
+        data += struct.pack('>4sQ', chunkId, offset)
+        offset += len(chunk)
+    data += struct.pack('>4sQ', b'\x00' * 4, offset)
+    data += b''.join(chunk for _, chunk in chunks)
+    data += hashlib.sha1(data).digest()
+
+    infoDir = gitPath('objects', 'info')
+    os.makedirs(infoDir, exist_ok = True)
+    writeFileAtomic(os.path.join(infoDir, 'commit-graph'), data)
+    # nodes read before had no generation if they were not in the graph.
+    repoState().commitNodes.clear()
+    return len(sha1s)
+
+# commits missing from the commit graph before commit() writes it again.
+GRAPH_MAX_MISSING = 64
+
+def updateCommitGraph(sha1):
+    ''' Write commit graph after commit of hex sha1 if there is none, or
+        more than GRAPH_MAX_MISSING commits reachable from sha1 are not in
+        it. Return count of commits written, None if not written.
+    '''
+    graph = getCommitGraph()
+    if graph is not None:
+        # new commits stack on the graph, the walk stops at its commits.
+        missing = set()
+        stack = [sha1]
+        while stack and len(missing) <= GRAPH_MAX_MISSING:
+            top = stack.pop()
+            if top in missing or graph.find(bytes.fromhex(top)) is not None:
+                continue
+            missing.add(top)
+            stack.extend(getCommitNode(top).parents)
+        if len(missing) <= GRAPH_MAX_MISSING:
+            return None
+    return writeCommitGraph()
+
+def walkCommits(starts):
+    ''' Yield CommitNode reachable from starts, newest commit time first,
+        like 'git log'. Uses the commit graph, no commit is inflated. '''
+    import heapq
+    seen = set(starts)
+    heap = []
+    for sha1 in starts:
+        node = getCommitNode(sha1)
+        heapq.heappush(heap, (-node.time, sha1))
+    while heap:
+        _, sha1 = heapq.heappop(heap)
+        node = getCommitNode(sha1)
+        yield node
+        for parent in node.parents:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(heap, (-getCommitNode(parent).time, parent))
+
+def isAncestor(ancestor, descendant):
+    ''' Check if commit ancestor is reachable from commit descendant. The
+        walk never goes below the generation of ancestor. '''
+    target = getCommitNode(ancestor)
+    seen = {descendant}
+    stack = [descendant]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 == ancestor:
+            return True
+        for parent in getCommitNode(sha1).parents:
+            if parent in seen:
+                continue
+            seen.add(parent)
+            # generation of an ancestor is always smaller than its child.
+            if getCommitNode(parent).generation >= target.generation or \
+                    target.generation == GENERATION_INFINITY:
+                stack.append(parent)
+    return False
+
+def mergeBases(one, two):
+    ''' Return best common ancestors of commits one and two, walking both
+        sides down in generation order, same as git paint_down_to_common.
+    '''
+    import heapq
+    PARENT1, PARENT2, STALE = 1, 2, 4
+    flags = {one: PARENT1}
+    flags[two] = flags.get(two, 0) | PARENT2
+    heap = []
+    for sha1 in set((one, two)):
+        node = getCommitNode(sha1)
+        heapq.heappush(heap, (-node.generation, -node.time, sha1))
+    results = []
+    # stop when only stale commits are left in the queue.
+    while any(not flags[item[2]] & STALE for item in heap):
+        _, _, sha1 = heapq.heappop(heap)
+        flag = flags[sha1] & (PARENT1 | PARENT2 | STALE)
+        if flag == (PARENT1 | PARENT2):
+            if sha1 not in results:
+                results.append(sha1)
+            flag |= STALE
+        for parent in getCommitNode(sha1).parents:
+            if (flags.get(parent, 0) & flag) == flag:
+                continue
+            flags[parent] = flags.get(parent, 0) | flag
+            node = getCommitNode(parent)
+            heapq.heappush(heap, (-node.generation, -node.time, parent))
+    # drop results which are ancestors of other results.
+    return [sha1 for sha1 in results if not any(
+            other != sha1 and isAncestor(sha1, other) for other in results)]
+
+def pathChanged(node, path, stats):
+    ''' Check if path (file or directory) of commit differs from all of its
+        parents, asking the commit's Bloom filter (which covers the first
+        parent) before reading any tree. stats counts how the filter did.
+    '''
+    bloomFilter = getBloomFilter(node.sha1)
+    if bloomFilter is not None:
+        stats['checked'] += 1
+        if not bloomMaybeContains(bloomFilter, bloomPathKeys(path)):
+            stats['definitelyNot'] += 1
+            return False
+        stats['maybe'] += 1
+    entry = treeEntryAt(node.tree, path)
+    parentEntries = [treeEntryAt(getCommitNode(parent).tree, path)
+                     for parent in node.parents] or [None]
+    if bloomFilter is not None and entry == parentEntries[0]:
+        stats['falsePositive'] += 1
+    return all(entry != parentEntry for parentEntry in parentEntries)
+
+def log(revision = 'HEAD', maxCount = None, pretty = 'medium', paths = None,
+        bloomStats = False):
+    ''' Show commit history from revision, newest first. With paths, only
+        commits changing one of them against their first parent are shown.
+    '''
+    from datetime import datetime, timedelta, timezone
+    try:
+        start = resolveRevision(revision)
+    except FileNotFoundError:
+        errMsg("No Commits Yet.")
+    stats = {'checked': 0, 'definitelyNot': 0, 'maybe': 0,
+             'falsePositive': 0}
+    count = 0
+    for node in walkCommits([start]):
+        if maxCount is not None and count >= maxCount:
+            break
+        if paths and not any(pathChanged(node, path, stats)
+                             for path in paths):
+            continue
+        count += 1
+        if pretty == 'hash':
+            print(node.sha1)
+            continue
+        commit = readCommit(node.sha1)
+        if pretty == 'oneline':
+            print(node.sha1[:7], commit.message.split('\n', 1)[0])
+            continue
+        # 'corsair <xiangp126@126.com> 1505724533 -0400'
+        name, stamp, tz = commit.author.rsplit(' ', 2)
+        minutes = int(tz[1:3]) * 60 + int(tz[3:5])
+        zone = timezone(timedelta(minutes = -minutes if tz[0] == '-'
+                                                    else minutes))
+        date = datetime.fromtimestamp(int(stamp), zone)
+        print('commit {}'.format(node.sha1))
+        if len(node.parents) > 1:
+            print('Merge: {}'.format(' '.join(p[:7] for p in node.parents)))
+        print('Author: {}'.format(name))
+        print('Date:   {:%a %b} {} {:%H:%M:%S %Y %z}'.format(date, date.day,
+                                                              date))
+        print()
+        for line in commit.message.rstrip('\n').split('\n'):
+            print('    {}'.format(line).rstrip() or '')
+        print()
+    if bloomStats:
+        # false positive rate, of the commits the filter said 'maybe' to.
+        rate = stats['falsePositive'] / stats['maybe'] if stats['maybe'] else 0
+        print("Bloom filter: checked {}, definitely not {}, maybe {}, "
+              "false positive {} ({:.1%})".format(stats['checked'],
+              stats['definitelyNot'], stats['maybe'], stats['falsePositive'],
+              rate), file = sys.stderr)
+
+class Index:
+    ''' Entries of the index file, kept compact: the file is memory-mapped,
+        loading only records where each entry and its path start, and stat
+        fields, SHA-1 and path are decoded from the mapping when an entry is
+        asked for. Iterating or indexing yields IndexEntry, same as the old
+        list of entries.
+    '''
+    # 32-bit stat fields of an entry, in file order.
+    statFields = ('ctime_s', 'ctime_n', 'mtime_s', 'mtime_n', 'dev', 'ino',
+                  'mode', 'uid', 'gid', 'size')
+    ''' stat fields, SHA-1 and flags at an entry offset:
+        (1505637351, 0, 1505637351, 0, 16777220, 35245842, 33188, 502, 20,
+         83, b'\x0c\x02Q\xe0\x9eya\xf9\x92s\xa5\xa8\xe9S\xf6Q\xeb_=Y', 8)
+    '''
+    entryStruct = struct.Struct('>10L20sH')
+
+    def __init__(self, path = None, verify = True):
+        import array
+        self.version = 2
+        # {b'TREE': data, ...} raw data of index extensions.
+        self.extensions = {}
+        # offset of every entry in the mapped file.
+        self.offsets = array.array('Q')
+        self.flags = array.array('H')
+        self.extFlags = array.array('H')
+        # start and length of every path inside self.pathData, which is the
+        # mapped file itself, or the decoded paths for v4.
+        self.pathStarts = array.array('Q')
+        self.pathLens = array.array('I')
+        self.data = self.pathData = b''
+        if path is not None:
+            self.load(path, verify)
+
+    def load(self, path, verify):
+        import mmap
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.data = data
+        # calculate checksum leaving the last 20 bytes(checksum itself).
+        if verify:
+            view = memoryview(data)
+            with tracePhase('index-checksum'):
+                checkSum = hashlib.sha1(view[0:-20]).digest()
+            view.release()
+            assert checkSum == data[-20:], "Error, Invalid Index CheckSum."
+        sigh, ver, fileCnt = struct.unpack_from('>4sLL', data, 0)
+        assert sigh == b'DIRC', \
+                'Error, Invalid Index Signature {}'.format(sigh)
+        assert ver in (2, 3, 4), 'Error, Unknown Index Version {}'.format(ver)
+        self.version = ver
+
+        # per entry data length, 62, its 16-bit flags are the last field.
+        entryDataLen = self.entryStruct.size
+        flagsFrom = struct.Struct('>H').unpack_from
+        # the arrays are filled as the entries are walked, nothing per entry
+        # is kept but these.
+        offsets = self.offsets
+        flagsColumn = self.flags
+        extFlags = self.extFlags
+        pathStarts = self.pathStarts
+        pathLens = self.pathLens
+        # v4 only, decoded full paths one after another.
+        paths = bytearray()
+        prevPath = b''
+        i = 12
+        for _ in range(fileCnt):
+            flags, = flagsFrom(data, i + entryDataLen - 2)
+            offsets.append(i)
+            flagsColumn.append(flags)
+            pos = i + entryDataLen
+            # v3+, 16-bit extended flags follow if the extended bit is set.
+            if flags & INDEX_FLAG_EXTENDED:
+                assert ver >= 3, 'Error, Extended Flag in Index Version 2.'
+                extFlags.append(flagsFrom(data, pos)[0])
+                pos += 2
+            else:
+                extFlags.append(0)
+            if ver == 4:
+                ''' v4 path: varint N of bytes to remove from the end of the
+                    previous path, then the rest NUL-terminated, no padding.
+                    'src/a.c', 'src/b.c' => 0 'src/a.c\0', 3 'b.c\0'
+                '''
+                strip, pos = decodeOffsetVarint(data, pos)
+                end = data.find(b'\x00', pos)
+                path = prevPath[:len(prevPath) - strip] + data[pos:end]
+                prevPath = path
+                pathStarts.append(len(paths))
+                pathLens.append(len(path))
+                paths += path
+                i = end + 1
+                continue
+            # parse path name, multiple b'\x00' terminatered.
+            pathLen = flags & INDEX_NAME_MASK
+            # 0xfff means the name is too long for 12 bit, find its end.
+            if pathLen == INDEX_NAME_MASK:
+                pathLen = data.find(b'\x00', pos) - pos
+            pathStarts.append(pos)
+            pathLens.append(pathLen)
+            i += ((pos - i + pathLen) // 8 + 1) * 8
+        self.pathData = bytes(paths) if ver == 4 else data
+
+        # | Ext-Sig     | Ext-Size     | Ext-Data |, till the checksum.
+        while i + 8 <= len(data) - 20:
+            extSig, extSize = struct.unpack_from('>4sL', data, i)
+            self.extensions[extSig] = data[i + 8:i + 8 + extSize]
+            i += 8 + extSize
+        assert i == len(data) - 20, "Error, Invalid Index Extension."
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        ''' IndexEntry(ctime_s=1505637351, ctime_n=0, mtime_s=1505637351,
             mtime_n=0, dev=16777220, ino=35245842, mode=33188, uid=502,
             gid=20, size=83,
             sha1=b'\x0c\x02Q\xe0\x9eya\xf9\x92s\xa5\xa8\xe9S\xf6Q\xeb_=Y',
             flags=8, path='main.cpp')
         '''
-        entry = IndexEntry(*(fields + (path.decode(),)))
-        entries.append(entry)
-        i += entryLen
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('index entry out of range')
+        fields = self.entryStruct.unpack_from(self.data, self.offsets[i])
+        return IndexEntry(*fields, self.pathAt(i), self.extFlags[i])
 
-    assert len(entries) == fileCnt, "Error, File Count Not Match."
-    return entries
+    def pathBytesAt(self, i):
+        start = self.pathStarts[i]
+        return self.pathData[start:start + self.pathLens[i]]
+
+    def pathAt(self, i):
+        return self.pathBytesAt(i).decode('utf-8')
+
+    def sha1At(self, i):
+        start = self.offsets[i] + 40
+        return self.data[start:start + 20]
+
+    def paths(self):
+        ''' Return paths of all entries, in index order. '''
+        return [self.pathAt(i) for i in range(len(self))]
+
+    def find(self, path):
+        ''' Binary search position of path (entries are sorted by path
+            bytes), return None if not in index. '''
+        key = path.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.pathBytesAt(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.pathBytesAt(lo) == key:
+            return lo
+        return None
+
+    def get(self, path):
+        ''' Return IndexEntry of path, or None. '''
+        i = self.find(path)
+        return None if i is None else self[i]
 
-def getStatus():
+def readIndexChecksum(path):
+    ''' Return the trailing SHA-1 of index file, b'' if it is too short
+        or gone. '''
+    try:
+        with open(path, 'rb') as file:
+            file.seek(-20, os.SEEK_END)
+            return file.read(20)
+    except OSError:
+        return b''
+
+def readIndex(verify = True):
+    ''' Read index file, return Index holding IndexEntry objects. The
+        checksum check can be skipped by read-only commands with verify.
+        An unchanged index file is not parsed again, callers must not
+        modify the returned Index.
+    '''
+    path = gitPath('index')
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return Index()
+    key = (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    indexCache = repoState().indexCache
+    if indexCache['key'] == key and (indexCache['verified'] or not verify) \
+            and readIndexChecksum(path) == indexCache['index'].data[-20:]:
+        return indexCache['index']
+    try:
+        with tracePhase('index-read'):
+            index = Index(path, verify)
+    except FileNotFoundError:
+        return Index()
+    if trace:
+        trace.count('indexEntries', len(index))
+    indexCache.update(key = key, index = index, verified = verify)
+    return index
+
+''' Ignore rules of .gitignore in every directory, .git/info/exclude and
+    the global ~/.config/git/ignore, same syntax and precedence as git.
+    Rules of a deeper .gitignore win over a higher one, then info/exclude,
+    then the global file, the last matching rule in a file wins and '!'
+    brings a path back. Rules are sorted by shape when compiled, so most
+    paths are decided by dict lookups:
+      'name', 'name/'        -> basename dict
+      '*.suffix'             -> suffix dict, one lookup per suffix length
+      'prefix*'              -> prefix dict, one lookup per prefix length
+      'dir/name', '/name'    -> relative path dict
+      anything else          -> regex, tried only if it could beat the
+                                best rule found by the lookups.
+'''
+IgnoreRule = collections.namedtuple('IgnoreRule',
+                                    ['pattern', 'negate', 'dirOnly'])
+# characters that make a pattern more than a literal.
+IGNORE_WILDCARDS = '*?[\\'
+
+def wildmatchRegex(pattern):
+    ''' Translate git wildmatch pattern (with path name mode) to regex. '''
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/') \
+                and (i + 2 == len(pattern) or pattern[i + 2] == '/'):
+            # '**/x' any leading dirs, 'x/**' anything inside, 'a/**/b'
+            # zero or more dirs between.
+            if i + 2 == len(pattern):
+                regex.append('.*')
+            else:
+                regex.append('(?:.*/)?')
+                i += 1
+            i += 2
+            continue
+        if char == '*':
+            while i + 1 < len(pattern) and pattern[i + 1] == '*':
+                i += 1
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            end = i + 1
+            if end < len(pattern) and pattern[end] in '!^':
+                end += 1
+            if end < len(pattern) and pattern[end] == ']':
+                end += 1
+            while end < len(pattern) and pattern[end] != ']':
+                end += 1
+            if end >= len(pattern):
+                regex.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end]
+                negate = body[:1] in ('!', '^')
+                body = body[1:] if negate else body
+                body = body.replace('\\', '\\\\').replace('^', '\\^')
+                regex.append('[{}{}]'.format('^/' if negate else '', body))
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+def parseIgnoreLine(line):
+    ''' Return IgnoreRule and whether it is anchored of one line of an
+        ignore file, None for blank lines and comments. '''
+    line = line.rstrip('\r\n')
+    # trailing spaces are dropped unless escaped with '\'.
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dirOnly = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    # a slash at the beginning or in the middle anchors the pattern to
+    # the directory of the ignore file.
+    anchored = '/' in line
+    return IgnoreRule(line.lstrip('/'), negate, dirOnly), anchored
+
+class IgnoreRules:
+    ''' Compiled rules of one ignore file. '''
+    def __init__(self, lines):
+        self.rules = []
+        # key -> positions of rules, for the shapes in the comment above.
+        self.names, self.suffixes, self.prefixes, self.paths = {}, {}, {}, {}
+        # [(position, compiled regex, anchored)], last rule first.
+        self.regexes = []
+        for line in lines:
+            parsed = parseIgnoreLine(line)
+            if parsed is None:
+                continue
+            rule, anchored = parsed
+            pos = len(self.rules)
+            self.rules.append(rule)
+            pattern = rule.pattern
+            wild = [char for char in pattern if char in IGNORE_WILDCARDS]
+            if not wild:
+                table = self.paths if anchored else self.names
+                table.setdefault(pattern, []).append(pos)
+            elif not anchored and wild == ['*'] and pattern[0] == '*':
+                self.suffixes.setdefault(pattern[1:], []).append(pos)
+            elif not anchored and wild == ['*'] and pattern[-1] == '*':
+                self.prefixes.setdefault(pattern[:-1], []).append(pos)
+            else:
+                self.regexes.append((pos, wildmatchRegex(pattern), anchored))
+        self.regexes.reverse()
+        self.suffixLens = sorted({len(key) for key in self.suffixes})
+        self.prefixLens = sorted({len(key) for key in self.prefixes})
+
+    def match(self, relPath, isDir):
+        ''' Return True if ignored, False if brought back by '!', None if
+            no rule matches relPath (relative to the ignore file). '''
+        name = relPath[relPath.rfind('/') + 1:]
+        found = [self.names.get(name), self.paths.get(relPath)]
+        found += [self.suffixes.get(name[len(name) - length:])
+                  for length in self.suffixLens if length <= len(name)]
+        found += [self.prefixes.get(name[:length])
+                  for length in self.prefixLens if length <= len(name)]
+        best = -1
+        for positions in found:
+            for pos in positions or ():
+                if pos > best and (isDir or not self.rules[pos].dirOnly):
+                    best = pos
+        for pos, regex, anchored in self.regexes:
+            if pos <= best:
+                break
+            if (isDir or not self.rules[pos].dirOnly) and \
+                    regex.match(relPath if anchored else name):
+                best = pos
+                break
+        return None if best < 0 else not self.rules[best].negate
+
+def globalExcludesFile():
+    ''' Path of git's default global ignore file. '''
+    configHome = os.environ.get('XDG_CONFIG_HOME') or \
+                 os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(configHome, 'git', 'ignore')
+
+class IgnoreMatcher:
+    ''' All ignore rules of the work tree, .gitignore files are read when
+        a directory below them is first asked about. '''
+    def __init__(self):
+        # directory ('' or 'deer/') -> (IgnoreRules or None, blob SHA-1).
+        self.dirRules = {}
+        self.globalRules = []
+        for path in (gitPath('info', 'exclude'),
+                     globalExcludesFile()):
+            try:
+                data = readFile(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self.globalRules.append(IgnoreRules(
+                    data.decode('utf-8', 'surrogateescape').splitlines()))
+
+    def loadDir(self, dirPath):
+        ''' Return (IgnoreRules or None, blob SHA-1 or NULL_SHA1) of the
+            .gitignore in dirPath. '''
+        if dirPath not in self.dirRules:
+            try:
+                data = readFile(workPath(dirPath + '.gitignore'))
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                self.dirRules[dirPath] = (None, NULL_SHA1)
+            else:
+                self.dirRules[dirPath] = (IgnoreRules(
+                        data.decode('utf-8', 'surrogateescape').splitlines()),
+                        bytes.fromhex(hashObject(data)))
+        return self.dirRules[dirPath]
+
+    def isIgnored(self, path, isDir = False):
+        ''' Check path ('deer/raw.txt') against all rules, its parent
+            directories are expected to be not ignored, as a walk that
+            prunes ignored directories asks. '''
+        slash = path.rfind('/')
+        while True:
+            dirPath = path[:slash + 1]
+            rules, _ = self.loadDir(dirPath)
+            if rules is not None:
+                ignored = rules.match(path[len(dirPath):], isDir)
+                if ignored is not None:
+                    return ignored
+            if slash < 0:
+                break
+            slash = path.rfind('/', 0, slash)
+        for rules in self.globalRules:
+            ignored = rules.match(path, isDir)
+            if ignored is not None:
+                return ignored
+        return False
+
+''' Untracked cache (UNTR index extension), same format as git.
+      | varint ident size | ident 'Location <work tree>, system <os>\0' |
+      | stat of info/exclude | stat of core.excludesFile | dir flags 32  |
+      | SHA-1 of info/exclude | SHA-1 of core.excludesFile               |
+      | per directory exclude file name\0 | varint directory count     |
+      | per directory, preorder: varint untracked count, varint subdir  |
+      |   count, name\0, untracked names\0 (directories end with '/')   |
+      | EWAH bitmaps by directory number: valid, check only, has SHA-1 |
+      | stat of every valid directory | SHA-1 of every has SHA-1 one   |
+      | \0                                                             |
+    stat is ctime s/ns, mtime s/ns, dev, ino, uid, gid, size, 32 bit each,
+    SHA-1 of a directory is the blob SHA-1 of its .gitignore. A directory
+    whose stat and .gitignore are unchanged is not listed again.
+'''
+# DIR_SHOW_OTHER_DIRECTORIES | DIR_HIDE_EMPTY_DIRECTORIES, flags of git
+# status, git drops a cache written with other flags.
+UNTRACKED_DIR_FLAGS = 0x6
+NULL_SHA1 = b'\x00' * 20
+
+def encodeEwah(bits):
+    ''' Serialize list of bools as git's EWAH bitmap: 32 bit bit count,
+        32 bit word count, 64 bit words, 32 bit position of last marker.
+        Written as one marker word (running length 0, all literal words)
+        followed by the literal words, bit i is bit i % 64 of word i / 64.
+    '''
+    words = [0] * ((len(bits) + 63) // 64)
+    for i, bit in enumerate(bits):
+        if bit:
+            words[i // 64] |= 1 << (i % 64)
+    # marker: 1 bit running bit, 32 bit running length, 31 bit literals.
+    words.insert(0, len(words) << 33)
+    return struct.pack('>LL{}QL'.format(len(words)), len(bits), len(words),
+                       *words, 0)
+
+def decodeEwah(data, pos):
+    ''' Return (list of bools, next pos) of EWAH bitmap at pos. '''
+    bitCount, wordCount = struct.unpack_from('>LL', data, pos)
+    words = struct.unpack_from('>{}Q'.format(wordCount), data, pos + 8)
+    bits = []
+    i = 0
+    while i < wordCount:
+        marker = words[i]
+        literals = marker >> 33
+        bits.extend([bool(marker & 1)] * (((marker >> 1) & 0xffffffff) * 64))
+        for word in words[i + 1:i + 1 + literals]:
+            bits.extend(bool((word >> bit) & 1) for bit in range(64))
+        i += 1 + literals
+    return bits[:bitCount], pos + 8 + 8 * wordCount + 4
+
+def untrackedStat(st = None):
+    ''' Stat data of untracked cache from os.stat() result, zeros if None. '''
+    if st is None:
+        return (0,) * 9
+    ctimeS, ctimeN = divmod(st.st_ctime_ns, 10 ** 9)
+    mtimeS, mtimeN = divmod(st.st_mtime_ns, 10 ** 9)
+    return tuple(value & 0xffffffff for value in (ctimeS, ctimeN, mtimeS,
+                 mtimeN, st.st_dev, st.st_ino, st.st_uid, st.st_gid,
+                 st.st_size))
+
+def excludeFileData(path):
+    ''' Return (stat data, blob SHA-1) of an exclude file, zeros and
+        NULL_SHA1 if it does not exist. '''
+    try:
+        st = os.stat(path)
+        data = readFile(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return untrackedStat(), NULL_SHA1
+    return untrackedStat(st), bytes.fromhex(hashObject(data))
+
+class UntrackedDir:
+    ''' Node of the untracked cache: one directory of the working tree. '''
+    def __init__(self, name = ''):
+        self.name = name
+        # stat and untracked are trusted only if valid.
+        self.valid = False
+        # no tracked file below, listed only to show its untracked files.
+        self.checkOnly = False
+        self.stat = untrackedStat()
+        # SHA-1 of .gitignore in this directory, NULL_SHA1 if none.
+        self.excludeSha1 = NULL_SHA1
+        # names of untracked files, untracked directories end with '/'.
+        self.untracked = []
+        # 'dirName' -> UntrackedDir of the sub directory.
+        self.dirs = collections.OrderedDict()
+
+    def invalidate(self, path):
+        ''' Mark every directory from root down to path's parent dirty, a
+            path added to index is no longer untracked there. '''
+        node = self
+        for name in [''] + path.split('/')[:-1]:
+            node = node.dirs.get(name) if name else node
+            if node is None:
+                return
+            node.valid = False
+            node.checkOnly = False
+            node.untracked = []
+
+class UntrackedCache:
+    ''' Untracked cache of the index, see the format above. '''
+    def __init__(self):
+        self.ident = 'Location {}, system {}'.format(
+                os.path.realpath(workPath('.')), os.uname().sysname)
+        self.infoExcludeStat = self.excludesFileStat = untrackedStat()
+        self.infoExcludeSha1 = self.excludesFileSha1 = NULL_SHA1
+        self.dirFlags = UNTRACKED_DIR_FLAGS
+        self.excludePerDir = '.gitignore'
+        self.root = UntrackedDir()
+
+    def encode(self):
+        ''' Return UNTR extension data. '''
+        ident = self.ident.encode('utf-8') + b'\x00'
+        data = [encodeOffsetVarint(len(ident)), ident,
+                struct.pack('>9L', *self.infoExcludeStat),
+                struct.pack('>9L', *self.excludesFileStat),
+                struct.pack('>L', self.dirFlags),
+                self.infoExcludeSha1, self.excludesFileSha1,
+                self.excludePerDir.encode('utf-8') + b'\x00']
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.dirs.values()))
+        data.append(encodeOffsetVarint(len(nodes)))
+        for node in nodes:
+            untracked = node.untracked if node.valid else []
+            data.append(encodeOffsetVarint(len(untracked)))
+            data.append(encodeOffsetVarint(len(node.dirs)))
+            data.append(node.name.encode('utf-8') + b'\x00')
+            data.extend(name.encode('utf-8') + b'\x00' for name in untracked)
+        data.append(encodeEwah([node.valid for node in nodes]))
+        data.append(encodeEwah([node.valid and node.checkOnly
+                                for node in nodes]))
+        data.append(encodeEwah([node.excludeSha1 != NULL_SHA1
+                                for node in nodes]))
+        data.extend(struct.pack('>9L', *node.stat)
+                    for node in nodes if node.valid)
+        data.extend(node.excludeSha1 for node in nodes
+                    if node.excludeSha1 != NULL_SHA1)
+        data.append(b'\x00')
+        return b''.join(data)
+
+def parseUntrackedCache(data):
+    ''' Parse UNTR extension data into UntrackedCache. '''
+    cache = UntrackedCache()
+    identLen, pos = decodeOffsetVarint(data, 0)
+    cache.ident = data[pos:pos + identLen - 1].decode('utf-8', 'replace')
+    pos += identLen
+    cache.infoExcludeStat = struct.unpack_from('>9L', data, pos)
+    cache.excludesFileStat = struct.unpack_from('>9L', data, pos + 36)
+    cache.dirFlags, = struct.unpack_from('>L', data, pos + 72)
+    cache.infoExcludeSha1 = data[pos + 76:pos + 96]
+    cache.excludesFileSha1 = data[pos + 96:pos + 116]
+    pos += 116
+    nameEnd = data.index(b'\x00', pos)
+    cache.excludePerDir = data[pos:nameEnd].decode('utf-8')
+    count, pos = decodeOffsetVarint(data, nameEnd + 1)
+    if not count:
+        return cache
+
+    nodes = []
+    def parseNode(pos):
+        ''' Return (UntrackedDir, next pos) of the block at pos. '''
+        untrackedCount, pos = decodeOffsetVarint(data, pos)
+        dirCount, pos = decodeOffsetVarint(data, pos)
+        names = []
+        for _ in range(untrackedCount + 1):
+            nameEnd = data.index(b'\x00', pos)
+            names.append(data[pos:nameEnd].decode('utf-8', 'surrogateescape'))
+            pos = nameEnd + 1
+        node = UntrackedDir(names[0])
+        node.untracked = names[1:]
+        nodes.append(node)
+        for _ in range(dirCount):
+            child, pos = parseNode(pos)
+            node.dirs[child.name] = child
+        return node, pos
+    cache.root, pos = parseNode(pos)
+
+    valid, pos = decodeEwah(data, pos)
+    checkOnly, pos = decodeEwah(data, pos)
+    hasSha1, pos = decodeEwah(data, pos)
+    # git leaves off trailing zero bits.
+    padding = [False] * len(nodes)
+    valid, checkOnly, hasSha1 = [(bits + padding)[:len(nodes)]
+                                 for bits in (valid, checkOnly, hasSha1)]
+    for node, isValid, isCheckOnly in zip(nodes, valid, checkOnly):
+        node.valid, node.checkOnly = isValid, isCheckOnly
+        if isValid:
+            node.stat = struct.unpack_from('>9L', data, pos)
+            pos += 36
+    for node, isSet in zip(nodes, hasSha1):
+        if isSet:
+            node.excludeSha1 = data[pos:pos + 20]
+            pos += 20
+    return cache
+
+def scanUntracked(cache, trackedPaths, indexMtime = None, dirtyDirs = None,
+                  matcher = None):
+    ''' Return untracked files of working tree, using and refreshing the
+        untracked cache. A directory is listed again only if its stat or
+        .gitignore (or one above it) changed since the cache was written,
+        otherwise its untracked names come from the cache. Sub directories
+        are always visited, a change below does not touch the stat of the
+        parent. dirtyDirs ({'', 'deer/'}) from fsmonitor are the only
+        directories that may have changed, the others are not even stat-ed.
+        Ignored files and directories are left out, as matcher tells.
+    '''
+    if matcher is None:
+        matcher = IgnoreMatcher()
+    # 'deer/raw.txt' -> {'', 'deer/'}, directories holding tracked files.
+    trackedDirs = {''}
+    for path in trackedPaths:
+        slash = path.rfind('/')
+        while slash >= 0 and path[:slash + 1] not in trackedDirs:
+            trackedDirs.add(path[:slash + 1])
+            slash = path.rfind('/', 0, slash)
+    infoExclude = excludeFileData(gitPath('info', 'exclude'))
+    excludesFile = excludeFileData(globalExcludesFile())
+    # rules of the whole tree changed, nothing in the cache holds.
+    if (infoExclude[1], excludesFile[1]) != (cache.infoExcludeSha1,
+                                             cache.excludesFileSha1):
+        cache.root = UntrackedDir()
+    cache.infoExcludeStat, cache.infoExcludeSha1 = infoExclude
+    cache.excludesFileStat, cache.excludesFileSha1 = excludesFile
+    newFiles = []
+
+    def scanDir(node, dirPath, rulesChanged = False):
+        ''' Scan dirPath ('' for root, else 'deer/'), return whether any
+            untracked file is below it, None if it is not a directory.
+            rulesChanged tells a .gitignore above dirPath changed. '''
+        # git stops listing an untracked directory at its first file, so
+        # a check only node may be partial, list it again.
+        trusted = node.valid and not node.checkOnly and not rulesChanged
+        if dirtyDirs is None or dirPath in dirtyDirs or not trusted:
+            try:
+                st = os.lstat(workPath(dirPath) or '.')
+            except (FileNotFoundError, NotADirectoryError):
+                return None
+            if not stat.S_ISDIR(st.st_mode):
+                return None
+            statData = untrackedStat(st)
+            _, excludeSha1 = matcher.loadDir(dirPath)
+            rulesChanged = rulesChanged or node.excludeSha1 != excludeSha1
+            # a directory changed within the second the index was written
+            # may change again with the same mtime, do not trust it then.
+            racy = indexMtime is not None and \
+                    statData[2] >= (indexMtime[0] & 0xffffffff)
+            trusted = trusted and node.stat == statData and \
+                      not rulesChanged and not racy
+        else:
+            statData, excludeSha1 = node.stat, node.excludeSha1
+        if trusted:
+            files = [name for name in node.untracked if name[-1:] != '/']
+            dirNames = list(node.dirs.keys())
+            dirNames += [name[:-1] for name in node.untracked
+                         if name[-1:] == '/' and name[:-1] not in node.dirs]
+        else:
+            if trace:
+                trace.count('dirsListed')
+            files, dirNames = [], []
+            with os.scandir(workPath(dirPath) or '.') as dirEntries:
+                for dirEntry in dirEntries:
+                    if not dirPath and dirEntry.name == baseName:
+                        continue
+                    isDir = dirEntry.is_dir(follow_symlinks = False)
+                    # an ignored directory is not entered at all.
+                    if matcher.isIgnored(dirPath + dirEntry.name, isDir):
+                        continue
+                    if isDir:
+                        dirNames.append(dirEntry.name)
+                    else:
+                        files.append(dirEntry.name)
+            files.sort()
+            dirNames.sort()
+        node.valid = True
+        node.checkOnly = dirPath not in trackedDirs
+        node.stat = statData
+        node.excludeSha1 = excludeSha1
+
+        untracked = [name for name in files
+                     if dirPath + name not in trackedPaths]
+        newFiles.extend(dirPath + name for name in untracked)
+        hasUntracked = bool(untracked)
+        dirs = collections.OrderedDict()
+        for name in dirNames:
+            child = node.dirs.get(name) or UntrackedDir(name)
+            found = scanDir(child, dirPath + name + '/', rulesChanged)
+            # gone since the cache was written.
+            if found is None:
+                continue
+            dirs[name] = child
+            hasUntracked = hasUntracked or found
+            # untracked directory with something in it, as git lists it.
+            if found and dirPath + name + '/' not in trackedDirs:
+                untracked.append(name + '/')
+        node.dirs = dirs
+        node.untracked = untracked
+        return hasUntracked
+
+    scanDir(cache.root, '')
+    return newFiles
+
+''' File system monitor (FSMN index extension), same layout as git's v2.
+      | 32 bit version 2 | token\0 | 32 bit EWAH size | EWAH bitmap      |
+    Bit i is set if entry i was not clean when token was taken, so it is
+    checked again. 'fkgit fsmonitor' watches the work tree with inotify and
+    tells which paths changed since a token over a unix socket, status then
+    checks those paths and the set bits only, instead of every entry.
+      request: token\n  ('quit\n' stops the daemon)
+      reply:   new token\0path\0path...  ('/' as the only path: check all)
+    Token is '<daemon instance>:<event number>', a token of another daemon
+    instance or older than lost events always gets '/'.
+'''
+FSMONITOR_SOCKET = 'fsmonitor--daemon.ipc'
+# changed paths kept by the daemon, older tokens go stale past this.
+FSMONITOR_MAX_PATHS = 1 << 20
+# inotify(7) event bits.
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = \
+        0x4000, 0x8000, 0x1000000, 0x40000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+               IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+               IN_MOVE_SELF | IN_ONLYDIR
+
+def parseFsmonitor(data):
+    ''' Return (token, dirty bits) of FSMN extension data. '''
+    version, = struct.unpack_from('>L', data, 0)
+    assert version == 2, "FSMN Version {} Not Supported.".format(version)
+    tokenEnd = data.index(b'\x00', 4)
+    dirty, _ = decodeEwah(data, tokenEnd + 5)
+    return data[4:tokenEnd].decode('utf-8'), dirty
+
+def encodeFsmonitor(token, dirty):
+    ''' Return FSMN extension data of token and dirty bits of entries. '''
+    bitmap = encodeEwah(dirty)
+    return struct.pack('>L', 2) + token.encode('utf-8') + b'\x00' + \
+           struct.pack('>L', len(bitmap)) + bitmap
+
+class Inotify:
+    ''' Minimal inotify binding by ctypes, Linux only. '''
+    def __init__(self):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno = True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory path, '' or 'deer/'.
+        self.watches = {}
+
+    def watch(self, dirPath):
+        ''' Watch a directory, return False if it is gone. '''
+        wd = self.libc.inotify_add_watch(self.fd,
+                    os.fsencode(dirPath or '.'), INOTIFY_MASK)
+        if wd < 0:
+            return False
+        self.watches[wd] = dirPath
+        return True
+
+    def read(self):
+        ''' Yield (path, mask) of every queued event, path None if events
+            were lost. '''
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(data):
+                # struct inotify_event: wd, mask, cookie, len, name[len]
+                wd, mask, _, nameLen = struct.unpack_from('iIII', data, pos)
+                name = data[pos + 16:pos + 16 + nameLen].rstrip(b'\x00')
+                pos += 16 + nameLen
+                if mask & IN_Q_OVERFLOW:
+                    yield None, mask
+                elif mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches:
+                    dirPath = self.watches[wd]
+                    yield (dirPath + os.fsdecode(name) if name
+                           else dirPath.rstrip('/')), mask
+
+def fsmonitorDaemon():
+    ''' Watch the work tree till stopped, answer paths changed since a
+        token on .git/fsmonitor--daemon.ipc, see the protocol above. '''
+    import socket, selectors
+    if queryFsmonitor('') is not None:
+        errMsg("fsmonitor Already Running.")
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError):
+        errMsg("fsmonitor Needs inotify (Linux).")
+
+    # tokens of another daemon instance are always stale.
+    instance = '{}.{}'.format(os.getpid(), time.time_ns())
+    # number of the last event, and of the first one still known.
+    lastEvent = firstEvent = 0
+    # path -> number of the last event of it.
+    changed = {}
+
+    def watchTree(top):
+        ''' Watch top ('' or 'deer/') and directories below it, return
+            paths found in them. Watch first, then list, so nothing
+            created in between is missed. '''
+        found = []
+        stack = [top]
+        while stack:
+            dirPath = stack.pop()
+            if not inotify.watch(dirPath):
+                continue
+            try:
+                with os.scandir(dirPath or '.') as dirEntries:
+                    for dirEntry in dirEntries:
+                        if not dirPath and dirEntry.name == baseName:
+                            continue
+                        found.append(dirPath + dirEntry.name)
+                        if dirEntry.is_dir(follow_symlinks = False):
+                            stack.append(dirPath + dirEntry.name + '/')
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return found
+
+    def readEvents():
+        nonlocal lastEvent, firstEvent
+        for path, mask in inotify.read():
+            lastEvent += 1
+            if path is None or len(changed) >= FSMONITOR_MAX_PATHS:
+                # events lost, no older token can be answered any more.
+                changed.clear()
+                firstEvent = lastEvent
+                continue
+            if path == baseName or path.startswith(baseName + '/'):
+                continue
+            changed[path] = lastEvent
+            # files may be created before the new directory is watched.
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for found in watchTree(path + '/'):
+                    changed[found] = lastEvent
+
+    def answer(request):
+        ''' Return reply of a token request. '''
+        readEvents()
+        reply = ['{}:{}'.format(instance, lastEvent)]
+        tokenInstance, _, tokenEvent = request.partition(':')
+        if tokenInstance != instance or not tokenEvent.isdigit() or \
+                int(tokenEvent) < firstEvent:
+            reply.append('/')
+        else:
+            reply.extend(path for path, event in changed.items()
+                         if event > int(tokenEvent))
+        return '\x00'.join(reply).encode('utf-8', 'surrogateescape')
+
+    watchTree('')
+    sockPath = gitPath(FSMONITOR_SOCKET)
+    if os.path.exists(sockPath):
+        os.unlink(sockPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sockPath)
+    server.listen(16)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(inotify.fd, selectors.EVENT_READ)
+    print("fsmonitor Watching [{}] Directories.".format(len(inotify.watches)))
+    sys.stdout.flush()
+    try:
+        running = True
+        while running:
+            for key, _ in selector.select():
+                if key.fileobj is not server:
+                    readEvents()
+                    continue
+                conn, _ = server.accept()
+                with conn:
+                    conn.settimeout(5)
+                    try:
+                        request = conn.makefile('rb').readline()
+                        request = request.decode('utf-8').strip()
+                        if request == 'quit':
+                            running = False
+                            conn.sendall(b'ok')
+                        else:
+                            conn.sendall(answer(request))
+                    except OSError:
+                        continue
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(sockPath)
+        os.close(inotify.fd)
+
+def queryFsmonitor(token):
+    ''' Ask fsmonitor daemon for paths changed since token, return (new
+        token, set of paths or None if all must be checked), None if no
+        daemon is running. '''
+    import socket
+    sockPath = gitPath(FSMONITOR_SOCKET)
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(sockPath)
+            conn.sendall(token.encode('utf-8') + b'\n')
+            for chunk in iter(lambda: conn.recv(1 << 16), b''):
+                chunks.append(chunk)
+    except OSError:
+        return None
+    reply = b''.join(chunks).decode('utf-8', 'surrogateescape').split('\x00')
+    if reply[1:] == ['/']:
+        return reply[0], None
+    return reply[0], set(reply[1:])
+
+def stopFsmonitor():
+    ''' Stop fsmonitor daemon of this repository. '''
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(gitPath(FSMONITOR_SOCKET))
+            conn.sendall(b'quit\n')
+            conn.recv(16)
+    except OSError:
+        errMsg("fsmonitor Not Running.")
+
+def fsmonitorCandidates(paths, dirty, changedPaths):
+    ''' Return index paths to check: with dirty bit set, reported changed,
+        or below a reported path (a directory moved away reports only
+        itself). paths is sorted index paths. '''
+    candidates = {path for path, isDirty in zip(paths, dirty) if isDirty}
+    for changed in changedPaths:
+        i = bisect.bisect_left(paths, changed)
+        if i < len(paths) and paths[i] == changed:
+            candidates.add(changed)
+        # 'deer.txt' sorts between 'deer' and 'deer/', search again.
+        i = bisect.bisect_left(paths, changed + '/')
+        while i < len(paths) and paths[i].startswith(changed + '/'):
+            candidates.add(paths[i])
+            i += 1
+    return candidates
+
+# index entries per preload thread and most threads, as git's THREAD_COST
+# and MAX_PARALLEL, fewer entries are lstat-ed faster than threads start.
+PRELOAD_MIN_ENTRIES = 500
+PRELOAD_MAX_THREADS = 20
+
+def preloadIndex(paths, threads = None, minEntries = PRELOAD_MIN_ENTRIES):
+    ''' lstat() every path, return {path: os.stat_result, None if gone}.
+        Paths are split into ranges, each lstat-ed by its own thread, as
+        git's preload-index: lstat() drops the GIL, so threads overlap on
+        slow disks and NFS. By default one thread per minEntries paths, up
+        to PRELOAD_MAX_THREADS, a single thread below 2 * minEntries.
+    '''
+    paths = list(paths)
+    if trace:
+        trace.count('filesStat', len(paths))
+    with tracePhase('lstat'):
+        return preloadPaths(paths, threads, minEntries)
+
+def preloadPaths(paths, threads, minEntries):
+    ''' Worker of preloadIndex(). '''
+    if threads is None:
+        threads = min(len(paths) // max(minEntries, 1), PRELOAD_MAX_THREADS)
+    threads = min(threads, len(paths))
+    if threads <= 1:
+        return dict(zip(paths, lstatPaths(paths)))
+
+    chunkSize = -(-len(paths) // threads)
+    chunks = [paths[i:i + chunkSize] for i in range(0, len(paths), chunkSize)]
+    stats = {}
+    with workerPool(threads, 'thread') as executor:
+        for chunk, chunkStats in zip(chunks, executor.map(lstatPaths, chunks)):
+            stats.update(zip(chunk, chunkStats))
+    return stats
+
+def lstatPaths(paths):
+    ''' Worker of preloadIndex(), os.lstat() of every path, None if gone. '''
+    stats = []
+    for path in paths:
+        try:
+            stats.append(os.lstat(workPath(path)))
+        except (FileNotFoundError, NotADirectoryError):
+            stats.append(None)
+    return stats
+
+def getStatus(preloadThreads = None):
     ''' Get status of working tree, return (changedPaths, newPaths, delPath)
-        as a tuple. '''
-    paths = set()
-    ''' > for root, dirs, files in os.walk('.'):
-          ...  dirs[:] = [d for d in dirs if d != '.fkgit']
-          ...  print("root = ", root, ", dirs = ", dirs, ", files = ", files)
-          ...
-          root =  . , dirs =  ['deer', 'lala'] , files =  ['demo.py',
-                                    'main.cpp', 'indexcat.py', 'fkgit.py']
-          root =  ./deer , dirs =  [] , files =  ['data.txt', 'raw.txt']
-          root =  ./lala , dirs =  [] , files =  []
-    '''
-    for root, dirs, files in os.walk('.'):
-        # omit dir '.fkgit'
-        dirs[:] = [d for d in dirs if d != baseName]
-        for file in files:
-            path = os.path.join(root, file)
-            if path.startswith('./'):
-                path = path[2:]
-            paths.add(path)
-    ''' entries_by_path = {e.path: e for e in read_index()} =
-        {'indexcat.py': IndexEntry(..., ..., path='indexcat.py'),
-        'main.cpp': IndexEntry(..., ..., path='main.cpp')}
-    '''
-    # type(entries_by_path) = <class 'dict'>, convert to Key -> Value.
-    entriesByPath = {entry.path: entry for entry in readIndex()}
-    # entryPaths = {'indexcat.py', 'main.cpp'}
-    entryPaths = set(entriesByPath)
+        as a tuple. Index entries are lstat-ed by 'preloadThreads' threads,
+        see preloadIndex(). Files hashed because their stat data changed but
+        not their content get the new stat data written back to the index,
+        as 'git status' does, so they are not hashed again next time.
+    '''
+    index = readIndex(verify = False)
+    paths = index.paths()
+    # entryPaths = {'indexcat.py': 0, 'main.cpp': 1}, path -> position.
+    entryPaths = {path: i for i, path in enumerate(paths)}
+    indexMtime = getIndexMtime()
+
+    # ask fsmonitor first, what changes while we scan shows up next time.
+    fsmonitorData = index.extensions.get(b'FSMN')
+    # paths changed since last status, None if everything must be checked.
+    fsmonitorPaths = None
+    if fsmonitorData is not None:
+        token, dirty = parseFsmonitor(fsmonitorData)
+        with tracePhase('fsmonitor'):
+            reply = queryFsmonitor(token)
+        if reply is not None:
+            token, fsmonitorPaths = reply
+
+    untrackedData = index.extensions.get(b'UNTR')
+    if untrackedData is None:
+        walkPaths = set()
+        ''' > for root, dirs, files in os.walk('.'):
+              ...  dirs[:] = [d for d in dirs if d != '.fkgit']
+              ...  print("root = ", root, ", dirs = ", dirs, ", files = ", files)
+              ...
+              root =  . , dirs =  ['deer', 'lala'] , files =  ['demo.py',
+                                        'main.cpp', 'indexcat.py', 'fkgit.py']
+              root =  ./deer , dirs =  [] , files =  ['data.txt', 'raw.txt']
+              root =  ./lala , dirs =  [] , files =  []
+        '''
+        matcher = IgnoreMatcher()
+        top = workPath('.')
+        with tracePhase('walk'):
+            for root, dirs, files in os.walk(top):
+                # './deer' -> 'deer/', same form as index paths.
+                dirPath = root[len(top) + 1:] + '/' if root != top else ''
+                # omit dir '.fkgit' and never walk into ignored ones.
+                dirs[:] = [d for d in dirs if d != baseName and
+                           not matcher.isIgnored(dirPath + d, True)]
+                walkPaths.update(dirPath + file for file in files
+                                 if not matcher.isIgnored(dirPath + file))
+                if trace:
+                    trace.count('dirsListed')
+        # only two set() can minus each other.
+        newFiles = walkPaths - entryPaths.keys()
+    else:
+        # no walk, directories unchanged since last time are not listed.
+        cache = parseUntrackedCache(untrackedData)
+        dirtyDirs = None
+        if fsmonitorPaths is not None:
+            # 'deer/raw.txt' -> 'deer/', a path may be a directory too.
+            dirtyDirs = {path[:path.rfind('/') + 1] for path in fsmonitorPaths}
+            dirtyDirs.update(path + '/' for path in fsmonitorPaths)
+        with tracePhase('walk'):
+            newFiles = scanUntracked(cache, entryPaths, indexMtime, dirtyDirs)
+
+    # entries not reported by fsmonitor are known clean, skip them.
+    if fsmonitorPaths is None:
+        candidates = paths
+    else:
+        candidates = fsmonitorCandidates(paths, dirty, fsmonitorPaths)
+    # path -> os.lstat() of files both in working tree and index.
+    trackedStats = {}
+    deletedFiles = set()
+    for path, st in preloadIndex(candidates, preloadThreads).items():
+        if st is None or stat.S_ISDIR(st.st_mode):
+            deletedFiles.add(path)
+            continue
+        trackedStats[path] = st
 
     changedFiles = set()
+    # path -> IndexEntry with fresh stat data, for the index written back.
+    refreshed = {}
     # check if SHA1 of the file has changed.
     # binascii.hexlify(entries_by_path['main.cpp'].sha1).decode('utf-8') =
     # '0c0251e09e7961f99273a5a8e953f651eb5f3d59'
-    for path in (paths & entryPaths):
-        sha1 = hashObject(readFile(path), 'blob', write = False)
-        oriSHA1 = \
-            binascii.hexlify(entriesByPath[path].sha1).decode('utf-8')
+    for path, st in trackedStats.items():
+        entry = index[entryPaths[path]]
+        # stat data unchanged since 'add', no need to read and hash it.
+        if isStatClean(entry, st, indexMtime):
+            continue
+        try:
+            sha1 = hashFile(workPath(path), 'blob', write = False)
+        except FileChangedError:
+            # being written right now, not what the index has.
+            changedFiles.add(path)
+            continue
+        oriSHA1 = binascii.hexlify(entry.sha1).decode('utf-8')
         if sha1 != oriSHA1:
             changedFiles.add(path)
-    # only two set() can minus each other.
-    newFiles = paths - entryPaths
-    deletedFiles = entryPaths - paths
+            # changed within the second of the last index write, its stat
+            # data still matches: a newer index would make it look clean,
+            # zero its size as git does, so it never does.
+            if isStatClean(entry, st):
+                refreshed[path] = entry._replace(size = 0)
+        elif treeMode(st.st_mode) == entry.mode:
+            # same content, keep its new stat data: not hashed next time.
+            refreshed[path] = refreshIndexEntry(entry, st)
     #print(changedFiles, newFiles, deletedFiles)
 
+    extensions = dict(index.extensions)
+    if untrackedData is not None:
+        extensions[b'UNTR'] = cache.encode()
+    if fsmonitorData is not None:
+        # not clean now, so check them again next time.
+        extensions[b'FSMN'] = encodeFsmonitor(token, [
+                path in changedFiles or path in deletedFiles
+                for path in paths])
+    if refreshed or extensions != index.extensions:
+        # the index is written in this second or later, an entry modified
+        # in it is racy there: smudged, so it is hashed again, not trusted.
+        racyTime = int(time.time()) & 0xffffffff
+        entries = []
+        for entry in index:
+            entry = refreshed.get(entry.path, entry)
+            if entry.path in refreshed and entry.mtime_s >= racyTime:
+                entry = entry._replace(size = 0)
+            entries.append(entry)
+        # refreshed only if no one changed the index since it was read.
+        writeIndex(entries, index.version, extensions, index.data[-20:])
+
     return (sorted(changedFiles), sorted(newFiles), sorted(deletedFiles))
 
-def status():
+def status(preloadThreads = None):
     ''' The upper function of getStatus(). In case the latter is too large. '''
-    changed, new, deleted = getStatus()
+    changed, new, deleted = getStatus(preloadThreads)
     if changed:
         print('changed files:')
         for path in changed:
@@ -414,40 +3177,201 @@ def status():
         for path in deleted:
             print('   ', path)
 
-def add(paths):
-    ''' Add files to 'stage', same as 'git add main.cpp'. '''
-    entriesByPath = {entry.path: entry for entry in readIndex()}
+@indexLocked
+def add(paths, jobs = None, poolType = 'process', preloadThreads = None):
+    ''' Add files to 'stage', same as 'git add main.cpp'.
+        Blobs are hashed, compressed and written by a pool of 'jobs' workers,
+        'process' pool for zlib-heavy work or 'thread' pool for slow I/O.
+        Tracked paths are lstat-ed first by 'preloadThreads' threads, the
+        ones with clean stat data are not hashed again.
+    '''
+    index = readIndex()
+    entriesByPath = {entry.path: entry for entry in index}
+    cacheTree = parseCacheTree(index.extensions.get(b'TREE'))
+    untrackedData = index.extensions.get(b'UNTR')
+    untrackedCache = untrackedData and parseUntrackedCache(untrackedData)
     entries = []
 
     # type(paths) = <class 'list'>
+    # './deer/raw.txt' -> 'deer/raw.txt', same form as getStatus().
+    paths = [os.path.normpath(path) for path in paths]
+    indexMtime = getIndexMtime()
+    trackedStats = preloadIndex([path for path in paths
+                                 if path in entriesByPath], preloadThreads)
+    paths = [path for path in paths if trackedStats.get(path) is None or
+             not isStatClean(entriesByPath[path], trackedStats[path],
+                             indexMtime)]
+    try:
+        hashed = hashPaths(paths, jobs, poolType)
+    except FileChangedError as error:
+        errMsg(error)
     # make sure git add XX did not affect the others already in index file.
-    for path in paths:
-        sha1 = hashObject(readFile(path), 'blob', True)
-        ''' os.stat(path) = os.stat_result(st_mode=33204, st_ino=195100843,
-            st_dev=64512, st_nlink=1, st_uid=1000, st_gid=1000, st_size=82,
-            st_atime=1505454057, st_mtime=1505453832, st_ctime=1505453832).
-        '''
-        st = os.stat(path)
-        # Default encoding is 'utf-8'
-        # 0 0 00 {12 bit} -> 'name length', 16 bit total.
-        flags = len(path.encode('utf-8'))
-        # only case lowest 12 bit(name length) not overflow.
-        assert flags < (1 << 12)
-        entry = IndexEntry(
-                int(st.st_ctime), 0, int(st.st_mtime), 0, st.st_dev, st.st_ino,
-                st.st_mode, st.st_uid, st.st_gid, st.st_size, bytes.fromhex(sha1),
-                flags, path)
+    for path, sha1, st in hashed:
+        entry = newIndexEntry(path, st, sha1)
+        oldEntry = entriesByPath.get(path)
+        # only the trees above a changed entry need hashing again.
+        if oldEntry is None or oldEntry.sha1 != entry.sha1 or \
+                oldEntry.mode != entry.mode:
+            cacheTree.invalidate(path)
+        if oldEntry is None and untrackedCache:
+            untrackedCache.root.invalidate(path)
         entriesByPath[path] = entry
     entries = list(entriesByPath.values())
     entries.sort(key = operator.attrgetter('path'))
-    writeIndex(entries)
+    extensions = dict(index.extensions)
+    extensions[b'TREE'] = cacheTree.encode()
+    if untrackedCache:
+        extensions[b'UNTR'] = untrackedCache.encode()
+    if b'FSMN' in extensions:
+        # bits go by entry position, which moves as entries are added.
+        token, dirty = parseFsmonitor(extensions[b'FSMN'])
+        dirtyPaths = {path for path, isDirty in zip(index.paths(), dirty)
+                      if isDirty}
+        extensions[b'FSMN'] = encodeFsmonitor(token,
+                [entry.path in dirtyPaths for entry in entries])
+    writeIndex(entries, index.version, extensions)
+
+# paths per pool worker when jobs is not given, a pool costs more to start
+# than hashing a few files in this process.
+HASH_MIN_PATHS = 64
+
+def hashPaths(paths, jobs = None, poolType = 'process'):
+    ''' Hash and write blob of every path, return list of (path, sha1, stat)
+        in the same order as paths whatever the pool finishes first. By
+        default one worker per HASH_MIN_PATHS paths up to cpu count, no
+        pool below twice that.
+    '''
+    if jobs is None:
+        jobs = min(len(paths) // HASH_MIN_PATHS, os.cpu_count() or 1)
+    jobs = min(jobs, len(paths))
+    if jobs <= 1:
+        return [hashPath(path) for path in paths]
 
-def writeIndex(entries):
-    ''' Write IndexEntry objects to fkgit index file. '''
-    # read before write, see if the path already exists.
+    # batch small files together, ipc per path is more than the hashing.
+    chunkSize = max(1, len(paths) // (jobs * 4))
+    with workerPool(jobs, poolType) as executor:
+        # executor.map() yields results in order of paths.
+        return list(executor.map(hashPath, paths, chunksize = chunkSize))
+
+def hashPath(path):
+    ''' Worker of hashPaths(), write blob of path to object store. '''
+    ''' os.stat(path) = os.stat_result(st_mode=33204, st_ino=195100843,
+        st_dev=64512, st_nlink=1, st_uid=1000, st_gid=1000, st_size=82,
+        st_atime=1505454057, st_mtime=1505453832, st_ctime=1505453832).
+    '''
+    # stat before read, a write in between then shows up as stat change.
+    st = os.stat(workPath(path))
+    sha1 = hashFile(workPath(path), 'blob', True)
+    return (path, sha1, st)
+
+def newIndexEntry(path, st, sha1):
+    ''' Build IndexEntry of path from its os.stat() result and hex sha1. '''
+    # Default encoding is 'utf-8'
+    # 0 0 00 {12 bit} -> 'name length', 16 bit total.
+    flags = len(path.encode('utf-8'))
+    # only case lowest 12 bit(name length) not overflow.
+    assert flags < (1 << 12)
+    return IndexEntry(mode = treeMode(st.st_mode), sha1 = bytes.fromhex(sha1),
+                      flags = flags, path = path, **statFields(st))
+
+def refreshIndexEntry(entry, st):
+    ''' Return entry with the stat data of st, content and flags kept. '''
+    return entry._replace(**statFields(st))
+
+def statFields(st):
+    ''' Stat fields of IndexEntry from an os.stat() result, as dict. '''
+    # st_ctime_ns = 1505453832123456789 -> (1505453832, 123456789)
+    ctimeS, ctimeN = divmod(st.st_ctime_ns, 10 ** 9)
+    mtimeS, mtimeN = divmod(st.st_mtime_ns, 10 ** 9)
+    # every stat field is stored as 32 bit, truncate as git does.
+    return {'ctime_s': ctimeS & 0xffffffff, 'ctime_n': ctimeN,
+            'mtime_s': mtimeS & 0xffffffff, 'mtime_n': mtimeN,
+            'dev': st.st_dev & 0xffffffff, 'ino': st.st_ino & 0xffffffff,
+            'uid': st.st_uid & 0xffffffff, 'gid': st.st_gid & 0xffffffff,
+            'size': st.st_size & 0xffffffff}
+
+def getIndexMtime():
+    ''' Return mtime of index file as (seconds, nanoseconds), or None. '''
+    try:
+        st = os.stat(gitPath('index'))
+    except FileNotFoundError:
+        return None
+    return divmod(st.st_mtime_ns, 10 ** 9)
+
+def isStatClean(entry, st, indexMtime = None):
+    ''' Check whether the stat data of a file still matches its IndexEntry,
+        so the file can be treated as unchanged without hashing it.
+    '''
+    if stat.S_IFMT(st.st_mode) != stat.S_IFMT(entry.mode):
+        return False
+    # only the executable bit is tracked for regular files.
+    if (st.st_mode ^ entry.mode) & 0o100:
+        return False
+    mtimeS, mtimeN = divmod(st.st_mtime_ns, 10 ** 9)
+    ctimeS, ctimeN = divmod(st.st_ctime_ns, 10 ** 9)
+    if (mtimeS & 0xffffffff, mtimeN) != (entry.mtime_s, entry.mtime_n):
+        return False
+    if (ctimeS & 0xffffffff, ctimeN) != (entry.ctime_s, entry.ctime_n):
+        return False
+    if (st.st_size & 0xffffffff) != entry.size:
+        return False
+    if (st.st_ino & 0xffffffff) != entry.ino or \
+            (st.st_dev & 0xffffffff) != entry.dev:
+        return False
+    # Racy clean: the file was modified in the same (or later) timestamp
+    # the index was written, a later write within that time slot would
+    # leave the stat data untouched. Only trust the content hash then.
+    if indexMtime is not None and \
+            entry.mtime_s >= (indexMtime[0] & 0xffffffff):
+        return False
+    return True
+
+def getIndexVersion():
+    ''' Return version of the current index file, 2 if there is none. '''
+    try:
+        with open(gitPath('index'), 'rb') as file:
+            sigh, ver = struct.unpack('>4sL', file.read(8))
+    except (FileNotFoundError, struct.error):
+        return 2
+    return ver if sigh == b'DIRC' and ver in (2, 3, 4) else 2
+
+def writeIndex(entries, version = None, extensions = None,
+               baseChecksum = None):
+    ''' Write IndexEntry objects to fkgit index file, in given version (2, 3
+        or 4), or the version of the current index file if None.
+        extensions is {b'TREE': data, ...}, written after the entries.
+        With baseChecksum, the checksum of the index the entries come from,
+        the write is only a refresh: skipped, returning False, if another
+        process holds index.lock or the index has changed since.
+    '''
+    indexLockState = repoState().indexLock
+    if baseChecksum is not None and indexLockState['path'] is None:
+        indexLockState['path'] = lockIndex()
+        if indexLockState['path'] is None:
+            return False
+        if readIndexChecksum(gitPath('index')) != \
+                baseChecksum:
+            unlockIndex()
+            return False
+    with tracePhase('index-write'):
+        writeIndexFile(entries, version, extensions)
+    return True
+
+def writeIndexFile(entries, version, extensions):
+    ''' Worker of writeIndex(). '''
+    if version is None:
+        version = getIndexVersion()
+    entries = list(entries)
+    # extended flags need v3 at least, same as git.
+    if version == 2 and any(entry.extFlags for entry in entries):
+        version = 3
 
     packedEntries = []
+    prevPath = b''
     for entry in entries:
+        flags = entry.flags & ~INDEX_FLAG_EXTENDED
+        if entry.extFlags:
+            flags |= INDEX_FLAG_EXTENDED
         # >: big-endian, std. size & alignment
         # L:unsigned long
         # s:string (array of char)
@@ -458,14 +3382,27 @@ def writeIndex(entries):
         entryData = struct.pack('>LLLLLLLLLL20sH',
                 entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n,
                 entry.dev, entry.ino, entry.mode, entry.uid, entry.gid,
-                entry.size, entry.sha1, entry.flags)
+                entry.size, entry.sha1, flags)
+        if entry.extFlags:
+            entryData += struct.pack('>H', entry.extFlags)
         # 'main.cpp' -> b'main.cpp'
         path = entry.path.encode('utf-8')
+        if version == 4:
+            # strip what differs from previous path, keep common prefix.
+            common = 0
+            maxCommon = min(len(path), len(prevPath))
+            while common < maxCommon and path[common] == prevPath[common]:
+                common += 1
+            packedEntries.append(entryData +
+                    encodeOffsetVarint(len(prevPath) - common) +
+                    path[common:] + b'\x00')
+            prevPath = path
+            continue
         ''' 1-8 nul bytes as necessary to pad the this entry to a multiple of
             eight bytes while keeping the name NUL-terminated.
         '''
         # math.floor 70 / 8 = 8.75, 70 // 8 = 8
-        # len(entryData) = 62 = 10 * 4 + 20 + 2
+        # len(entryData) = 62 = 10 * 4 + 20 + 2, 64 with extended flags.
         entryDataLen = len(entryData)
         pathLen = len(path)
         # calculate how many b'\x00' will be appeded after file name.
@@ -473,14 +3410,23 @@ def writeIndex(entries):
         packedEntry = entryData + path + b'\x00' * (trueLen - entryDataLen - pathLen)
         packedEntries.append(packedEntry)
     # | DIRC        | Version      | File count  | ...       |
-    packHeader = struct.pack('>4sLL', b'DIRC', 2, len(entries))
+    packHeader = struct.pack('>4sLL', b'DIRC', version, len(entries))
     # The result is returned as a new bytes object.
     # Example: b'.'.join([b'ab', b'pq', b'rs']) -> b'ab.pq.rs'.
     # bytes + b''.join(list) => bytes
     allData = packHeader + b''.join(packedEntries)
+    # | Ext-Sig     | Ext-Size     | Ext-Data |
+    for extSig, extData in (extensions or {}).items():
+        allData += struct.pack('>4sL', extSig, len(extData)) + bytes(extData)
     indexSha1 = hashlib.sha1(allData).digest()
     allData += indexSha1
-    writeFile(os.path.join(baseName, 'index'), allData)
+    # written into index.lock and renamed over the index, which may be
+    # memory-mapped by a reader, the lock goes with the rename.
+    with IndexLock():
+        indexLockState = repoState().indexLock
+        writeFile(indexLockState['path'], allData)
+        os.replace(indexLockState['path'], gitPath('index'))
+        indexLockState['path'] = None
 
 def hashObject(data, objType = 'blob', write = False):
     ''' Compute sha1 hashcode of specified file and write data to object
@@ -492,19 +3438,705 @@ def hashObject(data, objType = 'blob', write = False):
     header = "{} {}".format(objType, len(data)).encode('utf-8')
     fullData = header + b'\x00' + data
     # 0c0251e09e7961f99273a5a8e953f651eb5f3d59
-    sha1 = hashlib.sha1(fullData).hexdigest()
+    with tracePhase('hash'):
+        sha1 = hashlib.sha1(fullData).hexdigest()
+    if trace:
+        trace.count('bytesHashed', len(data))
 
     if write:
         # .git/objects/0c/0251e09e7961f99273a5a8e953f651eb5f3d59
-        path = os.path.join(baseName, 'objects', sha1[:2], sha1[2:])
-        dirName = os.path.dirname(path)
+        path = gitPath('objects', sha1[:2], sha1[2:])
+        # objects are immutable, an existing one is already what we want.
         if not os.path.exists(path):
-            os.makedirs(dirName, exist_ok = True)
-        # zlib compress the data to be stored.
-        zlibData = zlib.compress(fullData)
-        writeFile(path, zlibData)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            # zlib compress the data to be stored.
+            with tracePhase('zlib-compress'):
+                zlibData = zlib.compress(fullData)
+            writeFileAtomic(path, zlibData)
+            if trace:
+                trace.count('objectsWritten')
     return sha1
 
+class FileChangedError(Exception):
+    ''' File size changed while hashFile() read it. '''
+
+def hashFile(path, objType = 'blob', write = False):
+    ''' Same as hashObject(readFile(path), ...), but streams the file in
+        chunks so memory stays flat for files of any size.
+    '''
+    if trace:
+        trace.count('filesHashed')
+    # compress of written blobs is inside, chunks are too small to time.
+    with tracePhase('hash-file'):
+        return hashFileData(path, objType, write)
+
+def hashFileData(path, objType, write):
+    ''' Worker of hashFile(). '''
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if trace:
+            trace.count('bytesHashed', size)
+        header = "{} {}".format(objType, size).encode('utf-8')
+        sha1 = hashlib.sha1(header + b'\x00')
+        if not write:
+            for chunk in iter(lambda: file.read(streamChunkSize), b''):
+                sha1.update(chunk)
+                size -= len(chunk)
+            if size != 0:
+                raise FileChangedError("File {} Changed While Hashing.".format(
+                                       path))
+            return sha1.hexdigest()
+
+        import tempfile
+        # hash is unknown till the end, compress into a temp file first.
+        objDir = gitPath('objects')
+        fd, tmpPath = tempfile.mkstemp(prefix = 'tmp_obj_', dir = objDir)
+        try:
+            compressor = zlib.compressobj()
+            with os.fdopen(fd, 'wb') as tmpFile:
+                tmpFile.write(compressor.compress(header + b'\x00'))
+                for chunk in iter(lambda: file.read(streamChunkSize), b''):
+                    sha1.update(chunk)
+                    tmpFile.write(compressor.compress(chunk))
+                    size -= len(chunk)
+                tmpFile.write(compressor.flush())
+            # the header has the size at open, the object would be corrupt.
+            if size != 0:
+                raise FileChangedError("File {} Changed While Hashing.".format(
+                                       path))
+
+            hexSha1 = sha1.hexdigest()
+            objPath = os.path.join(objDir, hexSha1[:2], hexSha1[2:])
+            if os.path.exists(objPath):
+                os.remove(tmpPath)
+            else:
+                os.makedirs(os.path.dirname(objPath), exist_ok = True)
+                os.replace(tmpPath, objPath)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+    return hexSha1
+
+''' Pack File (.git/objects/pack/pack-*.pack), version 2.
+      | PACK        | Version      | Object count |
+      | Object: type(3 bit) + size(varint) header, zlib data | ...
+      | Pack SHA-1 over all the above                         |
+
+    Pack Index (.git/objects/pack/pack-*.idx), version 2.
+      | \377tOc     | Version      | Fanout, 256 * 4 byte                |
+      | Sorted SHA-1, count * 20    | CRC32 of packed data, count * 4     |
+      | Offset, count * 4, MSB set => index into 8 byte large offsets    |
+      | Large offsets, n * 8        | Pack SHA-1    | Index SHA-1         |
+'''
+packTypeNums = {'commit': 1, 'tree': 2, 'blob': 3, 'tag': 4}
+packNumTypes = {num: name for name, num in packTypeNums.items()}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+packIdxMagic = b'\377tOc'
+
+class PackFile:
+    ''' A pack and its v2 index, both memory-mapped, read by offset. '''
+    def __init__(self, idxPath):
+        import mmap
+        self.idxPath = idxPath
+        self.packPath = idxPath[:-len('.idx')] + '.pack'
+        with open(self.idxPath, 'rb') as file:
+            self.idx = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        with open(self.packPath, 'rb') as file:
+            self.pack = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, ver = struct.unpack('>4sL', self.idx[0:8])
+        assert magic == packIdxMagic and ver == 2, \
+                "Error, Unsupported Pack Index {}".format(self.idxPath)
+        sigh, ver, self.count = struct.unpack('>4sLL', self.pack[0:12])
+        assert sigh == b'PACK' and ver in (2, 3), \
+                "Error, Invalid Pack File {}".format(self.packPath)
+        self.fanout = struct.unpack('>256L', self.idx[8:8 + 1024])
+        assert self.fanout[255] == self.count, "Error, Pack Count Not Match."
+        self.shaStart = 8 + 1024
+        self.crcStart = self.shaStart + 20 * self.count
+        self.offStart = self.crcStart + 4 * self.count
+        self.largeOffStart = self.offStart + 4 * self.count
+        # sorted offsets tell where every compressed object ends.
+        self.sortedOffsets = None
+
+    def sha1At(self, i):
+        ''' Binary SHA-1 of the i-th object in index order. '''
+        pos = self.shaStart + 20 * i
+        return self.idx[pos:pos + 20]
+
+    def offsetAt(self, i):
+        ''' Pack offset of the i-th object in index order. '''
+        pos = self.offStart + 4 * i
+        offset, = struct.unpack('>L', self.idx[pos:pos + 4])
+        if offset & 0x80000000:
+            pos = self.largeOffStart + 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack('>Q', self.idx[pos:pos + 8])
+        return offset
+
+    def findSha1(self, sha1):
+        ''' Return index position of binary sha1, or None. '''
+        lo = self.fanout[sha1[0] - 1] if sha1[0] else 0
+        hi = self.fanout[sha1[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midSha1 = self.sha1At(mid)
+            if midSha1 < sha1:
+                lo = mid + 1
+            elif midSha1 > sha1:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def findPrefix(self, hashCode):
+        ''' Return hex SHA-1 of all objects starting with hex prefix. '''
+        # an odd prefix 'abc' is searched as b'\xab\xc0', then filtered.
+        prefix = bytes.fromhex(hashCode[:len(hashCode) // 2 * 2])
+        if len(hashCode) % 2:
+            prefix += bytes([int(hashCode[-1], 16) << 4])
+        lo = self.fanout[prefix[0] - 1] if prefix[0] else 0
+        hi = self.fanout[prefix[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha1At(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.count:
+            hexSha1 = self.sha1At(lo).hex()
+            if not hexSha1.startswith(hashCode):
+                break
+            found.append(hexSha1)
+            lo += 1
+        return found
+
+    def objectEnd(self, offset):
+        ''' Offset right after the packed object starting at offset. '''
+        if self.sortedOffsets is None:
+            self.sortedOffsets = sorted(self.offsetAt(i)
+                                        for i in range(self.count))
+        i = bisect.bisect_right(self.sortedOffsets, offset)
+        if i < len(self.sortedOffsets):
+            return self.sortedOffsets[i]
+        return len(self.pack) - 20
+
+    def readRawAt(self, offset):
+        ''' Return (typeNum, size, dataStart, end) of the object at offset.
+            The object data is zlib compressed in pack[dataStart:end].
+        '''
+        byte = self.pack[offset]
+        typeNum = (byte >> 4) & 0b111
+        size = byte & 0b1111
+        shift = 4
+        pos = offset + 1
+        while byte & 0x80:
+            byte = self.pack[pos]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            pos += 1
+        return (typeNum, size, pos, self.objectEnd(offset))
+
+    def readDeltaBase(self, typeNum, pos):
+        ''' Parse base of a delta object whose header ends at pos.
+            Return (baseOffset or None, baseHexSha1 or None, dataStart).
+        '''
+        if typeNum == PACK_REF_DELTA:
+            return (None, self.pack[pos:pos + 20].hex(), pos + 20)
+        # OFS_DELTA, negative offset to the base.
+        negOffset, pos = decodeOffsetVarint(self.pack, pos)
+        return (negOffset, None, pos)
+
+    def readAt(self, offset):
+        ''' Read and inflate object at offset, return (type, data).
+            Delta chains are followed down to a cached or whole base, then
+            replayed upward, caching every object on the way.
+        '''
+        deltaBaseCache = repoState().deltaBaseCache
+        # deltas of the chain, from offset down to the base.
+        chain = []
+        while True:
+            cached = deltaBaseCache.get((self.packPath, offset))
+            if cached is not None:
+                objType, data = cached
+                break
+            typeNum, size, pos, end = self.readRawAt(offset)
+            if typeNum in packNumTypes:
+                objType = packNumTypes[typeNum]
+                with tracePhase('zlib-decompress'):
+                    data = zlib.decompress(self.pack[pos:end])
+                assert size == len(data), "Expect size {}, But Got {} bytes.".\
+                                        format(size, len(data))
+                break
+            if typeNum not in (PACK_OFS_DELTA, PACK_REF_DELTA):
+                errMsg("Unsupported Pack Object Type {}.".format(typeNum))
+            negOffset, baseSha1, pos = self.readDeltaBase(typeNum, pos)
+            with tracePhase('zlib-decompress'):
+                chain.append((offset, zlib.decompress(self.pack[pos:end])))
+            if negOffset is not None:
+                offset -= negOffset
+                continue
+            i = self.findSha1(bytes.fromhex(baseSha1))
+            if i is None:
+                # base of a REF_DELTA may live in another pack or loose.
+                objType, data = readObject(baseSha1)
+                break
+            offset = self.offsetAt(i)
+
+        if chain:
+            deltaBaseCache.put((self.packPath, offset), (objType, data))
+        for deltaOffset, delta in reversed(chain):
+            data = applyDelta(data, delta)
+            deltaBaseCache.put((self.packPath, deltaOffset), (objType, data))
+        return (objType, data)
+
+    def readHeaderAt(self, offset):
+        ''' Return (type, size) of the object at offset. A delta is not
+            applied, its result size is in the first bytes of the delta
+            and its type is that of the base at the end of the chain.
+        '''
+        size = None
+        while True:
+            typeNum, objSize, pos, end = self.readRawAt(offset)
+            if typeNum in packNumTypes:
+                return (packNumTypes[typeNum],
+                        objSize if size is None else size)
+            if typeNum not in (PACK_OFS_DELTA, PACK_REF_DELTA):
+                errMsg("Unsupported Pack Object Type {}.".format(typeNum))
+            negOffset, baseSha1, pos = self.readDeltaBase(typeNum, pos)
+            if size is None:
+                # two varints of at most 10 bytes: base size, result size.
+                with tracePhase('zlib-decompress'):
+                    head = zlib.decompressobj().decompress(
+                            self.pack[pos:min(end, pos + 4096)], 20)
+                _, headPos = decodeDeltaSize(head, 0)
+                size, _ = decodeDeltaSize(head, headPos)
+            if negOffset is not None:
+                offset -= negOffset
+                continue
+            i = self.findSha1(bytes.fromhex(baseSha1))
+            if i is None:
+                return (readObjectHeader(baseSha1)[0], size)
+            offset = self.offsetAt(i)
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+# bytes of delta bases cached per repository, deltaBaseCache of
+# RepositoryState, same default as git core.deltaBaseCacheLimit, 96 MiB.
+DELTA_BASE_CACHE_BYTES = 96 << 20
+
+''' Delta data (OFS_DELTA / REF_DELTA object content).
+      | Base size (varint) | Result size (varint) | Instructions ...  |
+    Copy from base:   1oooossss, offset/size bytes follow for every bit set.
+    Insert literal:   0nnnnnnn, n (1..127) bytes of data follow.
+'''
+# bytes per block of the base index when searching for copies.
+deltaBlockSize = 16
+
+def encodeDeltaSize(size):
+    ''' Little endian varint, 7 bit per byte. '''
+    out = bytearray()
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if size:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def decodeDeltaSize(delta, pos):
+    ''' Return (size, next pos) of varint at delta[pos]. '''
+    size = shift = 0
+    while True:
+        byte = delta[pos]
+        pos += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (size, pos)
+
+def applyDelta(base, delta):
+    ''' Rebuild the object from its base and delta data. '''
+    baseSize, pos = decodeDeltaSize(delta, 0)
+    resultSize, pos = decodeDeltaSize(delta, pos)
+    assert baseSize == len(base), "Error, Delta Base Size Not Match."
+    parts = []
+    deltaLen = len(delta)
+    while pos < deltaLen:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            parts.append(base[offset:offset + size])
+        elif op:
+            parts.append(delta[pos:pos + op])
+            pos += op
+        else:
+            errMsg("Invalid Delta Instruction 0.")
+    result = b''.join(parts)
+    assert resultSize == len(result), "Error, Delta Result Size Not Match."
+    return result
+
+def indexDeltaBase(base):
+    ''' Map every aligned block of base to its first offset. '''
+    index = {}
+    for offset in range(0, len(base) - deltaBlockSize + 1, deltaBlockSize):
+        index.setdefault(base[offset:offset + deltaBlockSize], offset)
+    return index
+
+def matchLength(base, baseOff, target, targetOff, limit):
+    ''' Length of common bytes from base[baseOff] and target[targetOff],
+        compared in growing slices instead of byte by byte. '''
+    length = 0
+    step = 64
+    while length < limit:
+        step = min(step, limit - length)
+        if base[baseOff + length:baseOff + length + step] == \
+                target[targetOff + length:targetOff + length + step]:
+            length += step
+            step *= 2
+        elif step > 1:
+            step //= 2
+        else:
+            break
+    return length
+
+def createDelta(base, target, baseIndex = None, maxSize = None):
+    ''' Return delta data turning base into target, or None if it would be
+        larger than maxSize. baseIndex is indexDeltaBase(base) if known.
+    '''
+    if baseIndex is None:
+        baseIndex = indexDeltaBase(base)
+    out = bytearray(encodeDeltaSize(len(base)) + encodeDeltaSize(len(target)))
+    targetLen = len(target)
+    baseLen = len(base)
+    # start of the pending literal bytes in target.
+    literal = 0
+    pos = 0
+
+    def flushLiteral(end):
+        for start in range(literal, end, 0x7f):
+            chunk = target[start:min(end, start + 0x7f)]
+            out.append(len(chunk))
+            out.extend(chunk)
+
+    while pos + deltaBlockSize <= targetLen:
+        baseOff = baseIndex.get(target[pos:pos + deltaBlockSize])
+        if baseOff is None:
+            pos += 1
+            continue
+        length = matchLength(base, baseOff, target, pos,
+                             min(baseLen - baseOff, targetLen - pos))
+        # grow the copy backward over literal bytes which also match.
+        while pos > literal and baseOff > 0 and \
+                base[baseOff - 1] == target[pos - 1]:
+            pos -= 1
+            baseOff -= 1
+            length += 1
+        flushLiteral(pos)
+        pos += length
+        literal = pos
+        while length:
+            size = min(length, 0xffffff)
+            op = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (baseOff >> (8 * i)) & 0xff
+                if byte:
+                    op |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = (size >> (8 * i)) & 0xff
+                if byte:
+                    op |= 0x10 << i
+                    args.append(byte)
+            out.append(op)
+            out.extend(args)
+            baseOff += size
+            length -= size
+        if maxSize is not None and len(out) > maxSize:
+            return None
+    flushLiteral(targetLen)
+    if maxSize is not None and len(out) > maxSize:
+        return None
+    return bytes(out)
+
+def packNameHash(name):
+    ''' Same as git pack_name_hash(), weighs the last characters of a path
+        most, so 'a/Makefile' and 'b/Makefile' sort next to each other. '''
+    hashVal = 0
+    for char in name.encode('utf-8'):
+        if char in b' \t\n\r':
+            continue
+        hashVal = ((hashVal >> 2) + (char << 24)) & 0xffffffff
+    return hashVal
+
+def getPacks():
+    ''' Return list of PackFile under objects/pack, cached per repository. '''
+    packDir = gitPath('objects', 'pack')
+    try:
+        mtime = os.stat(packDir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    packCache = repoState().packCache
+    if packCache['mtime'] != mtime:
+        loaded = {pack.idxPath: pack for pack in packCache['packs']}
+        packs = []
+        for name in sorted(os.listdir(packDir)):
+            idxPath = os.path.join(packDir, name)
+            if not name.endswith('.idx'):
+                continue
+            if not os.path.exists(idxPath[:-len('.idx')] + '.pack'):
+                continue
+            packs.append(loaded.pop(idxPath, None) or PackFile(idxPath))
+        # packs gone are not closed here, a reader on another thread may
+        # still be in one; their maps close when the last one drops them.
+        packCache['mtime'] = mtime
+        packCache['packs'] = packs
+    return packCache['packs']
+
+def readPackedObject(hexSha1):
+    ''' Read object with full hex SHA-1 from packs, return (type, data). '''
+    sha1 = bytes.fromhex(hexSha1)
+    for pack in getPacks():
+        i = pack.findSha1(sha1)
+        if i is not None:
+            return pack.readAt(pack.offsetAt(i))
+    raise ValueError("Object {!r} Not Found.".format(hexSha1))
+
+def readObjectHeader(sha1):
+    ''' Return (type, size) of object with full hex SHA-1, inflating only
+        as much as its header needs. ValueError if not found. '''
+    cached = repoState().objectCache.get(sha1)
+    if cached is not None:
+        return (cached[0], len(cached[1]))
+    path = gitPath('objects', sha1[:2], sha1[2:])
+    try:
+        with open(path, 'rb') as file:
+            decompressor = zlib.decompressobj()
+            head = b''
+            # 'blob 12345\0' comes out of the first few compressed bytes.
+            while b'\x00' not in head:
+                chunk = file.read(4096)
+                if not chunk:
+                    errMsg("Wrong Object File. Exit Now.")
+                with tracePhase('zlib-decompress'):
+                    head += decompressor.decompress(chunk, 64 - len(head))
+        objType, sizeStr = head[:head.index(b'\x00')].decode('utf-8').split()
+        return (objType, int(sizeStr))
+    except FileNotFoundError:
+        pass
+    binSha1 = bytes.fromhex(sha1)
+    for pack in getPacks():
+        i = pack.findSha1(binSha1)
+        if i is not None:
+            return pack.readHeaderAt(pack.offsetAt(i))
+    raise ValueError("Object {!r} Not Found.".format(sha1))
+
+def encodePackObjectHeader(typeNum, size):
+    ''' type(3 bit) + size(4 bit low), then 7 bit of size per byte. '''
+    byte = (typeNum << 4) | (size & 0b1111)
+    size >>= 4
+    header = bytearray()
+    while size:
+        header.append(byte | 0x80)
+        byte = size & 0x7f
+        size >>= 7
+    header.append(byte)
+    return bytes(header)
+
+def listLooseObjects():
+    ''' Return sorted hex SHA-1 of all loose objects. '''
+    objDir = gitPath('objects')
+    sha1s = []
+    for name in os.listdir(objDir):
+        if len(name) != 2 or not os.path.isdir(os.path.join(objDir, name)):
+            continue
+        for rest in os.listdir(os.path.join(objDir, name)):
+            if len(rest) == 38:
+                sha1s.append(name + rest)
+    return sorted(sha1s)
+
+def findDeltas(sha1s, window = 10, depth = 50):
+    ''' Sliding-window delta search in the git way: objects sorted by type,
+        path name hash and size (largest first), every object tries the
+        'window' objects before it as base, delta chains at most 'depth'.
+        Return {sha1: (baseSha1, delta)} for objects stored as delta.
+    '''
+    # path hints come from the trees being packed and from the index.
+    names = {}
+    infos = []
+    for sha1 in sha1s:
+        objType, data = readObject(sha1)
+        if objType == 'tree':
+            for _, path, childSha1 in readTree(data = data):
+                names.setdefault(childSha1, path)
+        infos.append((sha1, objType, len(data)))
+    for entry in readIndex():
+        names.setdefault(entry.sha1.hex(), entry.path)
+    infos.sort(key = lambda info: (info[1],
+               packNameHash(names.get(info[0], '')), -info[2], info[0]))
+
+    deltas = {}
+    depths = {}
+    # (sha1, objType, data, baseIndex) of the recent objects.
+    recent = collections.deque(maxlen = window)
+    for sha1, objType, size in infos:
+        if window <= 0 or size < 50:
+            continue
+        objType, data = readObject(sha1)
+        best = None
+        # same as git, a delta must save at least half of the object.
+        maxSize = size // 2 - 20
+        for baseSha1, baseType, base, baseIndex in reversed(recent):
+            if baseType != objType or depths.get(baseSha1, 0) >= depth:
+                continue
+            if size < len(base) // 32:
+                continue
+            delta = createDelta(base, data, baseIndex, maxSize)
+            if delta is not None:
+                best = (baseSha1, delta)
+                maxSize = len(delta) - 1
+        if best is not None:
+            deltas[sha1] = best
+            depths[sha1] = depths.get(best[0], 0) + 1
+        recent.append((sha1, objType, data, indexDeltaBase(data)))
+    return deltas
+
+def writePack(sha1s, window = 10, depth = 50, ofsDelta = True):
+    ''' Write objects of given hex SHA-1 into a new pack and its v2 index,
+        similar objects stored as OFS_DELTA (or REF_DELTA if not ofsDelta).
+        Return path of the pack file.
+    '''
+    import tempfile
+    deltas = findDeltas(sha1s, window, depth)
+    packDir = gitPath('objects', 'pack')
+    os.makedirs(packDir, exist_ok = True)
+    fd, tmpPack = tempfile.mkstemp(prefix = 'tmp_pack_', dir = packDir)
+    packSha1 = hashlib.sha1()
+    # (sha1, crc32, offset) of every object written.
+    written = []
+    offsets = {}
+    with os.fdopen(fd, 'wb') as file:
+        def emit(data):
+            packSha1.update(data)
+            file.write(data)
+            return len(data)
+
+        def writeObject(sha1, offset):
+            ''' Write sha1 at offset, its delta base first. '''
+            if sha1 in deltas:
+                baseSha1, delta = deltas[sha1]
+                if baseSha1 not in offsets:
+                    offset = writeObject(baseSha1, offset)
+                if ofsDelta:
+                    packed = encodePackObjectHeader(PACK_OFS_DELTA, len(delta))
+                    packed += encodeOffsetVarint(offset - offsets[baseSha1])
+                else:
+                    packed = encodePackObjectHeader(PACK_REF_DELTA, len(delta))
+                    packed += bytes.fromhex(baseSha1)
+                packed += zlib.compress(delta)
+            else:
+                objType, data = readObject(sha1)
+                packed = encodePackObjectHeader(packTypeNums[objType], len(data))
+                packed += zlib.compress(data)
+            offsets[sha1] = offset
+            written.append((bytes.fromhex(sha1), zlib.crc32(packed), offset))
+            return offset + emit(packed)
+
+        offset = emit(struct.pack('>4sLL', b'PACK', 2, len(sha1s)))
+        for sha1 in sha1s:
+            if sha1 not in offsets:
+                offset = writeObject(sha1, offset)
+        trailer = packSha1.digest()
+        file.write(trailer)
+
+    written.sort()
+    fanout = [0] * 256
+    for sha1, _, _ in written:
+        fanout[sha1[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    idxOffsets = []
+    largeOffsets = []
+    for _, _, offset in written:
+        if offset < 0x80000000:
+            idxOffsets.append(offset)
+        else:
+            idxOffsets.append(0x80000000 | len(largeOffsets))
+            largeOffsets.append(offset)
+    idxData = struct.pack('>4sL', packIdxMagic, 2)
+    idxData += struct.pack('>256L', *fanout)
+    idxData += b''.join(sha1 for sha1, _, _ in written)
+    idxData += struct.pack('>{}L'.format(len(written)),
+                           *[crc for _, crc, _ in written])
+    idxData += struct.pack('>{}L'.format(len(idxOffsets)), *idxOffsets)
+    idxData += struct.pack('>{}Q'.format(len(largeOffsets)), *largeOffsets)
+    idxData += trailer
+    idxData += hashlib.sha1(idxData).digest()
+
+    # .git/objects/pack/pack-${sha1}.{pack,idx}, idx last so readers only
+    # see the pack once it is complete.
+    packPath = os.path.join(packDir, 'pack-{}.pack'.format(trailer.hex()))
+    os.replace(tmpPack, packPath)
+    writeFileAtomic(packPath[:-len('.pack')] + '.idx', idxData)
+    return packPath
+
+def repack(allObjects = False, delete = False, window = 10, depth = 50,
+           ofsDelta = True):
+    ''' Pack loose objects (and objects of existing packs if allObjects) into
+        a new pack, optionally removing what was packed.
+    '''
+    oldPacks = list(getPacks()) if allObjects else []
+    sha1s = set(listLooseObjects())
+    for pack in oldPacks:
+        sha1s.update(pack.sha1At(i).hex() for i in range(pack.count))
+    if not sha1s:
+        print("Nothing to Pack.")
+        return None
+    packPath = writePack(sorted(sha1s), window, depth, ofsDelta)
+    print("Packed [{}] Objects into {}".format(len(sha1s), packPath))
+    writeCommitGraph()
+
+    if delete:
+        import errno
+        objDir = gitPath('objects')
+        emptied = set()
+        for sha1 in listLooseObjects():
+            if sha1 in sha1s:
+                os.remove(os.path.join(objDir, sha1[:2], sha1[2:]))
+                emptied.add(sha1[:2])
+        # drop objects/xx left empty, or every scan of loose objects still
+        # lists them. Objects written meanwhile keep theirs.
+        for prefix in sorted(emptied):
+            try:
+                os.rmdir(os.path.join(objDir, prefix))
+            except OSError as error:
+                if error.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+        for pack in oldPacks:
+            if pack.packPath == packPath:
+                continue
+            pack.close()
+            # drop idx first, then no reader will open its pack.
+            os.remove(pack.idxPath)
+            os.remove(pack.packPath)
+    return packPath
+
 def readFile(path):
     ''' Read file as bytes at given path. '''
     with open(path, "rb") as file:
@@ -516,6 +4148,13 @@ def writeFile(path, data):
     with open(path, "wb") as file:
         file.write(data)
 
+def writeFileAtomic(path, data):
+    ''' Write bytes to a temp file then rename to path, so that concurrent
+        writers and readers never see a partial file. '''
+    tmpPath = '{}.tmp{}.{}'.format(path, os.getpid(), threading.get_ident())
+    writeFile(tmpPath, data)
+    os.replace(tmpPath, path)
+
 def init(repo):
     ''' Init .fkgit associated files. '''
     global baseName
@@ -533,25 +4172,508 @@ def init(repo):
     else:
         print("Warnning: Repository {} Not Empty.".format(baseName))
 
-def addFilesInDir(newPaths, path):
-    ''' Add all files recursively under the dir. '''
-    if not os.path.isdir(path):
+def expandAddPaths(param, preloadThreads = None):
+    ''' Return files 'fkgit add param...' adds: directories expanded, ignored
+        and swap files left out. '''
+    newPaths  = []
+    index = readIndex(verify = False)
+    matcher = IgnoreMatcher()
+    if param == list('.') and b'FSMN' in index.extensions:
+        # fsmonitor knows what changed, no need to hash everything.
+        changed, new, _ = getStatus(preloadThreads)
+        newPaths = changed + new
+    elif param == list('.'):
+        # add support to 'git add .' for all files in current dir.
+        addFilesInDir(newPaths, '.', matcher, index.paths())
+    else:
+        trackedPaths = index.paths()
+        for path in param:
+            addFilesInDir(newPaths, path, matcher, trackedPaths)
+
+    # excluded post fix file, removing while iterating skips the next.
+    exPostfix = ['swp', 'swo']
+    return [file for file in newPaths
+            if file.split('.')[-1] not in exPostfix]
+
+def addFilesInDir(newPaths, path, matcher = None, trackedPaths = ()):
+    ''' Add all files recursively under the dir, except ignored ones. A file
+        named on its own is always added, so are tracked files in ignored
+        directories, as git does. '''
+    if not os.path.isdir(workPath(path)):
         newPaths.append(os.path.join('.', path))
         return
+    if matcher is None:
+        matcher = IgnoreMatcher()
 
-    for root, dirs, files in os.walk(path):
-        dirs[:] = [d for d in dirs if d != baseName]
-        if not (files == []):
-            for file in files:
+    # pruned directories, 'build/', tracked files below are added later.
+    prunedDirs = []
+    top = workPath('')
+    for root, dirs, files in os.walk(workPath(path)):
+        # relative to the work tree again, as path was given.
+        root = root[len(top):]
+        # 'deer/lala' -> 'deer/lala/', '.' -> '', as the rules expect.
+        dirPath = os.path.normpath(root) + '/'
+        dirPath = '' if dirPath == './' else dirPath
+        keptDirs = []
+        for d in dirs:
+            if d == baseName and not dirPath:
+                continue
+            if matcher.isIgnored(dirPath + d, True):
+                prunedDirs.append(dirPath + d + '/')
+            else:
+                keptDirs.append(d)
+        dirs[:] = keptDirs
+        for file in files:
+            if not matcher.isIgnored(dirPath + file):
                 newPaths.append(os.path.join(root, file))
+    if prunedDirs:
+        prunedDirs = tuple(prunedDirs)
+        newPaths.extend(trackedPath for trackedPath in trackedPaths
+                        if trackedPath.startswith(prunedDirs) and
+                        os.path.isfile(workPath(trackedPath)))
+
+''' Library API, fkgit embedded in a long running Python process.
+      repo = Repository('/src/proj')
+      repo.status().changed          -> ['main.cpp']
+      repo.readObject('HEAD')        -> ('commit', b'tree ...')
+      repo.diff()                    -> [FileDiff(path = 'main.cpp', ...)]
+    The functions above work on the repository of repoState(): the current
+    directory on the command line. A Repository holds a RepositoryState of
+    its own, with its work tree and its object, tree, pack and index
+    caches, and sets it for the thread running its call. Paths are made
+    by gitPath() and workPath() from that state, so neither the working
+    directory of the process nor a module global is changed: the parsed
+    index and inflated objects stay warm from call to call, and calls of
+    different repositories run side by side on their threads. Calls of
+    one repository take turns under its lock. Any error, errMsg() or an
+    exception, comes out as RepositoryError; nothing is printed.
+'''
+Status = collections.namedtuple('Status', ['changed', 'new', 'deleted'])
+ObjectInfo = collections.namedtuple('ObjectInfo', ['sha1', 'type', 'size'])
+FileDiff = collections.namedtuple('FileDiff', [
+    'path', 'oldMode', 'oldSha1', 'newMode', 'newSha1', 'patch'])
+DiffStat = collections.namedtuple('DiffStat', [
+    'path', 'insertions', 'deletions', 'binarySizes'])
+
+class RepositoryState:
+    ''' Where a repository is and its in-process caches, see above. '''
+    def __init__(self, top = ''):
+        # work tree, '' for the current directory: paths stay relative.
+        self.top = top
+        self.gitDir = os.path.join(top, baseName)
+        # inflated objects by hex SHA-1, (type, data).
+        self.objectCache = LRUCache(OBJECT_CACHE_BYTES)
+        # parsed trees by hex SHA-1, tuple of (mode, path, sha1).
+        self.treeCache = LRUCache(TREE_CACHE_BYTES, treeCacheSize)
+        # inflated pack objects by (pack path, offset), bases of deltas.
+        self.deltaBaseCache = LRUCache(DELTA_BASE_CACHE_BYTES)
+        self.looseObjectIndex = LooseObjectIndex()
+        # packs loaded so far, keyed by idx path; reloaded when pack dir
+        # changes.
+        self.packCache = {'mtime': None, 'packs': []}
+        # the commit graph loaded, reloaded when its file changes.
+        self.commitGraphCache = {'mtime': None, 'graph': None}
+        # CommitNode by hex SHA-1, filled by getCommitNode().
+        self.commitNodes = {}
+        # last Index read, reused while the file is the same: writeIndex()
+        # always renames a new file in place, so a new inode, and the
+        # mapped old one keeps its inode in use till the Index is dropped.
+        # A writer overwriting in place within the mtime granularity is
+        # caught by the trailing checksum.
+        self.indexCache = {'key': None, 'index': None, 'verified': False}
+        # path of index.lock while we hold it, depth of IndexLock blocks.
+        self.indexLock = {'path': None, 'depth': 0}
+
+# state of the command line, the current directory.
+defaultState = RepositoryState()
+# state is the RepositoryState of the Repository call running on this
+# thread, errMsg() raises inside one.
+repositoryCall = threading.local()
+
+def repoState():
+    ''' RepositoryState of this thread's Repository call, else default. '''
+    return getattr(repositoryCall, 'state', None) or defaultState
+
+def gitPath(*names):
+    ''' Path of names under .git, gitPath('objects', 'pack'). '''
+    return os.path.join(repoState().gitDir, *names)
+
+def workPath(path):
+    ''' Path to open work tree path ('deer/raw.txt') by: as it is on the
+        command line, under the work tree in a Repository call. '''
+    return os.path.join(repoState().top, path)
+
+def workerPool(jobs, poolType = 'process'):
+    ''' Return executor of jobs workers, 'process' or 'thread', whose tasks
+        run in the repository of this thread. '''
+    import concurrent.futures
+    state = getattr(repositoryCall, 'state', None)
+    if poolType == 'thread':
+        # threads share the state, and its caches.
+        return concurrent.futures.ThreadPoolExecutor(max_workers = jobs,
+                initializer = initWorker, initargs = (state,))
+    # a process gets caches of its own, only the work tree goes over.
+    return concurrent.futures.ProcessPoolExecutor(max_workers = jobs,
+            initializer = initWorker,
+            initargs = (state and state.top,))
+
+def initWorker(state):
+    ''' Initializer of workerPool() workers, state is a RepositoryState, a
+        work tree path or None for the command line. '''
+    if isinstance(state, str):
+        state = RepositoryState(state)
+    repositoryCall.state = state
+
+class RepositoryError(Exception):
+    ''' A Repository call failed, message as the command would print. '''
+
+class Repository:
+    ''' One work tree, see above. Diffs and adds run in this process unless
+        'jobs' asks for a pool. '''
+    def __init__(self, path = '.'):
+        self.path = os.path.realpath(path)
+        if not os.path.isdir(os.path.join(self.path, baseName)):
+            raise RepositoryError("Not a Repository: {}".format(self.path))
+        self.state = RepositoryState(self.path)
+        # calls of this repository share caches and index.lock, one at a
+        # time; calls of other repositories do not wait for it.
+        self.lock = threading.RLock()
+
+    def call(self, func, *args, **kwargs):
+        ''' Return func(*args, **kwargs) run in this repository, after the
+            calls of it already running. '''
+        with self.lock:
+            return self.readCall(func, *args, **kwargs)
+
+    def readCall(self, func, *args, **kwargs):
+        ''' Same as call(), for func only reading objects and the index:
+            runs alongside other calls. Objects never change, a parsed
+            Index is never changed, a newer one replaces it in the cache.
+        '''
+        saved = getattr(repositoryCall, 'state', None)
+        repositoryCall.state = self.state
+        try:
+            return func(*args, **kwargs)
+        except RepositoryError:
+            raise
+        except SystemExit as error:
+            raise RepositoryError("Exit Code {}.".format(
+                                  error.code)) from None
+        except Exception as error:
+            raise RepositoryError("{}: {}".format(
+                    type(error).__name__, error)) from error
+        finally:
+            repositoryCall.state = saved
+
+    def index(self):
+        ''' Return the Index, parsed again only if the file changed. '''
+        return self.readCall(readIndex, False)
+
+    def lsFiles(self):
+        ''' Return IndexEntry of every path in index, in index order. '''
+        return self.readCall(lambda: list(readIndex(verify = False)))
+
+    def status(self, preloadThreads = None):
+        ''' Return Status of working tree, lists of sorted paths. '''
+        return Status(*self.call(getStatus, preloadThreads))
+
+    def resolve(self, name):
+        ''' Return full SHA-1 of 'HEAD', a branch or a SHA-1 (prefix). '''
+        sha1, error = self.readCall(resolveBatchName, name)
+        if sha1 is None:
+            raise RepositoryError("Object {!r} {}.".format(name,
+                                                          error.title()))
+        return sha1
+
+    def readObject(self, name):
+        ''' Return (type, data) of object name, as resolve() takes it. '''
+        return self.readCall(readObject, self.resolve(name))
+
+    def objectInfo(self, name):
+        ''' Return ObjectInfo of object name, without inflating all of it. '''
+        sha1 = self.resolve(name)
+        return ObjectInfo(sha1, *self.readCall(readObjectHeader, sha1))
+
+    def diff(self, cached = False, commits = (), algorithm = 'myers',
+             jobs = 1, poolType = 'process'):
+        ''' Return FileDiff of every changed path, with git style patch
+            bytes, compared as diff() does. '''
+        def run():
+            pairs = diffPairsOf(cached, commits)
+            patches = diffPairs(diffFileWorker, pairs, algorithm, jobs,
+                                poolType)
+            return [FileDiff(*pair, patch)
+                    for pair, patch in zip(pairs, patches)]
+        # against the work tree, status may refresh the index.
+        if cached or len(commits) == 2:
+            return self.readCall(run)
+        return self.call(run)
+
+    def diffStat(self, cached = False, commits = (), algorithm = 'myers',
+                 jobs = 1, poolType = 'process'):
+        ''' Return DiffStat of every changed path. '''
+        def run():
+            pairs = diffPairsOf(cached, commits)
+            return [DiffStat(*stats) for stats in diffPairs(diffStatWorker,
+                    pairs, algorithm, jobs, poolType)]
+        if cached or len(commits) == 2:
+            return self.readCall(run)
+        return self.call(run)
+
+    def add(self, paths, jobs = 1, poolType = 'process'):
+        ''' Add paths (files or directories) to index, as 'fkgit add'.
+            Return the files added. '''
+        def run():
+            newPaths = expandAddPaths(list(paths))
+            add(newPaths, jobs, poolType)
+            return [os.path.normpath(path) for path in newPaths]
+        return self.call(run)
+
+    def commit(self, message):
+        ''' Commit index to master, return SHA-1 of the commit. '''
+        import io
+        return self.call(commit, message, io.StringIO())
+
+    def log(self, revision = 'HEAD', maxCount = None, paths = None):
+        ''' Return [(sha1, Commit)] from revision, newest first, only the
+            ones changing one of paths if given, as log() selects them. '''
+        def run():
+            stats = collections.Counter()
+            commits = []
+            for node in walkCommits([resolveRevision(revision)]):
+                if maxCount is not None and len(commits) >= maxCount:
+                    break
+                if paths and not any(pathChanged(node, path, stats)
+                                     for path in paths):
+                    continue
+                commits.append((node.sha1, readCommit(node.sha1)))
+            return commits
+        return self.readCall(run)
+
+    def cacheStats(self):
+        ''' Return counters of this repository's caches. '''
+        return self.readCall(cacheStats)
+
+''' Server mode, 'fkgit serve': Repository objects kept in one process and
+    asked over a unix socket, so a tool calling fkgit thousands of times
+    pays neither interpreter start nor index parsing each time. A request
+    is one JSON line, the reply to it is one JSON line, in order, many per
+    connection and any number of connections at once:
+      {"id": 1, "repo": "/src/proj", "command": "status"}
+      {"id": 1, "ok": true, "result": {"changed": [...], "new": [...],
+       "deleted": [...]}}
+      {"id": 2, "ok": false, "error": "Object 'x' Missing."}
+    Commands and their arguments (all optional but objects):
+      status      preloadThreads
+      ls-files                     -> [{path, mode, sha1, size}]
+      cat-file    objects [names], info (no data)
+                                   -> [{name, sha1, type, size, data}]
+                                      or [{name, error}] per object
+      diff        cached, commits, algorithm, stat
+                                   -> [{path, oldMode, oldSha1, newMode,
+                                       newSha1, patch}] or [{path,
+                                       insertions, deletions, binarySizes}]
+      ping                         -> null
+      stop                         shuts the server down
+    Bytes (data, patch) are base64. "repo" defaults to the directory the
+    server runs in. Every request runs on a thread of the event loop's
+    executor, so requests of all connections are answered concurrently:
+    each Repository holds its own state, requests of different
+    repositories never wait for each other. In one repository ls-files,
+    cat-file and diff of trees (cached or two commits) only read, and run
+    alongside anything; status and diff against the work tree may refresh
+    the index and take turns under the repository's lock. The parsed index
+    is dropped when the index file's stat or checksum changes, objects are
+    immutable and stay cached.
+'''
+# most repositories kept, the least recently used one is dropped.
+SERVE_MAX_REPOS = 16
+# a request line longer than this closes the connection.
+SERVE_MAX_LINE = 1 << 24
+
+def serveSocketPath():
+    ''' Default socket of 'fkgit serve', one per user: in $XDG_RUNTIME_DIR,
+        else in a fkgit-<uid> directory of tmp made 0700, which must be
+        ours and closed to others, or anyone could put a socket there. '''
+    runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtimeDir and os.path.isdir(runtimeDir):
+        return os.path.join(runtimeDir, 'fkgit-serve.sock')
+    import tempfile
+    sockDir = os.path.join(tempfile.gettempdir(),
+                           'fkgit-{}'.format(os.getuid()))
+    try:
+        os.mkdir(sockDir, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(sockDir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        errMsg("{} Is Not a Private Directory of Ours.".format(sockDir))
+    return os.path.join(sockDir, 'serve.sock')
+
+def encodeBytes(data):
+    ''' bytes as base64 str, to go in JSON. '''
+    import base64
+    return base64.b64encode(data).decode('ascii')
+
+class Server:
+    ''' Repositories and the request handling of 'fkgit serve'. '''
+    def __init__(self, maxRepos = SERVE_MAX_REPOS):
+        # realpath -> Repository, least recently used first.
+        self.repos = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.maxRepos = maxRepos
+        self.home = os.getcwd()
+
+    def repository(self, path):
+        ''' Return Repository of path, made on first use. '''
+        path = os.path.realpath(os.path.join(self.home, path or '.'))
+        # requests come from several executor threads.
+        with self.lock:
+            repo = self.repos.get(path)
+            if repo is None:
+                repo = Repository(path)
+                self.repos[path] = repo
+                while len(self.repos) > self.maxRepos:
+                    self.repos.popitem(last = False)
+            self.repos.move_to_end(path)
+            return repo
+
+    def handle(self, request):
+        ''' Return result of one request, RepositoryError if it failed. '''
+        command = request.get('command')
+        repo = self.repository(request.get('repo'))
+        if command == 'status':
+            return repo.status(request.get('preloadThreads'))._asdict()
+        if command == 'ls-files':
+            return [{'path': entry.path, 'mode': '{:o}'.format(entry.mode),
+                     'sha1': entry.sha1.hex(), 'size': entry.size}
+                    for entry in repo.lsFiles()]
+        if command == 'cat-file':
+            results = []
+            for name in request.get('objects') or ():
+                try:
+                    if request.get('info'):
+                        info = repo.objectInfo(name)
+                        results.append(dict(info._asdict(), name = name))
+                        continue
+                    sha1 = repo.resolve(name)
+                    objType, data = repo.readObject(sha1)
+                except RepositoryError as error:
+                    results.append({'name': name, 'error': str(error)})
+                    continue
+                results.append({'name': name, 'sha1': sha1, 'type': objType,
+                                'size': len(data), 'data': encodeBytes(data)})
+            return results
+        if command == 'diff':
+            args = (bool(request.get('cached')),
+                    tuple(request.get('commits') or ()),
+                    request.get('algorithm') or 'myers')
+            if args[2] not in DIFF_ALGORITHMS:
+                raise RepositoryError("Unknown Diff Algorithm {!r}.".format(
+                                      args[2]))
+            if request.get('stat'):
+                return [diffStat._asdict() for diffStat in repo.diffStat(*args)]
+            return [dict(fileDiff._asdict(), patch = encodeBytes(fileDiff.patch))
+                    for fileDiff in repo.diff(*args)]
+        raise RepositoryError("Unknown Command {!r}.".format(command))
+
+    async def serveClient(self, reader, writer):
+        ''' Answer the requests of one connection, in order. '''
+        import asyncio, json
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # longer than SERVE_MAX_LINE.
+                    break
+                if not line:
+                    break
+                reply = {}
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request Must Be a JSON Object.")
+                    reply['id'] = request.get('id')
+                    if request.get('command') in ('ping', 'stop'):
+                        reply.update(ok = True, result = None)
+                        if request['command'] == 'stop':
+                            self.stopped.set()
+                    else:
+                        result = await loop.run_in_executor(None,
+                                                            self.handle, request)
+                        reply.update(ok = True, result = result)
+                except Exception as error:
+                    # a bad request or repository must not end the server.
+                    reply.update(ok = False, error = str(error) or
+                                 type(error).__name__)
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # cancelled: the server stops, end quietly.
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, sockPath):
+        import asyncio
+        self.stopped = asyncio.Event()
+        # bound as 0600 right away, not chmod-ed after others could connect.
+        oldMask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.serveClient,
+                    sockPath, limit = SERVE_MAX_LINE)
+        finally:
+            os.umask(oldMask)
+        async with server:
+            await self.stopped.wait()
+
+def serve(sockPath = None, maxRepos = SERVE_MAX_REPOS):
+    ''' Run 'fkgit serve' on sockPath till a stop request. '''
+    import asyncio
+    sockPath = sockPath or serveSocketPath()
+    if os.path.exists(sockPath):
+        try:
+            serveRequest({'command': 'ping'}, sockPath)
+        except OSError:
+            # left by a server that died, nobody listens on it.
+            os.remove(sockPath)
+        else:
+            errMsg("fkgit serve Already Running on {}.".format(sockPath))
+    print("Serving on {}".format(sockPath))
+    sys.stdout.flush()
+    try:
+        asyncio.run(Server(maxRepos).run(sockPath))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(sockPath):
+            os.remove(sockPath)
+
+def serveRequest(request, sockPath = None):
+    ''' Send one request to 'fkgit serve', return its reply as dict. '''
+    import socket, json
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(sockPath or serveSocketPath())
+        conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with conn.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError("fkgit serve Closed the Connection.")
+    return json.loads(line)
 
 def errMsg(msg):
-    ''' Print Error Message. '''
+    ''' Print Error Message. Inside a Repository call, raise it instead. '''
+    if getattr(repositoryCall, 'state', None) is not None:
+        raise RepositoryError(msg)
     print("Error, {}".format(msg))
     sys.exit(1)
 
 if __name__ == '__main__':
     ''' The help message was referenced by git relative page. '''
+    import argparse
     parser = argparse.ArgumentParser()
     subParsers = parser.add_subparsers(dest = 'command')
     subParsers.required = True
@@ -559,11 +4681,26 @@ if __name__ == '__main__':
     # git init
     subParser = subParsers.add_parser('init', help = 'initialize a new repo')
 
+    # shared by status, diff and add.
+    preloadHelp = 'threads lstat-ing index entries, 1 for none (default: ' \
+                  'one per {} entries, at most {})'.format(
+                  PRELOAD_MIN_ENTRIES, PRELOAD_MAX_THREADS)
+
     # git add main.cpp indexcat.py
     subParser = subParsers.add_parser('add',
                                      help = 'Add file contents to the index')
     subParser.add_argument('paths', nargs = '+',
                                      help = 'path(s) of files to add')
+    subParser.add_argument('-j', '--jobs', type = int, default = None,
+            help = 'number of workers hashing files (default: one per {} '
+                 'files, at most cpu count)'.format(HASH_MIN_PATHS))
+    subParser.add_argument('--pool', choices = ['process', 'thread'],
+            default = 'process',
+            help = 'process pool for compression, thread pool for slow '
+                 'I/O (default %(default)r)')
+    subParser.add_argument('--preload-threads', type = int, default = None,
+            dest = 'preloadThreads',
+            help = preloadHelp)
 
     # git hash-object -t {commit,tree,blob}] [-w] <file_name>
     subParser = subParsers.add_parser('hash-object',
@@ -593,7 +4730,14 @@ if __name__ == '__main__':
                      dest = 'pretty', help = "pretty-print object's content")
     subParser.add_argument('-r', '--raw', action = 'store_true',
            dest = 'raw', help = "show raw data of object after decompressed")
-    subParser.add_argument('sha1', help = "SHA1 of the object")
+    subParser.add_argument('--batch', action = 'store_true',
+            help = 'print type, size and content of objects named on stdin')
+    subParser.add_argument('--batch-check', action = 'store_true',
+            dest = 'batchCheck',
+            help = 'print type and size of objects named on stdin')
+    subParser.add_argument('--buffer', action = 'store_true',
+            help = 'with --batch(-check), flush output only at the end')
+    subParser.add_argument('sha1', nargs = '?', help = "SHA1 of the object")
     subParser.required = False
 
     # git commit -m 'message'
@@ -606,40 +4750,137 @@ if __name__ == '__main__':
     subParser.add_argument('-m', '--message', required=True,
             help='text of commit message')
 
+    # git update-index --index-version 4
+    subParser = subParsers.add_parser('update-index',
+            help = 'rewrite the index file')
+    subParser.add_argument('--index-version', type = int, default = None,
+            choices = [2, 3, 4], dest = 'version',
+            help = 'index format version, 4 compresses path prefixes')
+    subParser.add_argument('--untracked-cache', action = 'store_true',
+            dest = 'untrackedCache',
+            help = 'keep untracked files of each directory in index')
+    subParser.add_argument('--no-untracked-cache', action = 'store_true',
+            dest = 'noUntrackedCache', help = 'drop the untracked cache')
+    subParser.add_argument('--fsmonitor', action = 'store_true',
+            help = 'ask fkgit fsmonitor for changed paths in status')
+    subParser.add_argument('--no-fsmonitor', action = 'store_true',
+            dest = 'noFsmonitor', help = 'stop asking fkgit fsmonitor')
+
+    # git fsmonitor--daemon
+    subParser = subParsers.add_parser('fsmonitor',
+            help = 'watch working tree with inotify, run till stopped')
+    subParser.add_argument('--stop', action = 'store_true',
+            help = 'stop the running fsmonitor')
+
+    # fkgit serve [--socket PATH]
+    subParser = subParsers.add_parser('serve',
+            help = 'answer requests on a unix socket, keeping repos in memory',
+            description = 'Answer JSON line requests on a unix socket, '
+                 'keeping repositories in memory. Requests of all '
+                 'connections are answered concurrently, status and diff '
+                 'against the work tree take turns within one repository.')
+    subParser.add_argument('--socket', default = None, dest = 'sockPath',
+            help = 'socket path (default: fkgit-serve.sock in '
+                 '$XDG_RUNTIME_DIR, else fkgit-<uid>/serve.sock in tmp)')
+    subParser.add_argument('--max-repos', type = int,
+            default = SERVE_MAX_REPOS, dest = 'maxRepos',
+            help = 'repositories kept in memory (default %(default)s)')
+    subParser.add_argument('--stop', action = 'store_true',
+            help = 'stop the running server')
+
+    # git repack [-a] [-d]
+    subParser = subParsers.add_parser('repack',
+            help = 'pack loose objects into a pack file')
+    subParser.add_argument('-a', action = 'store_true', dest = 'all',
+            help = 'also pack objects of existing packs into the new one')
+    subParser.add_argument('-d', action = 'store_true', dest = 'delete',
+            help = 'remove loose objects and old packs which got packed')
+    subParser.add_argument('--window', type = int, default = 10,
+            help = 'objects tried as delta base of each object '
+                 '(default %(default)r, 0 disables deltas)')
+    subParser.add_argument('--depth', type = int, default = 50,
+            help = 'max length of delta chains (default %(default)r)')
+    subParser.add_argument('--ref-delta', action = 'store_false',
+            dest = 'ofsDelta',
+            help = 'refer to delta bases by SHA-1 instead of pack offset')
+
+    # git log [-n 10] [--pretty oneline] [revision] [-- path ...]
+    subParser = subParsers.add_parser('log', help = 'show commit logs')
+    subParser.add_argument('revision', nargs = '?', default = 'HEAD',
+            help = 'commit to start from (default %(default)r)')
+    subParser.add_argument('-n', '--max-count', type = int, dest = 'maxCount',
+            help = 'limit the number of commits to output')
+    subParser.add_argument('--pretty', choices = ['medium', 'oneline', 'hash'],
+            default = 'medium', help = 'output format (default %(default)r)')
+    subParser.add_argument('--bloom-stats', action = 'store_true',
+            dest = 'bloomStats',
+            help = 'report how the changed-path Bloom filters did, to stderr')
+
+    # git merge-base [--is-ancestor] A B
+    subParser = subParsers.add_parser('merge-base',
+            help = 'find best common ancestors of two commits')
+    subParser.add_argument('--is-ancestor', action = 'store_true',
+            dest = 'isAncestor',
+            help = 'exit 0 if first commit is an ancestor of second, else 1')
+    subParser.add_argument('commits', nargs = 2, help = 'two commits')
+
+    # git commit-graph write
+    subParser = subParsers.add_parser('commit-graph',
+            help = 'write commit graph of all branches')
+
     # git diff
     subParser = subParsers.add_parser('diff',
           help = 'show diff of files changed (between index and working tree)')
+    subParser.add_argument('--cached', action = 'store_true',
+            help = 'diff between index and commit (default HEAD)')
+    subParser.add_argument('commits', nargs = '*',
+            help = 'one commit with --cached, or two commits to compare')
+    subParser.add_argument('--stat', action = 'store_true',
+            help = 'show changed line counts of each file only')
+    subParser.add_argument('--diff-algorithm', dest = 'algorithm',
+            choices = DIFF_ALGORITHMS, default = 'myers',
+            help = 'diff algorithm, default myers')
+    subParser.add_argument('-j', '--jobs', type = int, default = None,
+            help = 'number of workers diffing files (default: one per {} '
+                 'files, at most cpu count)'.format(DIFF_MIN_PAIRS))
+    subParser.add_argument('--pool', choices = ['process', 'thread'],
+            default = 'process', help = 'worker pool type (default: process)')
+    subParser.add_argument('--preload-threads', type = int, default = None,
+            dest = 'preloadThreads',
+            help = preloadHelp)
 
     # git status
     subParser = subParsers.add_parser('status',
                                         help='show status of working copy')
+    subParser.add_argument('--preload-threads', type = int, default = None,
+            dest = 'preloadThreads',
+            help = preloadHelp)
 
     # actual arguments parse stage.
-    args = parser.parse_args()
+    # 'fkgit log HEAD -- a/b.txt', paths after '--' are not options. Only
+    # log takes them, others get '--' as argparse handles it.
+    argv = sys.argv[1:]
+    paths = []
+    if argv[:1] == ['log'] and '--' in argv:
+        paths = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
 
     if args.command == 'add':
-        param = args.paths
-        newPaths  = []
-        if param == list('.'):
-            # add support to 'git add .' for all files in current dir.
-            addFilesInDir(newPaths, '.')
-        else:
-            for path in param:
-                addFilesInDir(newPaths, path)
+        newPaths = expandAddPaths(args.paths, args.preloadThreads)
 
-        # excluded post fix file.
-        exPostfix = ['swp', 'swo']
-        for file in newPaths:
-            if file.split('.')[-1] in exPostfix:
-                newPaths.remove(file)
-
-        add(newPaths)
+        add(newPaths, args.jobs, args.pool, args.preloadThreads)
         for path in newPaths:
             print(path)
 
     elif args.command == 'cat-file':
         try:
-            if args.type:
+            if args.batch or args.batchCheck:
+                catFileBatch(args.batch, args.buffer)
+            elif args.sha1 is None:
+                print("Missing SHA1, Please See Help Page.")
+                sys.exit(1)
+            elif args.type:
                 catFile('type', args.sha1)
             elif args.size:
                 catFile('size', args.sha1)
@@ -656,16 +4897,61 @@ if __name__ == '__main__':
     elif args.command == 'commit':
         commit(args.message)
     elif args.command == 'diff':
-        diff()
+        diff(args.cached, args.commits, args.algorithm, args.stat,
+             args.jobs, args.pool, args.preloadThreads)
     elif args.command == 'hash-object':
-        sha1 = hashObject(readFile(args.path), args.type, args.write)
+        try:
+            sha1 = hashFile(args.path, args.type, args.write)
+        except FileChangedError as error:
+            errMsg(error)
         print(sha1)
     elif args.command == 'init':
         init('.')
     elif args.command == 'ls-files':
         lsFiles(args.stage)
     elif args.command == 'status':
-        status()
+        status(args.preloadThreads)
+    elif args.command == 'log':
+        log(args.revision, args.maxCount, args.pretty, paths, args.bloomStats)
+    elif args.command == 'merge-base':
+        one, two = [resolveRevision(name) for name in args.commits]
+        if args.isAncestor:
+            sys.exit(0 if isAncestor(one, two) else 1)
+        for sha1 in mergeBases(one, two):
+            print(sha1)
+    elif args.command == 'commit-graph':
+        print("Wrote [{}] Commits.".format(writeCommitGraph() or 0))
+    elif args.command == 'update-index':
+        with IndexLock():
+            index = readIndex()
+            extensions = dict(index.extensions)
+            if args.untrackedCache and b'UNTR' not in extensions:
+                # empty cache, filled by the next status.
+                extensions[b'UNTR'] = UntrackedCache().encode()
+            elif args.noUntrackedCache:
+                extensions.pop(b'UNTR', None)
+            if args.fsmonitor and b'FSMN' not in extensions:
+                # empty token, the first status checks everything.
+                extensions[b'FSMN'] = encodeFsmonitor('', [])
+            elif args.noFsmonitor:
+                extensions.pop(b'FSMN', None)
+            writeIndex(index, args.version, extensions)
+    elif args.command == 'fsmonitor':
+        if args.stop:
+            stopFsmonitor()
+        else:
+            fsmonitorDaemon()
+    elif args.command == 'serve':
+        if args.stop:
+            try:
+                serveRequest({'command': 'stop'}, args.sockPath)
+            except OSError:
+                errMsg("fkgit serve Not Running.")
+        else:
+            serve(args.sockPath, args.maxRepos)
+    elif args.command == 'repack':
+        repack(args.all, args.delete, args.window, args.depth,
+               args.ofsDelta)
     else:
         # 'unexpected command {}'.format(command)
         #                    => "unexpected command diff"
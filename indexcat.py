@@ -1,264 +1,583 @@
 #!/usr/bin/env python3
-import os, sys, binascii, math
+import os, sys, struct, binascii
 from datetime import datetime
 
-# https://github.com/git/git/blob/master/Documentation/technical/index-format.txt
-def parseIndex(myfile):
-    ''' Parse Index File.
-          | 0           | 4            | 8           | C              |
-          |-------------|--------------|-------------|----------------|
-        0 | DIRC        | Version      | File count  | Ctime          | 0
-          | Nano-Sec    | Mtime        | Nano-Sec    | Device         |
-        2 | Inode       | Mode         | UID         | GID            | 2
-          | File size   | Entry SHA-1    ...           ...            |
-        4 | ...           ...          | Flags  | File Name(variant)  | 4
-          | Index SHA-1   ...           ...            ...            |
-        6 | ...                                                       |
+# https://github.com/git/git/blob/master/Documentation/gitformat-index.txt
+''' Index File.
+      | 0           | 4            | 8           | C              |
+      |-------------|--------------|-------------|----------------|
+    0 | DIRC        | Version      | File count  | Ctime          | 0
+      | Nano-Sec    | Mtime        | Nano-Sec    | Device         |
+    2 | Inode       | Mode         | UID         | GID            | 2
+      | File size   | Entry SHA-1    ...           ...            |
+    4 | ...           ...          | Flags  | File Name(variant)  | 4
+      | Index SHA-1   ...           ...            ...            |
+    6 | ...                                                       |
 
-   --->>
-        2 | Mode - 32 bit     |      4 | Flags - 16 bit
-          |-------------------|        |-------------------------|
-          | 16-bit unknown    |        | 1-bit assume-valid flag |
-          | 4-bit object type |        | 1-bit extended flag     |
-          | 3-bit unused      |        | 2-bit stage             |
-          | 9-bit unix perm   |        | 12-bit name length      |
+--->>
+    2 | Mode - 32 bit     |      4 | Flags - 16 bit
+      |-------------------|        |-------------------------|
+      | 16-bit unknown    |        | 1-bit assume-valid flag |
+      | 4-bit object type |        | 1-bit extended flag     |
+      | 3-bit unused      |        | 2-bit stage             |
+      | 9-bit unix perm   |        | 12-bit name length      |
 
-    '''
-    with open(myfile, "rb") as fRd:
-        ''' 32-bit signature:
-            The signature is { 'D', 'I', 'R', 'C' } (stands for "dircache")
-        '''
-        printAppendix()
-        print("Index File ", end = "")
-        printAppendix()
-        print()
-        byte = fRd.read(4)
-        if byte != b"":
-            str(byte, 'utf-8')
-            print("Head: %s" %byte.decode('ascii'))
+    Entries are followed by extensions, | Ext-Sig | Ext-Size | Ext-Data |
+    one by one till the trailing checksum.
+'''
 
-        ''' 32-bit version number:
-            The current supported versions are 2, 3 and 4. '''
-        byte = fRd.read(4)
-        if byte != b"":
-            val = int.from_bytes(byte, byteorder = "big")
-            print("Version: %d" %val)
+# ctime, ctime ns, mtime, mtime ns, dev, ino, mode, uid, gid, size, SHA-1
+# and flags of an entry, 62 bytes.
+ENTRY_STRUCT = struct.Struct('>10L20sH')
+FLAG_VALID = 0x8000
+FLAG_EXTENDED = 0x4000
+NAME_MASK = 0x0fff
+# v3+ extended flags.
+FLAG_SKIP_WORKTREE = 0x4000
+FLAG_INTENT_TO_ADD = 0x2000
 
-        ''' 32-bit file count
-            32-bit number of index entries.  '''
-        byte = fRd.read(4)
-        if byte != b"":
-            fileCount = int.from_bytes(byte, byteorder = "big")
-            print("File Count: %d" %fileCount)
+# ctime/mtime are (seconds, nanoseconds) in entries(), two columns in output.
+ENTRY_COLUMNS = ('path', 'mode', 'sha1', 'stage', 'size', 'ctime', 'mtime',
+                 'dev', 'ino', 'uid', 'gid', 'assume_valid', 'skip_worktree',
+                 'intent_to_add')
+CSV_COLUMNS = ENTRY_COLUMNS[:5] + ('ctime', 'ctime_ns', 'mtime', 'mtime_ns') \
+              + ENTRY_COLUMNS[7:]
+# object type of mode >> 12 -> name printed by summary.
+MODE_TYPES = {0o10: 'Regular File', 0o12: 'Symbolic Link', 0o16: 'Gitlink',
+              0o04: 'Sparse Directory'}
+# lines written to stdout at a time.
+WRITE_BATCH = 8192
 
-        ''' A number of sorted index entries
-            32-bit ctime seconds, the last time a file's metadata changed
-            this is stat(2) data.
-        '''
-        byte = fRd.read(4)
-        if byte != b"":
-            val = int.from_bytes(byte, byteorder = "big")
-            print("Ctime:", end = ' ')
-            print(datetime.fromtimestamp(int(val)).strftime('%Y-%m-%d %H:%M:%S'))
-        ''' 32-bit nano seconds of ctime. '''
-        byte = fRd.read(4)
-        if byte != b"":
-            val = int.from_bytes(byte, byteorder = "big")
-            #print("nano seconds: %d" %val)
-
-        ''' 32-bit mtime seconds, the last time a file's metadata changed
-            this is stat(2) data.
-        '''
-        byte = fRd.read(4)
-        if byte != b"":
-            val = int.from_bytes(byte, byteorder = "big")
-            print("Mtime:", end = ' ')
-            print(datetime.fromtimestamp(int(val)).strftime('%Y-%m-%d %H:%M:%S'))
-        ''' 32-bit nano seconds of mtime. '''
-        byte = fRd.read(4)
-        if byte != b"":
-            val = int.from_bytes(byte, byteorder = "big")
-            #print("nano seconds: %d" %val)
+class IndexFile:
+    ''' Index file mapped in memory and walked in one pass. entries() yields
+        one tuple per entry, in ENTRY_COLUMNS order:
+        ('main.cpp', 0o100644, 'bee80f...', 0, 77, (1505637351, 0),
+         (1505637351, 0), 64512, 194643356, 1000, 1000, 0, 0, 0)
+    '''
+    def __init__(self, path):
+        import mmap
+        with open(path, 'rb') as fRd:
+            size = os.fstat(fRd.fileno()).st_size
+            if size < 12 + 20:
+                raise ValueError('Index Too Short: {} Bytes'.format(size))
+            self.data = mmap.mmap(fRd.fileno(), 0, access = mmap.ACCESS_READ)
+        self.path = path
+        self.size = size
+        self.signature, self.version, self.count = \
+                struct.unpack_from('>4sLL', self.data, 0)
+        if self.signature != b'DIRC':
+            raise ValueError('Invalid Index Signature {}'.format(
+                             self.signature))
+        if self.version not in (2, 3, 4):
+            raise ValueError('Unknown Index Version {}'.format(self.version))
+        self.checksum = self.data[-20:]
+        # offset right after the last entry, known after a walk or by EOIE.
+        self.entriesEnd = None
 
-        ''' 32-bit dev
-            this is stat(2) data. '''
-        byte = fRd.read(4)
-        if byte != b"":
-            val = int.from_bytes(byte, byteorder = "big")
-            print("Device: %d" %val)
+    def verify(self):
+        ''' True if the trailing checksum matches, None if it was not
+            written (index.skipHash leaves it all zero). '''
+        import hashlib
+        if self.checksum == b'\x00' * 20:
+            return None
+        view = memoryview(self.data)
+        try:
+            return hashlib.sha1(view[:-20]).digest() == self.checksum
+        finally:
+            view.release()
 
-        ''' 32-bit inode
-            this is stat(2) data. '''
-        for loop in range(0, fileCount):
-            # beauty decorated
-            printAppendix()
-            print("File No. %d" %(loop + 1), end = ' ')
-            printAppendix()
-            print()
+    def entries(self):
+        ''' Yield entry tuples, fixed fields unpacked by one struct call. '''
+        data = self.data
+        v4 = self.version == 4
+        unpackFrom = ENTRY_STRUCT.unpack_from
+        entryLen = ENTRY_STRUCT.size
+        find = data.find
+        hexlify = binascii.hexlify
+        prevName = b''
+        pos = 12
+        for _ in range(self.count):
+            (ctimeS, ctimeN, mtimeS, mtimeN, dev, ino, mode, uid, gid, size,
+             sha1, flags) = unpackFrom(data, pos)
+            start = pos
+            pos += entryLen
+            extFlags = 0
+            if flags & FLAG_EXTENDED:
+                extFlags = (data[pos] << 8) | data[pos + 1]
+                pos += 2
+            if v4:
+                # varint of bytes to strip off the previous name, then the
+                # rest of the name NUL-terminated, no padding.
+                byte = data[pos]
+                strip = byte & 0x7f
+                pos += 1
+                while byte & 0x80:
+                    byte = data[pos]
+                    strip = ((strip + 1) << 7) | (byte & 0x7f)
+                    pos += 1
+                end = find(b'\x00', pos)
+                name = prevName[:len(prevName) - strip] + data[pos:end]
+                prevName = name
+                pos = end + 1
+            else:
+                nameLen = flags & NAME_MASK
+                # 0xfff means the name is too long for 12 bit, find its end.
+                if nameLen == NAME_MASK:
+                    nameLen = find(b'\x00', pos) - pos
+                name = data[pos:pos + nameLen]
+                # 1-8 NULs pad the entry to a multiple of eight bytes.
+                pos = start + ((pos - start + nameLen) // 8 + 1) * 8
+            yield (name.decode('utf-8', 'backslashreplace'), mode,
+                   hexlify(sha1).decode('ascii'), (flags >> 12) & 3, size,
+                   (ctimeS, ctimeN), (mtimeS, mtimeN), dev, ino, uid, gid,
+                   1 if flags & FLAG_VALID else 0,
+                   1 if extFlags & FLAG_SKIP_WORKTREE else 0,
+                   1 if extFlags & FLAG_INTENT_TO_ADD else 0)
+        self.entriesEnd = pos
 
-            byte = fRd.read(4)
-            if byte != b"":
-                val = int.from_bytes(byte, byteorder = "big")
-                print("Inode : %d" %val)
+    def extensions(self):
+        ''' Return [(signature, data)] of all extensions. Entries are
+            skipped by the EOIE offset when there is one, otherwise walked
+            once. '''
+        data = self.data
+        end = self.size - 20
+        if self.entriesEnd is None:
+            # EOIE is always the last extension, 8 + 24 bytes long.
+            eoie = end - 32
+            if eoie >= 12 and data[eoie:eoie + 8] == b'EOIE\x00\x00\x00\x18':
+                self.entriesEnd = struct.unpack_from('>L', data, eoie + 8)[0]
+            else:
+                for _ in self.entries():
+                    pass
+        result = []
+        pos = self.entriesEnd
+        while pos + 8 <= end:
+            sig, size = struct.unpack_from('>4sL', data, pos)
+            if pos + 8 + size > end:
+                raise ValueError('Extension {} at {} Overruns The Index'.format(
+                                 sig, pos))
+            result.append((sig.decode('ascii', 'replace'),
+                           data[pos + 8:pos + 8 + size]))
+            pos += 8 + size
+        if pos != end:
+            raise ValueError('Garbage Between Extensions And CheckSum')
+        return result
 
-            ''' 32-bit mode this is stat(2) data.
-                Included 4-bit object type
-                valid values in binary are 1000 (regular file), 1010 (symbolic link)
-                and 1110 (gitlink). '''
-            byte = fRd.read(2)              # 16-bit high, zero
-            byte = fRd.read(2)              # 16-bit low, 4 + 3 + 9
-            if byte != b"":
-                val = int.from_bytes(byte, byteorder = "big")
-                checkModeField(val)
+def hexSha1(data, pos = 0):
+    return binascii.hexlify(data[pos:pos + 20]).decode('ascii')
 
-            ''' 32-bit uid
-                this is stat(2) data. '''
-            byte = fRd.read(4)
-            if byte != b"":
-                val = int.from_bytes(byte, byteorder = "big")
-                print("UID: %d" %val)
+def readVarint(data, pos):
+    ''' Return (value, next pos) of git's offset varint at pos. '''
+    byte = data[pos]
+    val = byte & 0x7f
+    pos += 1
+    while byte & 0x80:
+        byte = data[pos]
+        val = ((val + 1) << 7) | (byte & 0x7f)
+        pos += 1
+    return val, pos
 
-            ''' 32-bit gid
-                this is stat(2) data. '''
-            byte = fRd.read(4)
-            if byte != b"":
-                val = int.from_bytes(byte, byteorder = "big")
-                print("GID: %d" %val)
+def readEwah(data, pos):
+    ''' Return (positions of set bits, next pos) of EWAH bitmap at pos.
+        32-bit bit count, 32-bit word count, 64-bit words, 32-bit position
+        of the last marker word. A marker word has 1 running bit, 32 bits
+        of running length in words and 31 bits of literal word count.
+    '''
+    bitCount, wordCount = struct.unpack_from('>LL', data, pos)
+    words = struct.unpack_from('>{}Q'.format(wordCount), data, pos + 8)
+    bits = []
+    bit = 0
+    i = 0
+    while i < wordCount:
+        marker = words[i]
+        running = ((marker >> 1) & 0xffffffff) * 64
+        if marker & 1:
+            bits.extend(range(bit, bit + running))
+        bit += running
+        for word in words[i + 1:i + 1 + (marker >> 33)]:
+            while word:
+                low = word & -word
+                bits.append(bit + low.bit_length() - 1)
+                word ^= low
+            bit += 64
+        i += 1 + (marker >> 33)
+    while bits and bits[-1] >= bitCount:
+        bits.pop()
+    return bits, pos + 8 + 8 * wordCount + 4
 
-            ''' 32-bit file size
-                This is the on-disk size from stat(2), truncated to 32-bit. '''
-            byte = fRd.read(4)
-            if byte != b"":
-                val = int.from_bytes(byte, byteorder = "big")
-                print("File Size: %d [Char]" %val)
+''' Extension parsers take (data, IndexFile, extensions) and return
+    (info, records): info is a small dict for the summary, records a list
+    of dicts, one per tree, conflict, directory etc.
+'''
+def parseTreeExtension(data, index, extensions):
+    ''' Cache tree extension, one entry per directory, in pre-order.
+        NUL-terminated path component (relative to its parent directory)
+        ASCII decimal number of entries covered by this tree, -1 = invalid
+        A space (ASCII 32)
+        ASCII decimal number of subtrees this tree has
+        A newline (ASCII 10)
+        160-bit object name of the tree, only if entry count is not -1
+    '''
+    records = []
+    # (path of the directory, subtrees left) of the parents.
+    parents = []
+    pos = 0
+    while pos < len(data):
+        nameEnd = data.index(b'\x00', pos)
+        lineEnd = data.index(b'\n', nameEnd)
+        name = data[pos:nameEnd].decode('utf-8', 'backslashreplace')
+        entryCount, subCount = map(int, data[nameEnd + 1:lineEnd].split())
+        pos = lineEnd + 1
+        while parents and parents[-1][1] == 0:
+            parents.pop()
+        if parents:
+            parents[-1][1] -= 1
+            path = parents[-1][0] + name + '/'
+        else:
+            path = name
+        sha1 = None
+        if entryCount >= 0:
+            sha1 = hexSha1(data, pos)
+            pos += 20
+        records.append({'path': path, 'entries': entryCount,
+                        'subtrees': subCount, 'sha1': sha1})
+        parents.append([path, subCount])
+    info = {'trees': len(records),
+            'invalid': sum(1 for record in records if record['entries'] < 0)}
+    if records and records[0]['sha1']:
+        info['root'] = records[0]['sha1']
+    return info, records
 
-            ''' 160-bit SHA-1 for the represented object. '''
-            byte = fRd.read(20)
-            if byte != b"":
-                # val = int.from_bytes(byte, byteorder = "big")
-                # print("SHA-1: %x" %val)
-                print("SHA-1: {}".format(binascii.hexlify(byte).decode('utf-8')))
+def parseResolveUndoExtension(data, index, extensions):
+    ''' Resolve undo extension, stages of conflicts resolved since.
+        NUL-terminated path
+        3 NUL-terminated ASCII octal modes of stage 1-3, 0 = missing
+        160-bit object name of each stage whose mode is not 0
+    '''
+    records = []
+    pos = 0
+    while pos < len(data):
+        nameEnd = data.index(b'\x00', pos)
+        path = data[pos:nameEnd].decode('utf-8', 'backslashreplace')
+        pos = nameEnd + 1
+        modes = []
+        for _ in range(3):
+            modeEnd = data.index(b'\x00', pos)
+            modes.append(int(data[pos:modeEnd], 8))
+            pos = modeEnd + 1
+        sha1s = []
+        for mode in modes:
+            sha1s.append(hexSha1(data, pos) if mode else None)
+            pos += 20 if mode else 0
+        records.append({'path': path, 'modes': ['%06o' %m for m in modes],
+                        'sha1s': sha1s})
+    return {'entries': len(records)}, records
 
-            ''' A 16-bit 'flags' field split into (high to low bits).
-            '''
-            byte = fRd.read(2)
-            if byte != b"":
-                val = int.from_bytes(byte, byteorder = 'big')
-                validFlag    = val & 0b1000000000000000
-                extendedFlag = val & 0b0100000000000000
-                stage        = val & 0b0011000000000000
-                fileNameLen  = val & 0b0000111111111111
-                print("Valid Flag: %d" %validFlag)
-                print("Extended Flag: %d" %extendedFlag)
-                print("Stage : %d" %stage)
-                print("File Name Length: %d" %fileNameLen)
+def parseUntrackedExtension(data, index, extensions):
+    ''' Untracked cache extension.
+        varint size of ident, ident string (work tree and os) NUL-ended
+        stat data of $GIT_DIR/info/exclude and of core.excludesFile
+        32-bit dir flags
+        SHA-1 of $GIT_DIR/info/exclude and of core.excludesFile
+        per-dir exclude file name, NUL-terminated (.gitignore)
+        varint number of directory blocks, then in preorder per block:
+            varint untracked count, varint subdir count, name NUL-ended,
+            untracked names NUL-ended
+        EWAH bitmaps: valid, check only, has SHA-1
+        stat data of valid blocks, SHA-1 of blocks having it, NUL
+        Stat data: ctime, ctime ns, mtime, mtime ns, dev, ino, uid, gid,
+        size, 32-bit each.
+    '''
+    identLen, pos = readVarint(data, 0)
+    info = {'ident': data[pos:pos + identLen - 1].decode('utf-8',
+                                                         'backslashreplace')}
+    pos += identLen + 36 * 2
+    info['dir_flags'] = '0x%x' %struct.unpack_from('>L', data, pos)[0]
+    info['info_exclude_sha1'] = hexSha1(data, pos + 4)
+    info['excludes_file_sha1'] = hexSha1(data, pos + 24)
+    pos += 44
+    nameEnd = data.index(b'\x00', pos)
+    info['exclude_per_dir'] = data[pos:nameEnd].decode('utf-8',
+                                                       'backslashreplace')
+    dirCount, pos = readVarint(data, nameEnd + 1)
+    info['dirs'] = dirCount
+    info['untracked'] = 0
+    if dirCount == 0:
+        return info, []
 
-            ''' file name (variable), ended with 0x0000. '''
-            byte = fRd.read(fileNameLen)
-            if byte != b'':
-                print("File Name: %s" %byte.decode('ascii'))
+    records = []
+    # (path of the directory, subdirs left) of the parents.
+    parents = []
+    for _ in range(dirCount):
+        untrackedCount, pos = readVarint(data, pos)
+        subCount, pos = readVarint(data, pos)
+        names = []
+        for _ in range(untrackedCount + 1):
+            nameEnd = data.index(b'\x00', pos)
+            names.append(data[pos:nameEnd].decode('utf-8', 'backslashreplace'))
+            pos = nameEnd + 1
+        while parents and parents[-1][1] == 0:
+            parents.pop()
+        if parents:
+            parents[-1][1] -= 1
+            path = parents[-1][0] + names[0] + '/'
+        else:
+            path = names[0]
+        records.append({'path': path, 'untracked': names[1:]})
+        info['untracked'] += untrackedCount
+        parents.append([path, subCount])
+    valid, pos = readEwah(data, pos)
+    checkOnly, pos = readEwah(data, pos)
+    hasSha1, pos = readEwah(data, pos)
+    for i in valid:
+        records[i]['mtime'] = struct.unpack_from('>L', data, pos + 8)[0]
+        pos += 36
+    for i in hasSha1:
+        records[i]['exclude_sha1'] = hexSha1(data, pos)
+        pos += 20
+    valid, checkOnly = set(valid), set(checkOnly)
+    for i, record in enumerate(records):
+        record['valid'] = 1 if i in valid else 0
+        record['check_only'] = 1 if i in checkOnly else 0
+    return info, records
 
-            ''' 1-8 nul bytes as necessary to pad the entry to a multiple
-                of eight bytes while keeping the name NUL-terminated. '''
-            ''' only entry, header(DIRC + Ver + File-Count) not included. '''
-            entryDataLen = 10 * 4 + 20 + 2
-            entryPlusFileLen = entryDataLen + fileNameLen
-            # calculate how many b'\x00' be appended after file name.
-            trueLen = (math.floor(entryPlusFileLen / 8) + 1) * 8
-            paddedLen = trueLen - entryPlusFileLen
+def parseFsmonitorExtension(data, index, extensions):
+    ''' File system monitor cache extension.
+        32-bit version, 1 or 2
+        v1: 64-bit time in nanoseconds, v2: NUL-terminated token
+        32-bit size of the EWAH bitmap, EWAH bitmap of dirty entries
+    '''
+    version, = struct.unpack_from('>L', data, 0)
+    if version == 1:
+        info = {'version': 1, 'time': struct.unpack_from('>Q', data, 4)[0]}
+        pos = 12
+    else:
+        tokenEnd = data.index(b'\x00', 4)
+        info = {'version': version,
+                'token': data[4:tokenEnd].decode('utf-8', 'backslashreplace')}
+        pos = tokenEnd + 1
+    dirty, _ = readEwah(data, pos + 4)
+    info['dirty'] = len(dirty)
+    return info, [{'dirty': i} for i in dirty]
 
-            ''' skip null-padding for file name '''
-            byte = fRd.read(paddedLen)
+def parseEndOfEntriesExtension(data, index, extensions):
+    ''' End of index entry extension.
+        32-bit offset to the end of the entries
+        160-bit SHA-1 over signature and size of the extensions between
+        the entries and this one
+    '''
+    import hashlib
+    offset, = struct.unpack_from('>L', data, 0)
+    sha1 = hashlib.sha1()
+    for sig, extData in extensions:
+        if sig == 'EOIE':
+            break
+        sha1.update(sig.encode('ascii', 'replace') +
+                    struct.pack('>L', len(extData)))
+    return {'offset': offset, 'sha1': hexSha1(data, 4),
+            'valid': offset == index.entriesEnd and
+                     sha1.digest() == data[4:24]}, []
 
-            if loop == fileCount - 1:
-                ''' - Extensions
-                     4-byte extension signature. If the first byte is 'A'..
-                     'Z' the extension is optional and can be ignored.
-                '''
-                byte = fRd.read(4)
-                if byte != b'':
-                    extSign = byte.decode('ascii')
+def parseEntryOffsetExtension(data, index, extensions):
+    ''' Index entry offset table extension, blocks of entries that can be
+        loaded in parallel.
+        32-bit version, then per block 32-bit offset and 32-bit entry count
+    '''
+    version, = struct.unpack_from('>L', data, 0)
+    records = [{'offset': offset, 'entries': count} for offset, count in
+               struct.iter_unpack('>LL', data[4:4 + (len(data) - 4) // 8 * 8])]
+    return {'version': version, 'blocks': len(records)}, records
 
-                # parse different extersion signature
-                if extSign == 'TREE':
-                    # print message here to be compatible with fkgit
-                    print("-------------------- Extensions  --------------------")
-                    print("Extension Signature: %s" %extSign)
-                    ''' 32-bit size of the extension. '''
-                    byte = fRd.read(4)
-                    if byte != b"":
-                        extSize = int.from_bytes(byte, byteorder = "big")
-                        print("Extension Size: %d" %extSize)
+def parseLinkExtension(data, index, extensions):
+    ''' Split index link extension.
+        160-bit SHA-1 of the shared index file
+        optional EWAH bitmaps of deleted and replaced shared entries
+    '''
+    info = {'shared_index': hexSha1(data, 0)}
+    records = []
+    if len(data) > 20:
+        deleted, pos = readEwah(data, 20)
+        replaced, _ = readEwah(data, pos)
+        info['delete'], info['replace'] = len(deleted), len(replaced)
+        records = [{'delete': i} for i in deleted] + \
+                  [{'replace': i} for i in replaced]
+    return info, records
 
-                    ''' Ext Data. End of Extension. '''
-                    ''' NUL-terminated path component (relative to its
-                                            parent directory) '''
-                    # byte = fRd.read(1)
+def parseSparseExtension(data, index, extensions):
+    ''' Sparse directory entries extension, no data: the index may hold
+        directories (mode 040000) in place of the files under them. '''
+    return {}, []
 
-                    # skip reading extension data
-                    byte = fRd.read(extSize)
-                    if byte != b'':
-                        # print("SHA-1: {}".format(binascii.hexlify(byte).decode('utf-8')))
-                        pass
-                elif extSign == 'REUC':
-                    pass
-                else:
-                    print("-----------------------------------------------------")
-                    fRd.seek(-4, 1)
+EXTENSION_PARSERS = {'TREE': parseTreeExtension,
+                     'REUC': parseResolveUndoExtension,
+                     'UNTR': parseUntrackedExtension,
+                     'FSMN': parseFsmonitorExtension,
+                     'EOIE': parseEndOfEntriesExtension,
+                     'IEOT': parseEntryOffsetExtension,
+                     'link': parseLinkExtension,
+                     'sdir': parseSparseExtension}
 
-                ''' 160-bit SHA-1 over the content of the index file
-                                            before this checksum  '''
-                byte = fRd.read(20)
-                if byte != b'':
-                    val = int.from_bytes(byte, byteorder = "big")
-                    print("CheckSum: %x" %val)
+def parseExtensions(index):
+    ''' Return [(signature, size, info, records)], info and records are
+        None for extensions with no parser. '''
+    extensions = index.extensions()
+    result = []
+    for sig, data in extensions:
+        info = records = None
+        if sig in EXTENSION_PARSERS:
+            info, records = EXTENSION_PARSERS[sig](data, index, extensions)
+        result.append((sig, len(data), info, records))
+    return result
 
-            else:
-                 # skip 20 bytes, originally know as checksum
-                 byte = fRd.read(20)
-                 if byte != b'':
-                     val = int.from_bytes(byte, byteorder = "big")
-                     # print("Partial CheckSum: %x" %val)
+def writeLines(lines, out = None):
+    ''' Write iterable of lines to stdout, WRITE_BATCH of them at a time. '''
+    write = (out or sys.stdout).write
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == WRITE_BATCH:
+            batch.append('')
+            write('\n'.join(batch))
+            batch = []
+    if batch:
+        batch.append('')
+        write('\n'.join(batch))
 
-        printAppendix()
-        print("End of Parse ", end = "")
-        printAppendix()
-        print()
+def dumpJson(index, withEntries = True, withExtensions = True):
+    ''' JSON lines: a header, one object per entry, per extension and per
+        extension record (tree, conflict, directory...), then the checksum.
+        {"type": "entry", "path": "main.cpp", "mode": "100644", ...}
+    '''
+    import json
+    from json.encoder import encode_basestring_ascii as quote
+    writeLines([json.dumps({'type': 'header', 'file': index.path,
+                            'version': index.version, 'entries': index.count,
+                            'size': index.size})])
+    if withEntries:
+        fmt = ('{"type": "entry", "path": %s, "mode": "%06o", "sha1": "%s", '
+               '"stage": %d, "size": %d, "ctime": %d, "ctime_ns": %d, '
+               '"mtime": %d, "mtime_ns": %d, "dev": %d, "ino": %d, "uid": %d, '
+               '"gid": %d, "assume_valid": %d, "skip_worktree": %d, '
+               '"intent_to_add": %d}')
+        writeLines(fmt %(quote(path), mode, sha1, stage, size, ctime[0],
+                         ctime[1], mtime[0], mtime[1], dev, ino, uid, gid,
+                         valid, skip, intent)
+                   for (path, mode, sha1, stage, size, ctime, mtime, dev,
+                        ino, uid, gid, valid, skip, intent) in index.entries())
+    if withExtensions:
+        for sig, size, info, records in parseExtensions(index):
+            line = {'type': 'extension', 'signature': sig, 'size': size}
+            line.update(info or {})
+            writeLines([json.dumps(line)])
+            writeLines(json.dumps(dict(type = sig, **record))
+                       for record in records or ())
+    writeLines([json.dumps({'type': 'checksum',
+                            'sha1': hexSha1(index.checksum)})])
 
-        fRd.close()
+def dumpCsv(index):
+    ''' CSV of entries, CSV_COLUMNS as header row. '''
+    import csv, io, itertools
+    # rows go through a StringIO and out WRITE_BATCH at a time, writing
+    # each row to stdout costs more than formatting it.
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator = '\n')
+    writer.writerow(CSV_COLUMNS)
+    rows = ((path, '%06o' %mode, sha1, stage, size, ctime[0], ctime[1],
+             mtime[0], mtime[1], dev, ino, uid, gid, valid, skip, intent)
+            for (path, mode, sha1, stage, size, ctime, mtime, dev, ino, uid,
+                 gid, valid, skip, intent) in index.entries())
+    while True:
+        writer.writerows(itertools.islice(rows, WRITE_BATCH))
+        if not buf.tell():
+            break
+        sys.stdout.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
 
-def checkModeField(val):
-    objType = (val >> 12) & 0b1111
-    unixPerm = val & 0b0000000111111111
+def printSummary(index, verify = False):
+    ''' Counts of entries by stage, type and flags, one line per extension
+        and the checksum, the same few lines for any number of entries. '''
+    stages = [0] * 4
+    types = {}
+    valid = skip = intent = 0
+    totalSize = newest = 0
+    newestPath = None
+    for (path, mode, sha1, stage, size, ctime, mtime, dev, ino, uid, gid,
+         isValid, isSkip, isIntent) in index.entries():
+        stages[stage] += 1
+        types[mode >> 12] = types.get(mode >> 12, 0) + 1
+        valid += isValid
+        skip += isSkip
+        intent += isIntent
+        totalSize += size
+        if mtime[0] >= newest:
+            newest, newestPath = mtime[0], path
 
-    print("File Type:", end = ' ')
-    if objType == 8:
-        print("Regular File")
-        # print("Unix Permission: %d" %unixPerm)
-        print("Unix Permission: 0644 (%d)" %unixPerm)
-    elif objType == 10:
-        print("Symbolic Link")
-        print("Unix Permission: 0")
-    elif objType == 14:
-        print("Gitlink")
-        print("Unix Permission: 0")
+    print("File: %s" %index.path)
+    print("Head: %s" %index.signature.decode('ascii'))
+    print("Version: %d" %index.version)
+    print("File Count: %d" %index.count)
+    print("Index Size: %d" %index.size)
+    print("Stages: %s" %' '.join('%d:%d' %(i, n)
+                                for i, n in enumerate(stages) if n))
+    for objType, count in sorted(types.items()):
+        print("%s: %d" %(MODE_TYPES.get(objType, 'Unknown Type %o' %objType),
+                         count))
+    print("Assume Valid: %d" %valid)
+    print("Skip Worktree: %d" %skip)
+    print("Intent To Add: %d" %intent)
+    print("Total File Size: %d" %totalSize)
+    if newestPath is not None:
+        print("Newest Mtime: %s %s" %(datetime.fromtimestamp(newest).strftime(
+                                      '%Y-%m-%d %H:%M:%S'), newestPath))
+    for sig, size, info, records in parseExtensions(index):
+        print("Extension %s: %d Bytes" %(sig, size), end = '')
+        if info is None:
+            print(" (unknown)")
+        else:
+            print(''.join(', %s %s' %(key, value)
+                          for key, value in info.items()))
+    print("CheckSum: %s" %hexSha1(index.checksum), end = '')
+    if verify:
+        ok = index.verify()
+        print(' (%s)' %{True: 'ok', False: 'MISMATCH', None: 'not written'}[ok])
     else:
-        print("Unknown Type")
-        print("Unix Permission: Unknown")
-
-def printAppendix():
-    print("--------------------", end = ' ')
+        print()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        indexPath = "./.git/index"
-    elif len(sys.argv) == 2:
-        indexPath = sys.argv[1]
-    else:
-        pass
+    import argparse
+    parser = argparse.ArgumentParser(
+                description = 'Parse a git index file, default .git/index.')
+    parser.add_argument('indexPath', nargs = '?',
+                        default = os.path.join('.', '.git', 'index'))
+    parser.add_argument('-f', '--format', default = 'summary',
+                        choices = ['summary', 'json', 'csv'],
+                        help = 'summary counts (default), JSON lines of '
+                               'entries and extensions, or CSV of entries')
+    parser.add_argument('--no-entries', action = 'store_true',
+                        help = 'json: leave entries out')
+    parser.add_argument('--no-extensions', action = 'store_true',
+                        help = 'json: leave extensions out')
+    parser.add_argument('--verify', action = 'store_true',
+                        help = 'summary: check the trailing SHA-1 too')
+    args = parser.parse_args()
     # tackle parse routine
-    if os.path.exists(indexPath):
-        parseIndex(indexPath)
-    else:
-        print("Usage: ./parse_index.py [index_file]")
+    if not os.path.exists(args.indexPath):
+        parser.print_usage()
+        exit(1)
+    try:
+        index = IndexFile(args.indexPath)
+        if args.format == 'json':
+            dumpJson(index, not args.no_entries, not args.no_extensions)
+        elif args.format == 'csv':
+            dumpCsv(index)
+        else:
+            printSummary(index, args.verify)
+        sys.stdout.flush()
+    except (ValueError, IndexError, struct.error) as e:
+        print("Error, %s" %e)
+        exit(1)
+    except BrokenPipeError:
+        # output piped to head etc. closed early, nothing left to say.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
         exit(1)
@@ -0,0 +1,36 @@
+''' Fixtures of the fkgit tests: an empty repository in a temp directory. '''
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fkgit
+
+# git checks what fkgit writes, where it is installed.
+GIT = shutil.which('git')
+needGit = pytest.mark.skipif(GIT is None, reason = 'git not installed')
+
+def runGit(*args):
+    ''' Run git in the current directory, return its stdout. '''
+    env = dict(os.environ, GIT_AUTHOR_NAME = 'tester',
+               GIT_AUTHOR_EMAIL = 'tester@example.com',
+               GIT_COMMITTER_NAME = 'tester',
+               GIT_COMMITTER_EMAIL = 'tester@example.com')
+    return subprocess.run([GIT] + list(args), check = True, env = env,
+                          stdout = subprocess.PIPE).stdout
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch, capsys):
+    ''' Empty repository as the current directory, with fresh caches. '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fkgit, 'defaultState', fkgit.RepositoryState())
+    fkgit.init('.')
+    capsys.readouterr()
+    return tmp_path
+
+def reloadState(monkeypatch):
+    ''' Drop caches of the repository, next reads go to the files. '''
+    monkeypatch.setattr(fkgit, 'defaultState', fkgit.RepositoryState())
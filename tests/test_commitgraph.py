@@ -0,0 +1,214 @@
+''' Commit graph written by fkgit read back by fkgit, and by git. '''
+import os
+
+import fkgit
+from conftest import needGit, reloadState, runGit
+
+def writeTreeOf(files):
+    ''' Write trees of {path: data}, return hex SHA-1 of the top one. '''
+    dirs = {}
+    blobs = []
+    for path, data in files.items():
+        name, _, rest = path.partition('/')
+        if rest:
+            dirs.setdefault(name, {})[rest] = data
+        else:
+            blobs.append((name, b'100644', fkgit.hashObject(data, 'blob',
+                                                            True)))
+    entries = blobs + [(name + '/', b'40000', writeTreeOf(subFiles))
+                       for name, subFiles in dirs.items()]
+    # git sorts a directory as if its name ended with '/'.
+    entries.sort(key = lambda entry: entry[0].encode('utf-8'))
+    data = b''.join(b'%s %s\x00' %(mode, name.rstrip('/').encode('utf-8')) +
+                    bytes.fromhex(sha1) for name, mode, sha1 in entries)
+    return fkgit.hashObject(data, 'tree', True)
+
+def writeCommit(files, parents = (), time = 1600000000, message = 'commit'):
+    ''' Write commit of files on parents, return its hex SHA-1. '''
+    lines = ['tree ' + writeTreeOf(files)]
+    lines += ['parent ' + parent for parent in parents]
+    lines += ['author tester <tester@example.com> {} +0000'.format(time),
+              'committer tester <tester@example.com> {} +0000'.format(time),
+              '', message, '']
+    return fkgit.hashObject('\n'.join(lines).encode('utf-8'), 'commit', True)
+
+def setBranch(name, sha1):
+    fkgit.writeFile(fkgit.gitPath('refs', 'heads', name),
+                    (sha1 + '\n').encode('utf-8'))
+
+def writeHistory():
+    ''' Two branches with merges and an octopus merge, return
+        {sha1: (files, parents, time)}. '''
+    history = {}
+    def commit(files, parents = (), time = None):
+        time = time or 1600000000 + len(history) * 60
+        sha1 = writeCommit(files, parents, time, 'commit %d' %len(history))
+        history[sha1] = (dict(files), tuple(parents), time)
+        return sha1
+
+    files = {'README': b'readme\n', 'src/main.c': b'int main;\n'}
+    master = commit(files)
+    for i in range(5):
+        files['src/file%d.c' %i] = b'file %d\n' %i
+        master = commit(files, [master])
+    sides = []
+    for i in range(3):
+        side = dict(files)
+        side['side/%d/café.txt' %i] = b'side %d\n' %i
+        sides.append(commit(side, [master]))
+    topicFiles = dict(side, topic = b'topic\n')
+    files.update(('side/%d/café.txt' %i, b'side %d\n' %i) for i in range(3))
+    # an octopus needs the EDGE chunk.
+    master = commit(files, [master] + sides)
+    topic = commit(topicFiles, [sides[2]])
+    master = commit(dict(files, topic = b'topic\n'), [master, topic])
+    # commit time past 32 bit, its top 2 bits go with the generation.
+    master = commit(files, [master], time = (1 << 32) + 7)
+    setBranch('master', master)
+    setBranch('topic', topic)
+    return history
+
+def generationsOf(history):
+    generations = {}
+    def generation(sha1):
+        if sha1 not in generations:
+            generations[sha1] = 1 + max([generation(parent) for parent
+                                         in history[sha1][1]] or [0])
+        return generations[sha1]
+    for sha1 in history:
+        generation(sha1)
+    return generations
+
+def test_commit_graph_round_trip(repo, monkeypatch):
+    history = writeHistory()
+    assert fkgit.writeCommitGraph() == len(history)
+    reloadState(monkeypatch)
+
+    graph = fkgit.getCommitGraph()
+    assert graph.count == len(history)
+    assert b'EDGE' in graph.chunks
+    assert [graph.sha1At(i).hex() for i in range(graph.count)] == \
+           sorted(history)
+    generations = generationsOf(history)
+    for sha1, (files, parents, time) in history.items():
+        pos = graph.find(bytes.fromhex(sha1))
+        tree, parentPos, generation, commitTime = graph.commitAt(pos)
+        assert tree.hex() == writeTreeOf(files)
+        assert [graph.sha1At(i).hex() for i in parentPos] == list(parents)
+        assert generation == generations[sha1]
+        assert commitTime == time
+        node = fkgit.getCommitNode(sha1)
+        assert (node.parents, node.generation) == (parents, generation)
+    assert graph.find(b'\x00' * 20) is None
+
+def test_commit_adds_to_graph(repo, monkeypatch, capsys):
+    monkeypatch.setattr(fkgit, 'GRAPH_MAX_MISSING', 3)
+    with open('main.cpp', 'w') as file:
+        file.write('int main;\n')
+    fkgit.add(['main.cpp'])
+    sha1s = [fkgit.commit('first')]
+    # the first commit writes the graph.
+    assert fkgit.getCommitGraph().count == 1
+    for i in range(3):
+        sha1s.append(fkgit.commit('commit %d' %i))
+        assert fkgit.getCommitGraph().count == 1
+    # more than GRAPH_MAX_MISSING commits missing, all written again.
+    sha1s.append(fkgit.commit('last'))
+    graph = fkgit.getCommitGraph()
+    assert graph.count == len(sha1s)
+    for generation, sha1 in enumerate(sha1s, 1):
+        assert graph.commitAt(graph.find(bytes.fromhex(sha1)))[2] == \
+               generation
+
+@needGit
+def test_git_verify_commit_graph(repo):
+    writeHistory()
+    fkgit.writeCommitGraph()
+    runGit('commit-graph', 'verify')
+
+def chunkData(graph, chunkId):
+    ''' Bytes of chunkId, up to the next chunk. '''
+    start = graph.chunks[chunkId]
+    end = min([offset for offset in graph.chunks.values() if offset > start]
+              + [len(graph.data) - 20])
+    return graph.data[start:end]
+
+@needGit
+def test_git_commit_graph_same_commit_data(repo, monkeypatch):
+    writeHistory()
+    fkgit.writeCommitGraph()
+    path = fkgit.gitPath('objects', 'info', 'commit-graph')
+    ours = fkgit.CommitGraph(path)
+    os.remove(path)
+    runGit('-c', 'commitGraph.generationVersion=1', 'commit-graph', 'write',
+           '--reachable')
+    reloadState(monkeypatch)
+    theirs = fkgit.getCommitGraph()
+    for chunk in (b'OIDF', b'OIDL', b'CDAT', b'EDGE'):
+        assert chunkData(ours, chunk) == chunkData(theirs, chunk)
+
+def test_murmur3():
+    # test vectors of git's t0095-bloom.sh.
+    assert fkgit.murmur3(0, b'') == 0
+    assert fkgit.murmur3(0, b'Hello world!') == 0x627b0c2c
+    assert fkgit.murmur3(0, b'The quick brown fox jumps over the lazy dog') \
+           == 0x2e4ff723
+
+def changedPaths(history, sha1, parent = None):
+    ''' Paths changed by commit against parent, its first parent if None,
+        and their leading directories. '''
+    files, parents, _ = history[sha1]
+    parent = parent or (parents[0] if parents else None)
+    old = history[parent][0] if parent else {}
+    paths = set()
+    for path in set(files) | set(old):
+        if files.get(path) != old.get(path):
+            parts = path.split('/')
+            paths.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return paths
+
+def test_bloom_filters(repo, monkeypatch, capsys):
+    history = writeHistory()
+    fkgit.writeCommitGraph()
+    reloadState(monkeypatch)
+    graph = fkgit.getCommitGraph()
+    for sha1 in history:
+        bloomFilter = graph.bloomFilterAt(graph.find(bytes.fromhex(sha1)))
+        assert bloomFilter == fkgit.computeBloomFilter(
+                fkgit.getCommitNode(sha1))
+        changed = changedPaths(history, sha1)
+        # never a false 'definitely not'.
+        for path in changed:
+            assert fkgit.bloomMaybeContains(bloomFilter,
+                                            fkgit.bloomPathKeys(path))
+        if not changed:
+            assert bloomFilter == b'\x00'
+
+    # log -- path shows the commits whose path differs from all parents.
+    for path in ('src/file3.c', 'side/1', 'side', 'topic', 'README'):
+        expected = [sha1 for sha1, (_, parents, _) in history.items()
+                    if all(path in changedPaths(history, sha1, parent)
+                           for parent in parents or [None])]
+        fkgit.log('master', pretty = 'hash', paths = [path])
+        assert sorted(capsys.readouterr().out.split()) == sorted(expected)
+
+def test_bloom_filter_too_many_changes(repo, monkeypatch):
+    files = {'many/%d' %i: b'%d\n' %i for i in range(fkgit.BLOOM_MAX_CHANGES)}
+    setBranch('master', writeCommit(files))
+    fkgit.writeCommitGraph()
+    graph = fkgit.getCommitGraph()
+    assert graph.bloomFilterAt(0) == b'\xff'
+
+@needGit
+def test_git_same_bloom_filters(repo, monkeypatch):
+    # non-ASCII paths check git's signed char murmur3.
+    writeHistory()
+    fkgit.writeCommitGraph()
+    path = fkgit.gitPath('objects', 'info', 'commit-graph')
+    ours = fkgit.CommitGraph(path)
+    os.remove(path)
+    runGit('commit-graph', 'write', '--reachable', '--changed-paths')
+    reloadState(monkeypatch)
+    theirs = fkgit.getCommitGraph()
+    for chunk in (b'BIDX', b'BDAT'):
+        assert chunkData(ours, chunk) == chunkData(theirs, chunk)
@@ -0,0 +1,133 @@
+''' Hunks of every diff algorithm, applied to the old side, give the new
+    side. '''
+import random
+import re
+
+import pytest
+
+import fkgit
+from conftest import needGit, runGit
+
+HUNK_HEADER = re.compile(rb'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+NO_NEWLINE = b'\\ No newline at end of file\n'
+
+def hunkLines(hunk):
+    ''' Split hunk into its header and (sign, line) pairs, a line before
+        NO_NEWLINE loses its b'\n'. '''
+    lines = fkgit.splitLines(hunk)
+    result = []
+    for line in lines[1:]:
+        if line == NO_NEWLINE:
+            sign, text = result[-1]
+            assert text.endswith(b'\n')
+            result[-1] = (sign, text[:-1])
+        else:
+            assert line[:1] in (b' ', b'-', b'+'), line
+            result.append((line[:1], line[1:]))
+    return lines[0], result
+
+def applyHunks(aLines, hunks):
+    ''' Apply unified diff hunks to aLines, exactly at the lines their
+        headers say, return the new lines. '''
+    bLines = []
+    pos = 0
+    for hunk in hunks:
+        header, lines = hunkLines(hunk)
+        match = HUNK_HEADER.match(header)
+        assert match, header
+        aStart, aCount, bStart, bCount = [int(group) if group else 1
+                                          for group in match.groups()]
+        # an empty range starts after line aStart, not at it.
+        aStart = aStart - 1 if aCount else aStart
+        bStart = bStart - 1 if bCount else bStart
+        assert aStart >= pos
+        bLines += aLines[pos:aStart]
+        assert len(bLines) == bStart
+        old = [text for sign, text in lines if sign != b'+']
+        new = [text for sign, text in lines if sign != b'-']
+        assert (len(old), len(new)) == (aCount, bCount)
+        assert aLines[aStart:aStart + aCount] == old
+        bLines += new
+        pos = aStart + aCount
+    return bLines + aLines[pos:]
+
+def lcsLength(aLines, bLines):
+    row = [0] * (len(bLines) + 1)
+    for a in aLines:
+        prev = 0
+        for j, b in enumerate(bLines):
+            prev, row[j + 1] = row[j + 1], (prev + 1 if a == b
+                                            else max(row[j + 1], row[j]))
+    return row[-1]
+
+def randomLines(rand, count):
+    # few distinct lines, so there is a lot to match, and wrongly.
+    lines = [rand.choice((b'a\n', b'b\n', b'c\n', b'}\n', b'\n',
+                          b'int f(void)\n')) for _ in range(count)]
+    if lines and rand.randrange(4) == 0:
+        lines[-1] = lines[-1].rstrip(b'\n') or b'x'
+    return lines
+
+def randomPairs(count, seed = 11):
+    rand = random.Random(seed)
+    for _ in range(count):
+        aLines = randomLines(rand, rand.randrange(40))
+        if rand.randrange(3):
+            bLines = randomLines(rand, rand.randrange(40))
+        else:
+            # mostly the same, a few lines changed.
+            bLines = list(aLines)
+            for _ in range(rand.randrange(1, 4)):
+                pos = rand.randrange(len(bLines) + 1)
+                bLines[pos:pos + rand.randrange(3)] = \
+                        randomLines(rand, rand.randrange(3))
+        yield aLines, bLines
+
+@pytest.mark.parametrize('algorithm', fkgit.DIFF_ALGORITHMS)
+def test_hunks_apply(algorithm):
+    for aLines, bLines in randomPairs(500):
+        changedA, changedB = fkgit.diffLines(aLines, bLines, algorithm)
+        # unchanged lines of both sides pair up one to one.
+        assert [line for line, changed in zip(aLines, changedA)
+                if not changed] == \
+               [line for line, changed in zip(bLines, changedB)
+                if not changed]
+        for context in (0, 1, 3):
+            hunks = list(fkgit.diffHunks(aLines, bLines, changedA, changedB,
+                                         context))
+            assert applyHunks(aLines, hunks) == bLines
+            assert bool(hunks) == (aLines != bLines)
+
+def test_myers_is_minimal():
+    for aLines, bLines in randomPairs(200, seed = 12):
+        changedA, changedB = fkgit.diffLines(aLines, bLines, 'myers')
+        assert sum(changedA) + sum(changedB) == \
+               len(aLines) + len(bLines) - 2 * lcsLength(aLines, bLines)
+
+def writeSides():
+    old = b'\n'.join(b'line %d' %i for i in range(100)) + b'\n'
+    new = old.replace(b'line 5\n', b'').replace(b'line 50', b'fifty') + b'end'
+    return (old, fkgit.hashObject(old, 'blob', True),
+            new, fkgit.hashObject(new, 'blob', True))
+
+@pytest.mark.parametrize('algorithm', fkgit.DIFF_ALGORITHMS)
+def test_diff_file_applies(repo, algorithm):
+    old, oldSha1, new, newSha1 = writeSides()
+    chunks = list(fkgit.diffFile('file.txt', '100644', oldSha1, '100644',
+                                 newSha1, algorithm))
+    assert chunks[0].endswith(b'--- a/file.txt\n+++ b/file.txt\n')
+    assert applyHunks(fkgit.splitLines(old), chunks[1:]) == \
+           fkgit.splitLines(new)
+
+@needGit
+@pytest.mark.parametrize('algorithm', fkgit.DIFF_ALGORITHMS)
+def test_git_applies_diff(repo, algorithm):
+    old, oldSha1, new, newSha1 = writeSides()
+    with open('file.txt', 'wb') as file:
+        file.write(old)
+    with open('file.patch', 'wb') as file:
+        file.writelines(fkgit.diffFile('file.txt', '100644', oldSha1,
+                                       '100644', newSha1, algorithm))
+    runGit('apply', 'file.patch')
+    with open('file.txt', 'rb') as file:
+        assert file.read() == new
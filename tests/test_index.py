@@ -0,0 +1,180 @@
+''' Index written by fkgit, in every version, read back by fkgit, by
+    indexcat.py and by git. '''
+import os
+import random
+import struct
+
+import pytest
+
+import fkgit
+import indexcat
+from conftest import needGit, reloadState, runGit
+
+# indexcat flags of the extended flags.
+SKIP_WORKTREE = 0x4000
+INTENT_TO_ADD = 0x2000
+
+def makeEntries(count, seed = 3, extended = False):
+    ''' count entries of nested paths sharing prefixes, sorted. '''
+    rand = random.Random(seed)
+    paths = set()
+    while len(paths) < count:
+        depth = rand.randrange(1, 5)
+        paths.add('/'.join('dir%d' %rand.randrange(4) for _ in range(depth))
+                  + '/file%d.txt' %rand.randrange(100))
+    # a name too long for the 12 bit length, and non-ASCII.
+    paths.add('long/' + 'x' * 5000)
+    paths.add('deer/café.txt')
+    entries = []
+    for i, path in enumerate(sorted(paths, key = lambda p: p.encode())):
+        nameLen = len(path.encode('utf-8'))
+        flags = min(nameLen, fkgit.INDEX_NAME_MASK)
+        extFlags = 0
+        if extended:
+            extFlags = (SKIP_WORKTREE, INTENT_TO_ADD, 0)[i % 3]
+        if extFlags:
+            flags |= fkgit.INDEX_FLAG_EXTENDED
+        entries.append(fkgit.IndexEntry(
+                ctime_s = 1500000000 + i, ctime_n = i, mtime_s = 1600000000,
+                mtime_n = 999999999 - i, dev = 2049, ino = 100 + i,
+                mode = 0o100755 if i % 5 == 0 else 0o100644, uid = 1000,
+                gid = 1000, size = i * 7,
+                sha1 = bytes.fromhex(fkgit.hashObject(path.encode())),
+                flags = flags, path = path, extFlags = extFlags))
+    return entries
+
+def indexcatTuple(entry):
+    ''' entry as the tuple indexcat.IndexFile.entries() yields. '''
+    return (entry.path, entry.mode, entry.sha1.hex(), (entry.flags >> 12) & 3,
+            entry.size, (entry.ctime_s, entry.ctime_n),
+            (entry.mtime_s, entry.mtime_n), entry.dev, entry.ino, entry.uid,
+            entry.gid, 0, 1 if entry.extFlags & SKIP_WORKTREE else 0,
+            1 if entry.extFlags & INTENT_TO_ADD else 0)
+
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_index_round_trip(repo, monkeypatch, version):
+    entries = makeEntries(300, extended = version == 3)
+    extensions = {b'ZZZZ': b'opaque data'}
+    fkgit.writeIndex(entries, version, extensions)
+    reloadState(monkeypatch)
+
+    index = fkgit.readIndex()
+    assert index.version == version
+    assert list(index) == entries
+    assert index.extensions == extensions
+    for i, entry in enumerate(entries):
+        assert index.pathAt(i) == entry.path
+        assert index.find(entry.path) == i
+
+    indexFile = indexcat.IndexFile(fkgit.gitPath('index'))
+    assert indexFile.verify()
+    assert indexFile.version == version
+    assert list(indexFile.entries()) == [indexcatTuple(entry)
+                                         for entry in entries]
+    assert indexFile.extensions() == [('ZZZZ', b'opaque data')]
+
+def test_index_v4_is_smaller(repo):
+    entries = makeEntries(300)
+    sizes = {}
+    for version in (2, 4):
+        fkgit.writeIndex(entries, version)
+        with open(fkgit.gitPath('index'), 'rb') as file:
+            sizes[version] = len(file.read())
+    assert sizes[4] < sizes[2]
+
+def test_extended_flags_need_v3(repo, monkeypatch):
+    fkgit.writeIndex(makeEntries(10, extended = True), 2)
+    reloadState(monkeypatch)
+    assert fkgit.readIndex().version == 3
+
+@needGit
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_git_reads_index(repo, version):
+    entries = makeEntries(100, extended = version == 3)
+    fkgit.writeIndex(entries, version)
+    lines = runGit('ls-files', '--stage', '-z').split(b'\x00')[:-1]
+    assert lines == [b'%o %s 0\t%s' %(entry.mode, entry.sha1.hex().encode(),
+                                      entry.path.encode('utf-8'))
+                     for entry in entries]
+
+def writeFiles(paths):
+    for path in paths:
+        if '/' in path:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'w') as file:
+            file.write('*.log\n' if path == '.gitignore' else path)
+
+def untrackedNodes(node, path = ''):
+    ''' (path, valid, untracked) of every directory of the cache. '''
+    yield path, node.valid, node.untracked
+    for name, child in node.dirs.items():
+        yield from untrackedNodes(child, path + name + '/')
+
+def test_untracked_cache_round_trip(repo, monkeypatch, capsys):
+    writeFiles(['a.txt', 'deer/b.txt', 'deer/new.txt', 'newdir/x.txt',
+                'new.txt', 'a.log', '.gitignore'])
+    fkgit.add(['a.txt', 'deer/b.txt'])
+    index = fkgit.readIndex()
+    extensions = dict(index.extensions)
+    extensions[b'UNTR'] = fkgit.UntrackedCache().encode()
+    fkgit.writeIndex(list(index), None, extensions)
+    untracked = ['.gitignore', 'deer/new.txt', 'new.txt', 'newdir/x.txt']
+    assert fkgit.getStatus() == ([], untracked, [])
+
+    # status filled the cache, it parses and encodes to the same data.
+    reloadState(monkeypatch)
+    data = fkgit.readIndex().extensions[b'UNTR']
+    cache = fkgit.parseUntrackedCache(data)
+    assert cache.encode() == data
+    assert list(untrackedNodes(cache.root)) == [
+            ('', True, ['.gitignore', 'new.txt', 'newdir/']),
+            ('deer/', True, ['new.txt']), ('newdir/', True, ['x.txt'])]
+    assert cache.root.excludeSha1 == bytes.fromhex(
+            fkgit.hashObject(b'*.log\n'))
+
+    indexFile = indexcat.IndexFile(fkgit.gitPath('index'))
+    info, records = indexcat.parseUntrackedExtension(data, indexFile, None)
+    assert info['dirs'] == 3 and info['untracked'] == 5
+    assert [(record['path'], record['valid'] == 1, record['untracked'])
+            for record in records] == list(untrackedNodes(cache.root))
+
+    # the cached result follows changes of the work tree.
+    writeFiles(['deer/late.txt'])
+    os.remove('new.txt')
+    reloadState(monkeypatch)
+    assert fkgit.getStatus() == ([], ['.gitignore', 'deer/late.txt',
+                                      'deer/new.txt', 'newdir/x.txt'], [])
+
+def test_ewah_round_trip():
+    rand = random.Random(9)
+    for count in (0, 1, 63, 64, 65, 1000):
+        bits = [rand.randrange(3) == 0 for _ in range(count)]
+        data = b'pre' + fkgit.encodeEwah(bits) + b'post'
+        assert fkgit.decodeEwah(data, 3) == (bits, len(data) - 4)
+        setBits = [i for i, bit in enumerate(bits) if bit]
+        assert indexcat.readEwah(data, 3) == (setBits, len(data) - 4)
+
+def test_ewah_running_words():
+    # as git compresses: a run of two all-ones words, then one literal.
+    words = [(1 << 33) | (2 << 1) | 1, 0b101]
+    data = struct.pack('>LL2QL', 131, 2, *words, 0)
+    bits = [True] * 128 + [True, False, True]
+    assert fkgit.decodeEwah(data, 0) == (bits, len(data))
+    assert indexcat.readEwah(data, 0)[0] == list(range(128)) + [128, 130]
+
+def test_fsmonitor_round_trip(repo, monkeypatch):
+    entries = makeEntries(100)
+    dirty = [i % 7 == 0 for i in range(len(entries))]
+    fsmonitor = fkgit.encodeFsmonitor('token:42', dirty)
+    assert fkgit.parseFsmonitor(fsmonitor) == ('token:42', dirty)
+    fkgit.writeIndex(entries, 4, {b'FSMN': fsmonitor})
+
+    reloadState(monkeypatch)
+    data = fkgit.readIndex().extensions[b'FSMN']
+    assert fkgit.parseFsmonitor(data) == ('token:42', dirty)
+    indexFile = indexcat.IndexFile(fkgit.gitPath('index'))
+    info, records = indexcat.parseFsmonitorExtension(data, indexFile, None)
+    assert info == {'version': 2, 'token': 'token:42',
+                    'dirty': dirty.count(True)}
+    assert [record['dirty'] for record in records] == \
+           [i for i, bit in enumerate(dirty) if bit]
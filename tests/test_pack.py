@@ -0,0 +1,127 @@
+''' Pack and idx written by fkgit read back by fkgit, and by git. '''
+import os
+import random
+
+import fkgit
+from conftest import needGit, reloadState, runGit
+
+def writeObjects(count, seed = 1):
+    ''' Write count loose blobs of random data and a tree of them, return
+        {sha1: (type, data)}. '''
+    rand = random.Random(seed)
+    objects = {}
+    entries = []
+    for i in range(count):
+        data = bytes(rand.randrange(256) for _ in range(rand.randrange(300)))
+        sha1 = fkgit.hashObject(data, 'blob', True)
+        objects[sha1] = ('blob', data)
+        entries.append(b'100644 file%d\x00' %i + bytes.fromhex(sha1))
+    tree = b''.join(sorted(entries))
+    objects[fkgit.hashObject(tree, 'tree', True)] = ('tree', tree)
+    return objects
+
+def objectDirs():
+    return sorted(name for name in os.listdir(fkgit.gitPath('objects'))
+                  if len(name) == 2)
+
+def test_pack_round_trip(repo, monkeypatch, capsys):
+    objects = writeObjects(40)
+    packPath = fkgit.repack(delete = True)
+    assert fkgit.listLooseObjects() == []
+    # emptied objects/xx are gone too.
+    assert objectDirs() == []
+
+    pack = fkgit.PackFile(packPath[:-len('.pack')] + '.idx')
+    assert pack.count == len(objects)
+    sha1s = [pack.sha1At(i).hex() for i in range(pack.count)]
+    assert sha1s == sorted(objects)
+    for i, sha1 in enumerate(sha1s):
+        assert pack.findSha1(bytes.fromhex(sha1)) == i
+        assert pack.readAt(pack.offsetAt(i)) == objects[sha1]
+    assert pack.findSha1(b'\xff' * 20) is None
+
+    reloadState(monkeypatch)
+    for sha1, obj in objects.items():
+        assert fkgit.readObject(sha1) == obj
+    pack.close()
+
+def test_repack_keeps_busy_object_dirs(repo, monkeypatch, capsys):
+    writeObjects(10)
+    packPath = fkgit.repack()
+    # without -d nothing is removed.
+    assert len(fkgit.listLooseObjects()) == 11
+    prefix = objectDirs()[0]
+    open(os.path.join(fkgit.gitPath('objects'), prefix, 'tmp_obj'),
+         'wb').close()
+    fkgit.hashObject(b'one more', 'blob', True)
+    fkgit.repack(allObjects = True, delete = True)
+    assert objectDirs() == [prefix]
+    assert not os.path.exists(packPath)
+
+@needGit
+def test_git_verify_pack(repo, capsys):
+    writeObjects(40)
+    packPath = fkgit.repack(delete = True)
+    runGit('verify-pack', packPath[:-len('.pack')] + '.idx')
+
+def mutate(rand, data):
+    ''' data with a few random inserts, deletes and replaces. '''
+    data = bytearray(data)
+    for _ in range(rand.randrange(1, 6)):
+        pos = rand.randrange(len(data) + 1)
+        span = rand.randrange(1, 40)
+        op = rand.randrange(3)
+        if op == 0:
+            data[pos:pos] = bytes(rand.randrange(256) for _ in range(span))
+        elif op == 1:
+            del data[pos:pos + span]
+        else:
+            data[pos:pos + span] = b'x' * span
+    return bytes(data)
+
+def test_delta_round_trip():
+    rand = random.Random(5)
+    for _ in range(200):
+        base = bytes(rand.randrange(256) for _ in range(rand.randrange(2000)))
+        target = mutate(rand, base) if rand.randrange(4) else base[::-1]
+        delta = fkgit.createDelta(base, target)
+        if delta is not None:
+            assert fkgit.applyDelta(base, delta) == target
+    # an empty base is all insert.
+    assert fkgit.applyDelta(b'', fkgit.createDelta(b'', b'new')) == b'new'
+
+def writeVersions(count, seed = 7):
+    ''' Write count blobs, each a small change of the one before. '''
+    rand = random.Random(seed)
+    data = b''.join(b'line %d of the file\n' %i for i in range(200))
+    objects = {}
+    for _ in range(count):
+        data = mutate(rand, data)
+        objects[fkgit.hashObject(data, 'blob', True)] = ('blob', data)
+    return objects
+
+def checkDeltaPack(monkeypatch, ofsDelta):
+    objects = writeVersions(30)
+    packPath = fkgit.repack(delete = True, ofsDelta = ofsDelta)
+    pack = fkgit.PackFile(packPath[:-len('.pack')] + '.idx')
+    types = [pack.readRawAt(pack.offsetAt(i))[0] for i in range(pack.count)]
+    deltaType = fkgit.PACK_OFS_DELTA if ofsDelta else fkgit.PACK_REF_DELTA
+    assert types.count(deltaType) > len(objects) // 2
+    assert set(types) <= {deltaType, 3}
+    reloadState(monkeypatch)
+    for sha1, obj in objects.items():
+        assert fkgit.readObject(sha1) == obj
+    pack.close()
+    return packPath
+
+def test_ofs_delta_pack(repo, monkeypatch, capsys):
+    checkDeltaPack(monkeypatch, True)
+
+def test_ref_delta_pack(repo, monkeypatch, capsys):
+    checkDeltaPack(monkeypatch, False)
+
+@needGit
+def test_git_verify_delta_pack(repo, monkeypatch, capsys):
+    for ofsDelta in (True, False):
+        packPath = checkDeltaPack(monkeypatch, ofsDelta)
+        runGit('verify-pack', packPath[:-len('.pack')] + '.idx')